@@ -5,30 +5,43 @@ UPDATED: Now includes Stripe integration for payments and authentication
 FIXED: AI no longer invents breaks/lunch that weren't requested
 """
 
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import FastAPI, HTTPException, Request, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse, PlainTextResponse, Response, StreamingResponse
 from pydantic import BaseModel
 from typing import Optional, List
 import sys
 import os
 import json
 import hashlib
+from email.utils import format_datetime, parsedate_to_datetime
 import secrets
-import re
 import unicodedata
-from datetime import datetime, timedelta, time
-from openai import OpenAI
+import itertools
+import base64
+from datetime import datetime, timedelta, timezone
 import stripe
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-import string
-import random
 
 # Add parent directory to path to import sheets_client
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from supabase_client import SheetsClient
+from supabase_client import SheetsClient, TRIAL_DAYS, trial_expires_at
+from instrumentation import REGISTRY, TimingMiddleware, track
+import stripe_catalog
+import subscription_state
+import stripe_events
+import trials
+import notifications
+import concurrency
+import postcommit
+import schedule_engine
+import schedule_parser
+import llm_gateway
+import schedule_templates
+import ics_feed
+import slot_io
 
 # ==================== NOTIFICATION MESSAGES (6 LANGUAGES) ====================
 NOTIF_MESSAGES = {
@@ -71,11 +84,69 @@ def get_notif_text(msg_key, language='en'):
     msgs = NOTIF_MESSAGES.get(msg_key, {})
     return msgs.get(language, msgs.get('en', ''))
 
+# Deferred notification producers: run after the response by
+# NotificationBatch.flush, return (customer_id, text, type) tuples.
+
+@notifications.producer
+def welcome_messages(sheets, customer_id):
+    """Welcome message in the doctor's language"""
+    doctor = sheets.get_doctor_by_customer_id(customer_id, fields=['language'])
+    lang = doctor.get('language', 'en') if doctor else 'en'
+    return [(customer_id, get_notif_text('welcome', lang), 'system')]
+
+@notifications.producer
+def first_appointment_messages(sheets, doctor_id, appointment_id=None):
+    """
+    First-appointment milestone, only when the booked appointment is the
+    doctor's earliest. Keyed on the appointment, not on a count, so later
+    bookings landing before this runs (or before an outbox retry) do not
+    suppress it. Without an appointment_id (tasks queued before it was
+    passed): only when the doctor has exactly one appointment.
+    """
+    doctor = sheets.get_doctor(doctor_id, fields=['customer_id', 'language'])
+    if not doctor or not doctor.get('customer_id'):
+        return []
+    if appointment_id is not None:
+        if str(sheets.get_first_appointment_id(doctor_id)) != str(appointment_id):
+            return []
+    elif sheets.count_doctor_appointments(doctor_id) != 1:
+        return []
+    return [(doctor['customer_id'], get_notif_text('first_appointment', doctor.get('language', 'en')), 'system')]
+
+@notifications.producer
+def referral_converted_messages(sheets, doctor_link, converted_name):
+    """Tell the referrer (found by invite_slug = converted doctor's link) that their invite converted"""
+    referral_result = sheets.supabase.table('referrals').select('referrer_customer_id').eq('invite_slug', doctor_link).limit(1).execute()
+    if not referral_result.data:
+        return []
+    referrer_customer_id = referral_result.data[0].get('referrer_customer_id')
+    if not referrer_customer_id:
+        return []
+    referrer = sheets.get_doctor_by_customer_id(referrer_customer_id, fields=['language'])
+    referrer_lang = referrer.get('language', 'en') if referrer else 'en'
+    text = get_notif_text('referral_converted', referrer_lang).replace('{name}', converted_name)
+    return [(referrer_customer_id, text, 'referral_converted')]
+
+# ==================== POST-COMMIT TASKS ====================
+# Run after the response (see postcommit.py); raise to be retried.
+
+@postcommit.task
+def set_invite_status(sheets, slug, status):
+    result = sheets.update_invite_status(slug, status)
+    if not result.get('success'):
+        raise RuntimeError(result.get('error', f'Failed to set invite {slug} to {status}'))
+
+@postcommit.task
+def send_email(sheets, subject, body, to_email=None):
+    if not send_notification_email(subject, body, to_email):
+        raise RuntimeError(f"Email not sent: {subject}")
+
 # Initialize FastAPI app
 app = FastAPI(
     title="SlotlyCare API",
     description="Healthcare appointment scheduling system with AI-powered slot generation",
-    version="2.0.0"
+    version="2.0.0",
+    default_response_class=ORJSONResponse
 )
 
 # Configure CORS
@@ -85,21 +156,17 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing"],
 )
 
-# Initialize OpenAI client
-openai_client = OpenAI()
+# Per-request timing (Server-Timing header + /metrics histograms)
+app.add_middleware(TimingMiddleware)
 
 # Initialize Stripe
 stripe.api_key = os.environ.get('STRIPE_SECRET_KEY')
 
 # ==================== PYDANTIC MODELS ====================
 
-class SlotModel(BaseModel):
-    date: str
-    time: str
-    status: str = "available"
-
 class DoctorModel(BaseModel):
     id: str
     name: str
@@ -113,10 +180,15 @@ class DoctorModel(BaseModel):
     welcome_message: Optional[str] = ""
     additional_info: Optional[str] = ""
     link: str
-    slots: Optional[List[SlotModel]] = []
+    slots: Optional[list] = []  # Validated in bulk by slot_io.parse_slots
     customer_id: Optional[str] = ""  # Stripe customer ID
     partner_source: Optional[str] = None  # Coupon code if came from partner channel
     plan_years: Optional[int] = None  # Subscription duration (default 3, referral gets 5)
+    schedule_template_id: Optional[str] = None  # Slots expanded from this template when none are sent
+    schedule_template_version: Optional[int] = None  # Default: latest (pinned on save)
+    schedule_overrides: Optional[dict] = None  # Personal overrides / blocked_dates / blocked_date_ranges
+    schedule_structure: Optional[dict] = None  # From a /api/schedule preview: slots expanded on save when none are sent
+    schedule_text: Optional[str] = None  # The text the structure came from (kept for batch regeneration)
 
 class AppointmentModel(BaseModel):
     doctor_id: str
@@ -126,10 +198,38 @@ class AppointmentModel(BaseModel):
     date: str
     time: str
     notes: Optional[str] = ""
+    hold_token: Optional[str] = None  # From /api/hold-slot
+
+class HoldSlotRequest(BaseModel):
+    doctor_id: str
+    date: str
+    time: str
+    hold_token: Optional[str] = None  # Renew / move an existing hold
+    minutes: Optional[int] = None
+
+class ReleaseSlotHoldRequest(BaseModel):
+    hold_token: str
+
+class NextSlotsRequest(BaseModel):
+    doctor_ids: List[str]
+
+class CalendarFeedRequest(BaseModel):
+    customer_id: str
+    rotate: Optional[bool] = False  # New URL; the old one stops working
 
 class ScheduleRequest(BaseModel):
     schedule_text: str
 
+class TemplateScheduleRequest(BaseModel):
+    template_id: str
+    version: Optional[int] = None
+    overrides: Optional[dict] = None  # Personal overrides / blocked_dates / blocked_date_ranges
+
+class CreateScheduleTemplateRequest(BaseModel):
+    id: str
+    name: str
+    structure: dict
+
 class Slot(BaseModel):
     date: str
     time: str
@@ -206,288 +306,174 @@ class NewGradRequest(BaseModel):
 
 # ==================== SCHEDULE FUNCTIONS ====================
 
-def validate_schedule_text(text: str) -> Optional[str]:
-    """Valida o texto de entrada para evitar abuso e garantir o mínimo de qualidade."""
-    text_lower = text.lower().strip()
-    if len(text_lower) < 15:
-        return "Schedule text is too short. Please provide more details (minimum 15 characters)."
-    
-    blocked_keywords = ["recipe", "receita", "bolo", "cake", "poem", "poema", "piada", "joke"]
-    if any(word in text_lower for word in blocked_keywords):
-        return "The text does not appear to be schedule-related. Please enter only information about your work hours."
-    
-    return None
-
-def get_schedule_structure_from_openai(text: str) -> dict:
-    """Chama a API da OpenAI para extrair uma estrutura FLEXÍVEL de horários."""
-    today = datetime.now().date()
-    end_date = today + timedelta(days=180)
-    
-    system_prompt = f'''You are a medical scheduling assistant. Today is {today.strftime("%Y-%m-%d")}.
-
-CRITICAL RULE: ONLY include what the user EXPLICITLY mentions. NEVER add anything they didn't ask for.
-
-Your task: Extract schedule information from the doctor's text and return a JSON structure.
-
-MULTILINGUAL SUPPORT - Accept input in ANY language:
-- Portuguese: Segunda, Terça, Quarta, Quinta, Sexta, Sábado, Domingo
-- Spanish: Lunes, Martes, Miércoles, Jueves, Viernes, Sábado, Domingo
-- French: Lundi, Mardi, Mercredi, Jeudi, Vendredi, Samedi, Dimanche
-- German: Montag, Dienstag, Mittwoch, Donnerstag, Freitag, Samstag, Sonntag
-- Italian: Lunedì, Martedì, Mercoledì, Giovedì, Venerdì, Sabato, Domenica
-- English: Monday, Tuesday, Wednesday, Thursday, Friday, Saturday, Sunday
-
-ALWAYS output day names in English.
-
-STRICT RULES - READ CAREFULLY:
-1. BREAKS/LUNCH: ONLY add breaks if user EXPLICITLY mentions: "lunch", "almoço", "almuerzo", "pause", "break", "intervalo", "pausa". If they don't mention it, breaks must be an EMPTY array [].
-2. SLOT DURATION: Use what user says. If not mentioned, default to 30 minutes.
-3. BLOCKED DATES: Only if user mentions vacation, block, holiday, férias, bloquear, etc.
-4. OVERRIDES: Only if user specifies DIFFERENT hours for specific days.
-
-EXAMPLES:
-
-Input: "Segunda a sexta 9h-17h. Sábado 8h-12h. Consulta de 20 minutos"
-Output:
-{{
-  "schedule": {{
-    "default": {{
-      "days": ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday"],
-      "start_time": "09:00",
-      "end_time": "17:00",
-      "slot_duration_minutes": 20,
-      "breaks": []
-    }},
-    "overrides": [
-      {{"day": "Saturday", "start_time": "08:00", "end_time": "12:00", "slot_duration_minutes": 20, "breaks": []}}
-    ],
-    "blocked_dates": [],
-    "blocked_date_ranges": []
-  }}
-}}
-
-Input: "Monday to Friday 8am-6pm, lunch 12pm-1pm"
-Output:
-{{
-  "schedule": {{
-    "default": {{
-      "days": ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday"],
-      "start_time": "08:00",
-      "end_time": "18:00",
-      "slot_duration_minutes": 30,
-      "breaks": [{{"start": "12:00", "end": "13:00"}}]
-    }},
-    "overrides": [],
-    "blocked_dates": [],
-    "blocked_date_ranges": []
-  }}
-}}
-
-Input: "Terça a sábado 10h-19h, consultas de 45 minutos"
-Output:
-{{
-  "schedule": {{
-    "default": {{
-      "days": ["Tuesday", "Wednesday", "Thursday", "Friday", "Saturday"],
-      "start_time": "10:00",
-      "end_time": "19:00",
-      "slot_duration_minutes": 45,
-      "breaks": []
-    }},
-    "overrides": [],
-    "blocked_dates": [],
-    "blocked_date_ranges": []
-  }}
-}}
-
-Input: "Segunda a sexta 9h-18h. Bloquear 20 de dezembro a 5 de janeiro para férias"
-Output:
-{{
-  "schedule": {{
-    "default": {{
-      "days": ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday"],
-      "start_time": "09:00",
-      "end_time": "18:00",
-      "slot_duration_minutes": 30,
-      "breaks": []
-    }},
-    "overrides": [],
-    "blocked_dates": [],
-    "blocked_date_ranges": [
-      {{"start": "2026-12-20", "end": "2027-01-05", "reason": "vacation"}}
-    ]
-  }}
-}}
-
-REMEMBER: 
-- NO breaks unless explicitly requested
-- Times in 24h format (HH:MM)
-- Dates in YYYY-MM-DD format
-- Return ONLY valid JSON, nothing else'''
-
-    response = openai_client.chat.completions.create(
-        model="gpt-4-turbo",
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": text}
-        ],
-        response_format={"type": "json_object"},
-        temperature=0.1  # Lower temperature for more consistent/literal responses
-    )
-    return json.loads(response.choices[0].message.content)
+# Preview window of /api/schedule?preview=true (the full horizon is expanded on save)
+PREVIEW_DAYS = 14
+PREVIEW_MAX_DAYS = 31
 
-def generate_slots(structure: dict) -> List[Slot]:
-    """Gera slots baseado em estrutura FLEXÍVEL com suporte a exceções."""
-    slots = []
-    today = datetime.now().date()
-    end_date = today + timedelta(days=180)
-    current_date = today
-
-    schedule_data = structure.get("schedule", structure)
-    default_config = schedule_data.get("default", schedule_data)
-    overrides = schedule_data.get("overrides", [])
-    blocked_ranges = schedule_data.get("blocked_date_ranges", [])
-    
-    # Parse blocked_dates - handle both string and dict formats
-    blocked_dates = set()
-    raw_blocked = schedule_data.get("blocked_dates", [])
-    for item in raw_blocked:
-        if isinstance(item, str):
-            blocked_dates.add(item)
-        elif isinstance(item, dict):
-            # Handle {"date": "2026-01-25"} or {"start": "...", "end": "..."}
-            if "date" in item:
-                blocked_dates.add(item["date"])
-            elif "start" in item and "end" in item:
-                # It's actually a range
-                try:
-                    start = datetime.strptime(item["start"], "%Y-%m-%d").date()
-                    end = datetime.strptime(item["end"], "%Y-%m-%d").date()
-                    current = start
-                    while current <= end:
-                        blocked_dates.add(current.strftime("%Y-%m-%d"))
-                        current += timedelta(days=1)
-                except:
-                    pass
-    
-    # Parse blocked ranges
-    for range_info in blocked_ranges:
-        try:
-            start = datetime.strptime(range_info["start"], "%Y-%m-%d").date()
-            end = datetime.strptime(range_info["end"], "%Y-%m-%d").date()
-            current = start
-            while current <= end:
-                blocked_dates.add(current.strftime("%Y-%m-%d"))
-                current += timedelta(days=1)
-        except:
-            pass
-    
-    # Day mapping
-    day_mapping = {
-        "Monday": 0, "Tuesday": 1, "Wednesday": 2, "Thursday": 3,
-        "Friday": 4, "Saturday": 5, "Sunday": 6
-    }
+def schedule_preview(schedule_structure: dict, compiled, days: int) -> dict:
+    """
+    Preview of a schedule: the structure, the slots of the first `days`
+    days and summary stats computed from the weekday grids (nothing
+    beyond the window is expanded).
+    """
+    days = max(1, min(days, PREVIEW_MAX_DAYS))
+    slots = list(compiled.iter_slots(days=days - 1))
     
-    # Default config with error handling
-    default_days = []
-    for d in default_config.get("days", []):
-        if d in day_mapping:
-            default_days.append(day_mapping[d])
+    stats = compiled.weekly_stats()
+    stats["horizon_days"] = schedule_engine.HORIZON_DAYS
+    stats["horizon_slots"] = compiled.count_slots()
     
+    return {
+        "success": True,
+        "preview": True,
+        "preview_days": days,
+        "schedule": schedule_structure,
+        "stats": stats,
+        "slots": slots,
+        "total_slots": len(slots),
+        "error": None
+    }
+
+def schedule_events(schedule_text: str, preview: bool, preview_days: int):
+    """
+    Server-sent events of /api/schedule?stream=sse:
+        default  the default day config, as soon as the model has written it
+        preview  provisional slots of the first PREVIEW_DAYS days and weekly
+                 stats from the default config alone (before overrides and
+                 blocked dates are known)
+        result   the same body /api/schedule returns without streaming
+        error    {"success": false, "status": ..., "error": ...}
+    """
     try:
-        default_start = time.fromisoformat(default_config.get("start_time", "09:00"))
-    except:
-        default_start = time.fromisoformat("09:00")
+        schedule_structure = None
+        for kind, value in schedule_parser.stream_schedule(schedule_text):
+            if kind == "schedule":
+                schedule_structure = value
+                continue
+            
+            yield sse_event("default", value)
+            try:
+                provisional = schedule_engine.compile_schedule(value)
+            except (ValueError, KeyError, TypeError, AttributeError):
+                continue
+            yield sse_event("preview", {
+                "provisional": True,
+                "stats": provisional.weekly_stats(),
+                "slots": list(provisional.iter_slots(days=PREVIEW_DAYS - 1))
+            })
+        
+        if not schedule_parser.is_complete(schedule_structure):
+            yield sse_event("error", {
+                "success": False, "status": 500,
+                "error": "AI could not extract a valid schedule structure. Try rephrasing your text."
+            })
+            return
+        
+        compiled = schedule_engine.compile_schedule(schedule_structure)
+        if preview:
+            result = schedule_preview(schedule_structure, compiled, preview_days)
+            has_slots = result["stats"]["slots_per_week"] > 0
+        else:
+            generated_slots = list(compiled.iter_slots())
+            result = {"success": True, "slots": generated_slots, "total_slots": len(generated_slots), "error": None}
+            has_slots = bool(generated_slots)
+        
+        if not has_slots:
+            yield sse_event("error", {
+                "success": False, "status": 404,
+                "error": "No appointment slots could be generated based on the provided text. Check days and hours."
+            })
+            return
+        
+        yield sse_event("result", result)
     
+    except llm_gateway.LLMUnavailable:
+        yield sse_event("error", {
+            "success": False, "status": 503,
+            "error": "The schedule assistant is temporarily unavailable. Please try again in a minute."
+        })
+    except Exception as e:
+        print(f"Schedule event stream failed: {e}")
+        yield sse_event("error", {
+            "success": False, "status": 500,
+            "error": f"An internal error occurred while processing your request: {str(e)}"
+        })
+
+# ==================== STREAMING ====================
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+NDJSON_CHUNK_LINES = 200
+
+def ndjson_lines(records, trailer=None):
+    """
+    Serialises records as NDJSON, NDJSON_CHUNK_LINES lines per chunk.
+    trailer(count) gives the last line (totals). The status code is sent
+    with the first chunk, so a failure mid-stream becomes a final
+    {"success": false, "error": ...} line.
+    """
+    buffer = []
+    count = 0
     try:
-        default_end = time.fromisoformat(default_config.get("end_time", "17:00"))
-    except:
-        default_end = time.fromisoformat("17:00")
-    
-    default_duration = default_config.get("slot_duration_minutes", 30)
-    if not isinstance(default_duration, int) or default_duration < 5:
-        default_duration = 30
-    
-    default_breaks = default_config.get("breaks", [])
-    if not isinstance(default_breaks, list):
-        default_breaks = []
-    
-    # Process overrides by day
-    day_overrides = {}
-    for override in overrides:
-        day_name = override.get("day")
-        if day_name in day_mapping:
-            day_overrides[day_name] = override
-    
-    # Generate slots day by day
-    while current_date <= end_date:
-        date_str = current_date.strftime("%Y-%m-%d")
-        
-        # Skip blocked dates
-        if date_str in blocked_dates:
-            current_date += timedelta(days=1)
-            continue
-        
-        weekday = current_date.weekday()
-        day_name = [k for k, v in day_mapping.items() if v == weekday][0]
-        
-        # Check if this day has override
-        if day_name in day_overrides:
-            override = day_overrides[day_name]
-            start_time = time.fromisoformat(override.get("start_time", "09:00"))
-            end_time = time.fromisoformat(override.get("end_time", "17:00"))
-            duration = override.get("slot_duration_minutes", default_duration)
-            breaks = override.get("breaks", [])
-        elif weekday in default_days:
-            start_time = default_start
-            end_time = default_end
-            duration = default_duration
-            breaks = default_breaks
+        for record in records:
+            buffer.append(slot_io.dumps(record))
+            count += 1
+            if len(buffer) >= NDJSON_CHUNK_LINES:
+                yield b'\n'.join(buffer) + b'\n'
+                buffer = []
+        if trailer:
+            buffer.append(slot_io.dumps(trailer(count)))
+    except Exception as e:
+        print(f"NDJSON stream failed after {count} records: {e}")
+        buffer.append(slot_io.dumps({"success": False, "error": str(e)}))
+    if buffer:
+        yield b'\n'.join(buffer) + b'\n'
+
+def ndjson_response(records, trailer=None) -> StreamingResponse:
+    """Streams an iterable of dicts as NDJSON (opt-in with ?stream=ndjson)."""
+    return StreamingResponse(ndjson_lines(records, trailer), media_type=NDJSON_MEDIA_TYPE)
+
+SSE_MEDIA_TYPE = "text/event-stream"
+
+def sse_event(event: str, data: dict) -> bytes:
+    """One server-sent event (orjson output never contains a newline)."""
+    return b'event: ' + event.encode() + b'\ndata: ' + slot_io.dumps(data) + b'\n\n'
+
+def sse_response(events) -> StreamingResponse:
+    """Streams an iterable of sse_event() chunks (opt-in with ?stream=sse)."""
+    return StreamingResponse(
+        events,
+        media_type=SSE_MEDIA_TYPE,
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# ==================== TRIAL EXPIRY ====================
+
+def trial_status(doctor) -> dict:
+    """
+    Trial expiry fields for a trial doctor, from the materialised expires_at
+    (single timestamp comparison). Rows created before expires_at existed
+    fall back to created_at.
+    """
+    now = datetime.now(timezone.utc)
+    try:
+        if doctor.expires_at:
+            expires_at = datetime.fromisoformat(str(doctor.expires_at).replace('Z', '+00:00'))
+        elif doctor.created_at:
+            created_at = datetime.strptime(str(doctor.created_at)[:10], '%Y-%m-%d').replace(tzinfo=timezone.utc)
+            expires_at = trial_expires_at(created_at)
         else:
-            current_date += timedelta(days=1)
-            continue
-        
-        # Parse breaks
-        break_intervals = []
-        for b in breaks:
-            break_intervals.append((
-                time.fromisoformat(b["start"]),
-                time.fromisoformat(b["end"])
-            ))
-        
-        # Generate slots for this day
-        current_slot_time = datetime.combine(current_date, start_time)
-        end_of_day = datetime.combine(current_date, end_time)
-        slot_delta = timedelta(minutes=duration)
-        
-        while current_slot_time < end_of_day:
-            slot_end = current_slot_time + slot_delta
-            if slot_end > end_of_day:
-                break
-            
-            # Check if slot overlaps with any break
-            in_break = False
-            break_end_time = None
-            for break_start, break_end in break_intervals:
-                # Check if current slot overlaps with this break
-                if not (current_slot_time.time() >= break_end or slot_end.time() <= break_start):
-                    in_break = True
-                    break_end_time = break_end
-                    break
-            
-            if in_break:
-                # Jump to the end of the break, not just the next slot
-                current_slot_time = datetime.combine(current_date, break_end_time)
-            else:
-                slots.append(Slot(
-                    date=current_slot_time.strftime("%Y-%m-%d"),
-                    time=current_slot_time.strftime("%H:%M")
-                ))
-                current_slot_time = slot_end
-        
-        current_date += timedelta(days=1)
+            return {"trial_expired": False, "trial_days_remaining": TRIAL_DAYS}
+    except Exception as e:
+        print(f"Trial date parse error: {e}, expires_at={doctor.expires_at}, created_at={doctor.created_at}")
+        return {"trial_expired": False, "trial_days_remaining": TRIAL_DAYS}
+    
+    if expires_at.tzinfo is None:
+        expires_at = expires_at.replace(tzinfo=timezone.utc)
     
-    return slots
+    return {
+        "trial_expired": doctor.trial_expired or now >= expires_at,
+        "trial_days_remaining": max(0, (expires_at.date() - now.date()).days)
+    }
 
 # ==================== ENDPOINTS ====================
 
@@ -508,6 +494,14 @@ async def root():
         ]
     }
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics(request: Request):
+    """Prometheus-style metrics (request and backend-call histograms)"""
+    token = os.environ.get('METRICS_TOKEN')
+    if token and not secrets.compare_digest(request.headers.get('authorization', ''), f"Bearer {token}"):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
 @app.get("/api/test")
 async def test_endpoint():
     """Test endpoint to verify API is working"""
@@ -518,33 +512,77 @@ async def test_endpoint():
     }
 
 @app.post("/api/schedule", response_model=ScheduleResponse, tags=["Scheduling"])
-async def generate_schedule(request: ScheduleRequest):
+async def generate_schedule(request: ScheduleRequest, stream: Optional[str] = None,
+                            preview: bool = False, preview_days: int = PREVIEW_DAYS):
     """
     Receives a natural language description of work hours,
     uses OpenAI to analyze it, and generates 180 days of available appointment slots.
+
+    With ?stream=ndjson the slots are streamed one per line as they are
+    generated, followed by a {"success": true, "total_slots": N} line.
+
+    With ?preview=true only the first preview_days days (default 14, max 31)
+    are returned, with the parsed structure and weekly stats (slots and
+    hours per week, slots over the full horizon). Send the structure as
+    schedule_structure to /api/save-doctor to expand the full horizon there.
+
+    With ?stream=sse the completion is streamed and parsed as it arrives:
+    the default config and provisional preview slots are sent as soon as
+    the model has written them, then the usual body (see schedule_events).
     """
     # 1. Validation
-    validation_error = validate_schedule_text(request.schedule_text)
+    validation_error = schedule_parser.validate_schedule_text(request.schedule_text)
     if validation_error:
         raise HTTPException(status_code=400, detail=validation_error)
+    
+    if stream == "sse":
+        return sse_response(schedule_events(request.schedule_text, preview, preview_days))
 
     try:
         # 2. OpenAI Processing
-        schedule_structure = get_schedule_structure_from_openai(request.schedule_text)
+        try:
+            # Blocking (retries and backoff up to the gateway deadline): off the event loop
+            schedule_structure = await concurrency.call(schedule_parser.parse_schedule, request.schedule_text)
+        except llm_gateway.LLMUnavailable:
+            raise HTTPException(
+                status_code=503,
+                detail="The schedule assistant is temporarily unavailable. Please try again in a minute."
+            )
 
         # Validate structure from OpenAI
-        schedule_data = schedule_structure.get("schedule", schedule_structure)
-        default_config = schedule_data.get("default", schedule_data)
-        
-        required_keys = ["days", "start_time", "end_time", "slot_duration_minutes"]
-        if not all(key in default_config for key in required_keys):
+        if not schedule_parser.is_complete(schedule_structure):
             raise HTTPException(
                 status_code=500, 
                 detail="AI could not extract a valid schedule structure. Try rephrasing your text."
             )
 
         # 3. Generate Slots
-        generated_slots = generate_slots(schedule_structure)
+        compiled = schedule_engine.compile_schedule(schedule_structure)
+        
+        if preview:
+            result = schedule_preview(schedule_structure, compiled, preview_days)
+            if not result["stats"]["slots_per_week"]:
+                raise HTTPException(
+                    status_code=404, 
+                    detail="No appointment slots could be generated based on the provided text. Check days and hours."
+                )
+            return ORJSONResponse(result)
+        
+        if stream == "ndjson":
+            slots = compiled.iter_slots()
+            first_slot = next(slots, None)
+            if first_slot is None:
+                raise HTTPException(
+                    status_code=404, 
+                    detail="No appointment slots could be generated based on the provided text. Check days and hours."
+                )
+            return ndjson_response(
+                itertools.chain([first_slot], slots),
+                trailer=lambda count: {"success": True, "total_slots": count}
+            )
+
+        with track('slotgen', '', 'generate_slots'):
+            generated_slots = list(compiled.iter_slots())
         
         if not generated_slots:
             raise HTTPException(
@@ -552,12 +590,13 @@ async def generate_schedule(request: ScheduleRequest):
                 detail="No appointment slots could be generated based on the provided text. Check days and hours."
             )
 
-        # 4. Return Response
-        return ScheduleResponse(
-            success=True,
-            slots=generated_slots,
-            total_slots=len(generated_slots)
-        )
+        # 4. Return Response (already in ScheduleResponse shape: skip re-validation)
+        return ORJSONResponse({
+            "success": True,
+            "slots": generated_slots,
+            "total_slots": len(generated_slots),
+            "error": None
+        })
 
     except HTTPException as http_exc:
         raise http_exc
@@ -567,6 +606,88 @@ async def generate_schedule(request: ScheduleRequest):
             detail=f"An internal error occurred while processing your request: {str(e)}"
         )
 
+# ==================== SCHEDULE TEMPLATES ====================
+
+def template_summary(template: dict) -> dict:
+    return {"id": template['id'], "version": template['version'], "name": template['name'], "structure": template['structure']}
+
+@app.get("/api/schedule-templates", tags=["Scheduling"])
+async def list_schedule_templates():
+    """Latest version of every shared schedule template"""
+    try:
+        sheets = SheetsClient()
+        templates = schedule_templates.list_templates(sheets)
+        
+        return {"success": True, "templates": [template_summary(t) for t in templates]}
+    
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Internal server error: {str(e)}"
+        )
+
+@app.post("/api/schedule/from-template", tags=["Scheduling"])
+async def schedule_from_template(request: TemplateScheduleRequest,
+                                 preview: bool = False, preview_days: int = PREVIEW_DAYS):
+    """
+    Generate slots from a shared template plus personal overrides and
+    blocked dates, without calling OpenAI (instant onboarding).
+    Same response shape as /api/schedule (including ?preview=true),
+    plus the template version used.
+    """
+    try:
+        sheets = SheetsClient()
+        
+        try:
+            expanded = schedule_templates.expand(sheets, request.template_id, request.version, request.overrides)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            raise HTTPException(status_code=400, detail="Invalid schedule overrides")
+        
+        if expanded is None:
+            raise HTTPException(status_code=404, detail="Schedule template not found")
+        
+        template, compiled = expanded
+        template_info = {"id": template['id'], "version": template['version'], "name": template['name']}
+        
+        if preview:
+            result = schedule_preview(template['structure'], compiled, preview_days)
+            result["template"] = template_info
+            return ORJSONResponse(result)
+        
+        generated_slots = list(compiled.iter_slots())
+        
+        return ORJSONResponse({
+            "success": True,
+            "template": template_info,
+            "slots": generated_slots,
+            "total_slots": len(generated_slots),
+            "error": None
+        })
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Internal server error: {str(e)}"
+        )
+
+@app.post("/api/schedule-templates", include_in_schema=False)
+async def create_schedule_template(request: Request, body: CreateScheduleTemplateRequest):
+    """Store a new version of a template (versions are immutable). Requires ADMIN_TOKEN."""
+    verify_admin_request(request)
+    
+    sheets = SheetsClient()
+    try:
+        result = schedule_templates.create_version(sheets, body.id, body.name, body.structure)
+    except (ValueError, KeyError, TypeError, AttributeError):
+        raise HTTPException(status_code=400, detail="Invalid schedule structure")
+    
+    if not result['success']:
+        raise HTTPException(status_code=500, detail=result.get('error', 'Failed to save template'))
+    
+    return {"success": True, "id": body.id, "version": result['version']}
+
 @app.get("/api/get-doctor")
 async def get_doctor(id: str):
     """
@@ -590,28 +711,12 @@ async def get_doctor(id: str):
         
         response = {
             "success": True,
-            "doctor": doctor
+            "doctor": doctor.to_dict()
         }
         
         # Check trial expiration
-        customer_id = doctor.get('customer_id', '')
-        if customer_id.startswith('trial_'):
-            created_at = doctor.get('created_at', '')
-            if created_at:
-                try:
-                    # Parse just the date part (first 10 chars: YYYY-MM-DD)
-                    created_at_str = str(created_at)[:10]
-                    created_date = datetime.strptime(created_at_str, '%Y-%m-%d')
-                    days_elapsed = (datetime.utcnow() - created_date).days
-                    response["trial_expired"] = days_elapsed >= 7
-                    response["trial_days_remaining"] = max(0, 7 - days_elapsed)
-                except Exception as e:
-                    print(f"Trial date parse error: {e}, created_at={created_at}")
-                    response["trial_expired"] = False
-                    response["trial_days_remaining"] = 7
-            else:
-                response["trial_expired"] = False
-                response["trial_days_remaining"] = 7
+        if (doctor.customer_id or '').startswith('trial_'):
+            response.update(trial_status(doctor))
         
         return response
     
@@ -647,27 +752,12 @@ async def get_doctor_by_customer(customer_id: str):
         
         response = {
             "success": True,
-            "doctor": doctor
+            "doctor": doctor.to_dict()
         }
         
         # Check trial expiration
         if customer_id.startswith('trial_'):
-            created_at = doctor.get('created_at', '')
-            if created_at:
-                try:
-                    # Parse just the date part (first 10 chars: YYYY-MM-DD)
-                    created_at_str = str(created_at)[:10]
-                    created_date = datetime.strptime(created_at_str, '%Y-%m-%d')
-                    days_elapsed = (datetime.utcnow() - created_date).days
-                    response["trial_expired"] = days_elapsed >= 7
-                    response["trial_days_remaining"] = max(0, 7 - days_elapsed)
-                except Exception as e:
-                    print(f"Trial date parse error: {e}, created_at={created_at}")
-                    response["trial_expired"] = False
-                    response["trial_days_remaining"] = 7
-            else:
-                response["trial_expired"] = False
-                response["trial_days_remaining"] = 7
+            response.update(trial_status(doctor))
         
         return response
     
@@ -678,7 +768,7 @@ async def get_doctor_by_customer(customer_id: str):
         )
 
 @app.post("/api/save-doctor")
-async def save_doctor(doctor: DoctorModel):
+async def save_doctor(doctor: DoctorModel, background_tasks: BackgroundTasks):
     """
     Save or update doctor configuration and availability slots
     
@@ -689,22 +779,33 @@ async def save_doctor(doctor: DoctorModel):
     - Success message with doctor ID and link
     """
     try:
+        try:
+            slots_data = slot_io.parse_slots(doctor.slots)
+        except slot_io.SlotPayloadError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        
         sheets = SheetsClient()
         
         # Determine if this is an update or new doctor
         existing_doctor = None
         doctor_id = doctor.id  # Default to provided ID (the link)
         
-        # If customer_id is provided, check if doctor already exists
+        # Independent lookups in parallel: who uses the link, and (if
+        # customer_id is provided) whether this doctor already exists
+        lookups = [concurrency.call(sheets.get_link_owner_ids, doctor.link)]
         if doctor.customer_id:
-            existing_doctor = sheets.get_doctor_by_customer_id(doctor.customer_id)
-            if existing_doctor:
-                # Use existing doctor's ID for updates
-                doctor_id = existing_doctor['id']
+            lookups.append(concurrency.call(sheets.get_doctor_by_customer_id, doctor.customer_id, fields=['id', 'link']))
+        link_owner_ids, *existing = await concurrency.gather(*lookups)
         
-        # Check if link is available (exclude current doctor if updating)
+        if existing and existing[0]:
+            existing_doctor = existing[0]
+            # Use existing doctor's ID for updates
+            doctor_id = existing_doctor['id']
+        
+        # Check if link is available (exclude current doctor if updating;
+        # a failed lookup counts as taken)
         exclude_id = doctor_id if existing_doctor else None
-        if not sheets.check_link_available(doctor.link, exclude_doctor_id=exclude_id):
+        if link_owner_ids is None or any(owner_id != exclude_id for owner_id in link_owner_ids):
             raise HTTPException(
                 status_code=400,
                 detail="This link is already taken. Please choose another one."
@@ -715,6 +816,27 @@ async def save_doctor(doctor: DoctorModel):
             # The link is changing - use new link as new ID
             doctor_id = doctor.link
         
+        # Template-based schedule: pin the version, expand if no slots were sent
+        template = None
+        if doctor.schedule_template_id:
+            try:
+                expanded = schedule_templates.expand(
+                    sheets, doctor.schedule_template_id, doctor.schedule_template_version, doctor.schedule_overrides
+                )
+            except (ValueError, KeyError, TypeError, AttributeError):
+                raise HTTPException(status_code=400, detail="Invalid schedule overrides")
+            if expanded is None:
+                raise HTTPException(status_code=400, detail="Schedule template not found")
+            template, compiled = expanded
+            if not slots_data:
+                slots_data = list(compiled.iter_slots())
+        elif doctor.schedule_structure and not slots_data:
+            # Confirmed preview: the full horizon is expanded only now
+            try:
+                slots_data = list(schedule_engine.iter_slots(doctor.schedule_structure))
+            except (ValueError, KeyError, TypeError, AttributeError):
+                raise HTTPException(status_code=400, detail="Invalid schedule structure")
+        
         # Prepare doctor data
         doctor_data = {
             'id': doctor_id if not existing_doctor else existing_doctor['id'],
@@ -733,9 +855,24 @@ async def save_doctor(doctor: DoctorModel):
             'partner_source': doctor.partner_source,
             'plan_years': doctor.plan_years
         }
-        
-        # Save doctor data
-        doctor_result = sheets.save_doctor(doctor_data)
+        # The schedule source always describes the slots being saved (batch
+        # regeneration rebuilds from it): hand-edited slots sent without a
+        # source clear it, so they are never replaced by a stale one
+        if template:
+            doctor_data['schedule_template_id'] = template['id']
+            doctor_data['schedule_template_version'] = template['version']
+            doctor_data['schedule_overrides'] = doctor.schedule_overrides
+            doctor_data['schedule_text'] = None
+            doctor_data['schedule_structure'] = None
+        elif slots_data:
+            doctor_data['schedule_text'] = doctor.schedule_text
+            doctor_data['schedule_structure'] = doctor.schedule_structure
+            doctor_data['schedule_template_id'] = None
+            doctor_data['schedule_template_version'] = None
+            doctor_data['schedule_overrides'] = None
+        
+        # Save doctor data (before the slots, which reference it)
+        doctor_result = await concurrency.call(sheets.save_doctor, doctor_data)
         
         if not doctor_result['success']:
             raise HTTPException(
@@ -745,20 +882,10 @@ async def save_doctor(doctor: DoctorModel):
         
         # Save availability slots if provided
         slots_saved = 0
-        is_first_schedule = False
-        if doctor.slots:
-            # Check if this is the first time generating slots
-            try:
-                existing_slots = sheets.get_availability(doctor_data['id'])
-                if not existing_slots or len(existing_slots) == 0:
-                    is_first_schedule = True
-            except Exception:
-                pass
-            
-            slots_data = [slot.dict() for slot in doctor.slots]
+        if slots_data:
             # Use the doctor's ID (which may be the old ID if updating)
             save_id = doctor_data['id']
-            slots_result = sheets.save_availability(save_id, slots_data)
+            slots_result = await concurrency.call(sheets.save_availability, save_id, slots_data)
             
             if not slots_result['success']:
                 raise HTTPException(
@@ -767,15 +894,14 @@ async def save_doctor(doctor: DoctorModel):
                 )
             
             slots_saved = slots_result.get('slots_count', 0)
+            # First time this doctor has slots
+            is_first_schedule = slots_result.get('previous_count', 0) == 0
             
-            # First schedule notification
+            # First schedule notification (written after the response)
             if is_first_schedule and slots_saved > 0 and doctor.customer_id:
-                try:
-                    lang = doctor.language or 'en'
-                    text = get_notif_text('first_schedule', lang)
-                    sheets.create_message(doctor.customer_id, text, 'system')
-                except Exception:
-                    pass
+                batch = notifications.NotificationBatch(sheets)
+                batch.add(doctor.customer_id, get_notif_text('first_schedule', doctor.language or 'en'), 'system')
+                batch.schedule(postcommit.PostCommit(sheets, background_tasks))
         
         return {
             "success": True,
@@ -794,20 +920,21 @@ async def save_doctor(doctor: DoctorModel):
         )
 
 @app.get("/api/get-slots")
-async def get_slots(doctor_id: str, date: Optional[str] = None):
+async def get_slots(doctor_id: str, date: Optional[str] = None, hold_token: Optional[str] = None):
     """
     Get available appointment slots for a doctor
     
     Parameters:
     - doctor_id: Doctor unique identifier (required)
     - date: Filter by specific date YYYY-MM-DD (optional)
+    - hold_token: Caller's hold, so the held slot is still listed (optional)
     
     Returns:
-    - List of available slots
+    - List of available slots (slots held by other patients are left out)
     """
     try:
         sheets = SheetsClient()
-        slots = sheets.get_availability(doctor_id, date)
+        slots = sheets.get_availability(doctor_id, date, hold_token=hold_token)
         
         return {
             "success": True,
@@ -824,7 +951,7 @@ async def get_slots(doctor_id: str, date: Optional[str] = None):
         )
 
 @app.post("/api/book-appointment")
-async def book_appointment(appointment: AppointmentModel):
+async def book_appointment(appointment: AppointmentModel, background_tasks: BackgroundTasks):
     """
     Create a new appointment
     
@@ -836,6 +963,7 @@ async def book_appointment(appointment: AppointmentModel):
     - date: Appointment date (YYYY-MM-DD)
     - time: Appointment time (HH:MM)
     - notes: Optional notes
+    - hold_token: Optional token from /api/hold-slot
     
     Returns:
     - Appointment confirmation
@@ -843,8 +971,8 @@ async def book_appointment(appointment: AppointmentModel):
     try:
         sheets = SheetsClient()
         
-        # Verify slot is still available
-        slots = sheets.get_availability(appointment.doctor_id, appointment.date)
+        # Verify slot is still available (and not held by another patient)
+        slots = sheets.get_availability(appointment.doctor_id, appointment.date, hold_token=appointment.hold_token)
         slot_available = any(
             slot['date'] == appointment.date and 
             slot['time'] == appointment.time and 
@@ -869,18 +997,14 @@ async def book_appointment(appointment: AppointmentModel):
             )
         
         # === FIRST APPOINTMENT NOTIFICATION ===
-        try:
-            doctor = sheets.get_doctor(appointment.doctor_id)
-            if doctor and doctor.get('customer_id'):
-                total = sheets.count_doctor_appointments(appointment.doctor_id)
-                if total == 1:
-                    lang = doctor.get('language', 'en')
-                    text = get_notif_text('first_appointment', lang)
-                    sheets.create_message(doctor['customer_id'], text, 'system')
-        except Exception as notif_error:
-            print(f"Notification error (non-blocking): {notif_error}")
-            # Notification failure should never block the appointment
-            print(f"Notification error (non-blocking): {notif_error}")
+        # Checked and written after the response: never blocks the appointment
+        batch = notifications.NotificationBatch(sheets)
+        batch.add_deferred(first_appointment_messages, appointment.doctor_id, result['appointment_id'])
+        batch.schedule(postcommit.PostCommit(sheets, background_tasks))
+        
+        # The slot is booked now, the hold is no longer needed
+        if appointment.hold_token:
+            background_tasks.add_task(sheets.release_slot_hold, appointment.hold_token)
         
         return {
             "success": True,
@@ -901,12 +1025,275 @@ async def book_appointment(appointment: AppointmentModel):
             detail=f"Internal server error: {str(e)}"
         )
 
+# ==================== AVAILABILITY SEARCH ====================
+
+SEARCH_DEFAULT_DAYS = 30
+SEARCH_MAX_DAYS = 90
+SEARCH_MAX_LIMIT = 200
+
+def encode_search_cursor(slot: dict) -> str:
+    """Opaque keyset cursor: the (date, time, doctor_id) of the last slot of a page"""
+    raw = json.dumps([slot['date'], slot['time'], slot['doctor_id']], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_search_cursor(cursor: str) -> tuple:
+    try:
+        date, time_str, doctor_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return (date, time_str, doctor_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+@app.get("/api/search-slots")
+async def search_slots(
+    specialty: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    limit: int = 50,
+    cursor: Optional[str] = None
+):
+    """
+    Earliest free slots across all doctors (directory / marketplace)
+    
+    Parameters:
+    - specialty: Filter by specialty (partial, case-insensitive, optional)
+    - date_from / date_to: Date window YYYY-MM-DD (default: today + 30 days, max 90 days)
+    - limit: Page size (max 200)
+    - cursor: next_cursor of the previous page
+    
+    Returns:
+    - Slots ordered by date and time, the doctors they belong to, and next_cursor
+    """
+    try:
+        try:
+            start = datetime.strptime(date_from, "%Y-%m-%d").date() if date_from else datetime.now().date()
+            end = datetime.strptime(date_to, "%Y-%m-%d").date() if date_to else start + timedelta(days=SEARCH_DEFAULT_DAYS)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Dates must be YYYY-MM-DD")
+        
+        if end < start or (end - start).days > SEARCH_MAX_DAYS:
+            raise HTTPException(status_code=400, detail=f"Date window must be 0 to {SEARCH_MAX_DAYS} days")
+        
+        limit = min(max(limit, 1), SEARCH_MAX_LIMIT)
+        after = decode_search_cursor(cursor) if cursor else None
+        
+        sheets = SheetsClient()
+        rows = sheets.search_availability(start.isoformat(), end.isoformat(), specialty, after, limit)
+        
+        slots = []
+        doctors = {}
+        for row in rows:
+            slots.append({"doctor_id": row['doctor_id'], "date": row['date'], "time": row['time']})
+            if row['doctor_id'] not in doctors:
+                doctors[row['doctor_id']] = {
+                    "name": row['doctor_name'],
+                    "specialty": row['specialty'] or '',
+                    "link": row['link'],
+                    "logo_url": row['logo_url'] or '',
+                    "color": row['color']
+                }
+        
+        return {
+            "success": True,
+            "slots": slots,
+            "doctors": doctors,
+            "count": len(slots),
+            "next_cursor": encode_search_cursor(slots[-1]) if len(slots) == limit else None
+        }
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Internal server error: {str(e)}"
+        )
+
+# ==================== NEXT AVAILABLE SLOT ====================
+
+NEXT_SLOTS_MAX_DOCTORS = 100
+
+@app.get("/api/next-slot")
+async def next_slot(doctor_id: str):
+    """
+    Next available slot of a doctor (for cards and invite pages)
+    
+    Returns:
+    - next_slot: {date, time}, or null if the doctor has no future availability
+    """
+    try:
+        sheets = SheetsClient()
+        next_slots = sheets.get_next_slots([doctor_id])
+        
+        if doctor_id not in next_slots:
+            raise HTTPException(status_code=404, detail="Doctor not found")
+        
+        return {"success": True, "doctor_id": doctor_id, "next_slot": next_slots[doctor_id]}
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Internal server error: {str(e)}"
+        )
+
+@app.post("/api/next-slots")
+async def next_slots_batch(request: NextSlotsRequest):
+    """
+    Next available slot of many doctors in one read
+    
+    Body:
+    - doctor_ids: Up to 100 doctor IDs
+    
+    Returns:
+    - next_slots: doctor_id -> {date, time} or null (unknown doctors are left out)
+    """
+    if len(request.doctor_ids) > NEXT_SLOTS_MAX_DOCTORS:
+        raise HTTPException(status_code=400, detail=f"At most {NEXT_SLOTS_MAX_DOCTORS} doctors per request")
+    
+    try:
+        sheets = SheetsClient()
+        next_slots = sheets.get_next_slots(set(request.doctor_ids)) if request.doctor_ids else {}
+        
+        return {"success": True, "next_slots": next_slots}
+    
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Internal server error: {str(e)}"
+        )
+
+# ==================== SLOT HOLDS ====================
+
+SLOT_HOLD_MINUTES = 5
+SLOT_HOLD_MAX_MINUTES = 15
+
+@app.post("/api/hold-slot")
+async def hold_slot(request: HoldSlotRequest):
+    """
+    Reserve a slot while the patient fills in the booking form
+    
+    Body:
+    - doctor_id, date (YYYY-MM-DD), time (HH:MM)
+    - hold_token: Optional, renews or moves the caller's existing hold
+    - minutes: Optional hold duration (default 5, max 15)
+    
+    Returns:
+    - hold_token to pass to /api/book-appointment, and expires_at
+    """
+    try:
+        sheets = SheetsClient()
+        minutes = min(max(request.minutes or SLOT_HOLD_MINUTES, 1), SLOT_HOLD_MAX_MINUTES)
+        token = request.hold_token or secrets.token_urlsafe(16)
+        
+        # Holds are keyed on the text of date and time: one form only, so
+        # "09:00" and "09:00:00" can never be held by two patients at once
+        try:
+            slot_date, slot_time = slot_io.normalize_slot(request.date, request.time)
+        except slot_io.SlotPayloadError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid date or time: {e}")
+        
+        now = datetime.now()
+        if (slot_date, slot_time) < (now.strftime('%Y-%m-%d'), now.strftime('%H:%M')):
+            raise HTTPException(status_code=400, detail="This time slot has already passed")
+        
+        status = sheets.get_slot_set(request.doctor_id, slot_date).status_of(slot_date, slot_time)
+        
+        if status != 'available':
+            raise HTTPException(
+                status_code=400,
+                detail="This time slot is no longer available"
+            )
+        
+        result = sheets.hold_slot(request.doctor_id, slot_date, slot_time, token, minutes)
+        
+        if not result['success']:
+            raise HTTPException(
+                status_code=500,
+                detail=result.get('error', 'Failed to hold slot')
+            )
+        
+        if not result['held']:
+            raise HTTPException(
+                status_code=409,
+                detail="This time slot is being held by another patient"
+            )
+        
+        # One hold per token: moving to another slot frees the previous one
+        if request.hold_token:
+            sheets.release_slot_hold(token, keep=(slot_date, slot_time))
+        
+        return {
+            "success": True,
+            "hold_token": token,
+            "expires_at": result['expires_at'],
+            "minutes": minutes
+        }
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Internal server error: {str(e)}"
+        )
+
+@app.post("/api/release-slot-hold")
+async def release_slot_hold(request: ReleaseSlotHoldRequest):
+    """Release a hold (patient picked another slot or left)"""
+    sheets = SheetsClient()
+    released = sheets.release_slot_hold(request.hold_token)
+    
+    return {"success": True, "released": released}
+
 # ==================== STRIPE & AUTH ENDPOINTS ====================
 
 def hash_password(password: str) -> str:
     """Hash password with SHA256"""
     return hashlib.sha256(password.encode()).hexdigest()
 
+def stripe_customer_exists(customer_id: str) -> bool:
+    """Whether the Stripe customer can be retrieved"""
+    try:
+        with track('stripe', 'Customer', 'retrieve'):
+            stripe.Customer.retrieve(customer_id)
+        return True
+    except Exception:
+        return False
+
+def resolve_price_id(test_mode: bool) -> str:
+    """Price ID for checkout: test_mode usa preço de teste (R$1), produção usa env var"""
+    if test_mode:
+        return 'price_1T2DRCDMcPDY3XCzzyVX5NbI'  # Live BRL R$1,00 (para testes)
+    return os.environ.get('STRIPE_PRICE_ID', 'price_1SpFPDRmTP4UQnz3uiYcFQON')
+
+@app.get("/api/price")
+async def get_price(test_mode: bool = False):
+    """
+    Get the checkout price (amount and currency) for landing pages.
+    Served from the Stripe catalog cache.
+    """
+    try:
+        price = stripe_catalog.get_price(resolve_price_id(test_mode))
+        if not price:
+            raise HTTPException(status_code=404, detail="Price not found")
+
+        return {
+            "success": True,
+            "price_id": price['id'],
+            "unit_amount": price['unit_amount'],
+            "currency": price['currency'],
+            "active": price['active']
+        }
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to retrieve price: {str(e)}"
+        )
+
 @app.post("/api/create-checkout-session")
 async def create_checkout_session(request: CreateCheckoutRequest):
     """
@@ -914,11 +1301,7 @@ async def create_checkout_session(request: CreateCheckoutRequest):
     Supports partner landings via coupon_code and test_mode parameters.
     """
     try:
-        # Escolhe o Price ID: test_mode usa preço de teste (R$1), produção usa env var
-        if request.test_mode:
-            price_id = 'price_1T2DRCDMcPDY3XCzzyVX5NbI'  # Live BRL R$1,00 (para testes)
-        else:
-            price_id = os.environ.get('STRIPE_PRICE_ID', 'price_1SpFPDRmTP4UQnz3uiYcFQON')
+        price_id = resolve_price_id(request.test_mode)
         
         # Base checkout parameters
         checkout_params = {
@@ -943,11 +1326,10 @@ async def create_checkout_session(request: CreateCheckoutRequest):
             # Trial: desconto automático 30% (Referral30)
             checkout_params['discounts'] = [{'promotion_code': 'promo_1T0Ov8DMcPDY3XCzs2doSm4F'}]
         elif request.coupon_code:
-            # Parceiro: busca o promotion_code pelo código legível (ex: "CIOSP2026")
-            promo_list = stripe.PromotionCode.list(code=request.coupon_code, limit=1, active=True)
-            if not promo_list.data:
+            # Parceiro: busca o promotion_code pelo código legível (ex: "CIOSP2026"), com cache
+            promo_id = stripe_catalog.get_promotion_code_id(request.coupon_code)
+            if not promo_id:
                 raise HTTPException(status_code=400, detail=f"Coupon '{request.coupon_code}' not found or inactive")
-            promo_id = promo_list.data[0].id
             checkout_params['discounts'] = [{'promotion_code': promo_id}]
         else:
             # Compra normal: usuário pode digitar cupom manualmente
@@ -961,7 +1343,8 @@ async def create_checkout_session(request: CreateCheckoutRequest):
         if request.plan_years:
             checkout_params.setdefault('metadata', {})['plan_years'] = str(request.plan_years)
         
-        checkout_session = stripe.checkout.Session.create(**checkout_params)
+        with track('stripe', 'checkout.Session', 'create'):
+            checkout_session = stripe.checkout.Session.create(**checkout_params)
         
         return {
             "success": True,
@@ -983,7 +1366,8 @@ async def get_checkout_session(session_id: str):
     Get checkout session details after payment
     """
     try:
-        session = stripe.checkout.Session.retrieve(session_id)
+        with track('stripe', 'checkout.Session', 'retrieve'):
+            session = stripe.checkout.Session.retrieve(session_id)
         
         customer_id = session.customer
         customer_email = session.customer_details.email if session.customer_details else None
@@ -992,10 +1376,11 @@ async def get_checkout_session(session_id: str):
         # Create a Stripe Customer so success.html can proceed normally
         if not customer_id and session.payment_status == "paid" and customer_email:
             try:
-                new_customer = stripe.Customer.create(
-                    email=customer_email,
-                    metadata={"source": "payment_link", "session_id": session_id}
-                )
+                with track('stripe', 'Customer', 'create'):
+                    new_customer = stripe.Customer.create(
+                        email=customer_email,
+                        metadata={"source": "payment_link", "session_id": session_id}
+                    )
                 customer_id = new_customer.id
                 print(f"Created customer {customer_id} for Payment Link session {session_id}")
             except Exception as ce:
@@ -1018,12 +1403,13 @@ async def get_checkout_session(session_id: str):
         )
 
 @app.post("/api/stripe-webhook")
-async def stripe_webhook(request: Request):
+async def stripe_webhook(request: Request, background_tasks: BackgroundTasks):
     """
     Stripe Webhook — safety net for payment confirmation.
-    Listens for checkout.session.completed events and saves
-    the account to pending_accounts so it can be recovered
-    even if success.html fails.
+    Verifies the signature, persists the raw event and acknowledges
+    immediately; the event is processed afterwards by the queue worker
+    (pending_accounts for checkout.session.completed, subscription
+    projection for /api/verify-subscription).
     """
     payload = await request.body()
     sig_header = request.headers.get('stripe-signature')
@@ -1033,49 +1419,30 @@ async def stripe_webhook(request: Request):
         raise HTTPException(status_code=500, detail="Webhook secret not configured")
 
     try:
-        event = stripe.Webhook.construct_event(payload, sig_header, webhook_secret)
+        stripe.Webhook.construct_event(payload, sig_header, webhook_secret)
     except stripe.error.SignatureVerificationError:
         raise HTTPException(status_code=400, detail="Invalid signature")
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Webhook error: {str(e)}")
 
-    if event['type'] == 'checkout.session.completed':
-        session = event['data']['object']
+    # Signature is valid: keep the raw JSON as the queued payload
+    event = json.loads(payload)
 
-        customer_id = session.get('customer')
-        customer_email = None
-        if session.get('customer_details'):
-            customer_email = session['customer_details'].get('email')
+    # Promotion code / price changes invalidate the catalog cache
+    stripe_catalog.handle_catalog_event(event)
 
-        metadata = session.get('metadata', {}) or {}
-        partner_source = metadata.get('partner_coupon')
-        plan_years = int(metadata.get('plan_years', 3))
-        amount_total = session.get('amount_total')
+    # Stripe redelivers on timeouts and errors: each event ID is queued once
+    try:
+        sheets = SheetsClient()
+        is_new = sheets.enqueue_stripe_event(event, stripe_events.event_customer_id(event))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Webhook error: {str(e)}")
 
-        # If no customer was created (Payment Link flow), create one
-        if not customer_id and session.get('payment_status') == 'paid' and customer_email:
-            try:
-                new_customer = stripe.Customer.create(
-                    email=customer_email,
-                    metadata={"source": "webhook", "session_id": session.get('id', '')}
-                )
-                customer_id = new_customer.id
-            except Exception:
-                pass
+    if not is_new:
+        return JSONResponse(content={"received": True, "duplicate": True}, status_code=200)
 
-        try:
-            sheets = SheetsClient()
-            sheets.save_pending_account({
-                'session_id': session.get('id', ''),
-                'customer_id': customer_id or '',
-                'customer_email': customer_email or '',
-                'partner_source': partner_source,
-                'plan_years': plan_years,
-                'payment_status': session.get('payment_status', ''),
-                'amount_total': amount_total
-            })
-        except Exception as e:
-            print(f"Webhook: failed to save pending account: {e}")
+    # Process after the response is sent; the cron drains anything left over
+    background_tasks.add_task(stripe_events.process_pending, sheets, 20)
 
     return JSONResponse(content={"received": True}, status_code=200)
 
@@ -1138,14 +1505,15 @@ async def recover_account(request: RecoverAccountRequest):
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
 @app.post("/api/set-password")
-async def set_password(request: SetPasswordRequest):
+async def set_password(request: SetPasswordRequest, background_tasks: BackgroundTasks):
     """
     Set password for a customer after payment
     """
     try:
         # Verify customer exists in Stripe
         try:
-            customer = stripe.Customer.retrieve(request.customer_id)
+            with track('stripe', 'Customer', 'retrieve'):
+                customer = stripe.Customer.retrieve(request.customer_id)
         except:
             raise HTTPException(status_code=404, detail="Customer not found")
         
@@ -1164,14 +1532,10 @@ async def set_password(request: SetPasswordRequest):
         if not result['success']:
             raise HTTPException(status_code=500, detail="Failed to save user")
         
-        # Welcome message
-        try:
-            doctor = sheets.get_doctor_by_customer_id(request.customer_id)
-            lang = doctor.get('language', 'en') if doctor else 'en'
-            text = get_notif_text('welcome', lang)
-            sheets.create_message(request.customer_id, text, 'system')
-        except Exception:
-            pass
+        # Welcome message (written after the response)
+        batch = notifications.NotificationBatch(sheets)
+        batch.add_deferred(welcome_messages, request.customer_id)
+        batch.schedule(postcommit.PostCommit(sheets, background_tasks))
         
         return {
             "success": True,
@@ -1225,14 +1589,21 @@ async def login(request: LoginRequest):
 @app.get("/api/verify-subscription/{customer_id}")
 async def verify_subscription(customer_id: str):
     """
-    Check if customer has active subscription
+    Check if customer has active subscription.
+    Answered from the local projection kept up to date by the Stripe webhook;
+    customers not projected yet, or projected without a subscription status
+    (only payment events seen so far), are looked up in Stripe.
     """
     try:
-        subscriptions = stripe.Subscription.list(customer=customer_id, status='active')
+        sheets = SheetsClient()
+        state = sheets.get_subscription_state(customer_id)
+        if state is None or state.get('status') == 'none':
+            state = subscription_state.refresh_customer(sheets, customer_id)
         
         return {
             "success": True,
-            "active": len(subscriptions.data) > 0,
+            "active": bool(state.get('active')),
+            "status": state.get('status'),
             "customer_id": customer_id
         }
     
@@ -1243,18 +1614,27 @@ async def verify_subscription(customer_id: str):
         )
 
 @app.get("/api/get-appointments")
-async def get_appointments(customer_id: str):
+async def get_appointments(customer_id: str, stream: Optional[str] = None):
     """
     Get all appointments for a doctor (by customer_id)
+
+    With ?stream=ndjson appointments are read page by page and streamed
+    one per line, followed by a {"success": true, "count": N} line.
     """
     try:
         sheets = SheetsClient()
         
         # First get doctor_id from customer_id
-        doctor = sheets.get_doctor_by_customer_id(customer_id)
+        doctor = sheets.get_doctor_by_customer_id(customer_id, fields=['id'])
         if not doctor:
             raise HTTPException(status_code=404, detail="Doctor not found")
         
+        if stream == "ndjson":
+            return ndjson_response(
+                sheets.iter_appointments(doctor['id']),
+                trailer=lambda count: {"success": True, "count": count}
+            )
+        
         appointments = sheets.get_appointments(doctor['id'])
         
         return {
@@ -1271,6 +1651,212 @@ async def get_appointments(customer_id: str):
             detail=f"Internal server error: {str(e)}"
         )
 
+# ==================== CALENDAR FEED ====================
+
+# Feed window: recent history plus the bookable future
+CALENDAR_PAST_DAYS = 30
+CALENDAR_FUTURE_DAYS = 366
+# Deletions are remembered this long; older sync tokens get 410 (full resync)
+SYNC_TOKEN_MAX_AGE_DAYS = 90
+# A change stamped just before a token's time may commit just after it
+SYNC_OVERLAP_SECONDS = 5
+
+def parse_timestamp(value: str) -> datetime:
+    return datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+
+def encode_sync_token(changed_at: str) -> str:
+    return base64.urlsafe_b64encode(str(changed_at).encode()).decode()
+
+def decode_sync_token(sync_token: str) -> datetime:
+    try:
+        return parse_timestamp(base64.urlsafe_b64decode(sync_token.encode()).decode())
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid sync token")
+
+def calendar_window():
+    today = datetime.now().date()
+    return (
+        (today - timedelta(days=CALENDAR_PAST_DAYS)).isoformat(),
+        (today + timedelta(days=CALENDAR_FUTURE_DAYS)).isoformat()
+    )
+
+def feed_last_modified(doctor: dict) -> datetime:
+    """
+    Last change of the feed: the doctor's last appointment change, or the
+    start of today (UTC) when the window last moved, whichever is later.
+    """
+    changed_at = parse_timestamp(doctor['appointments_changed_at']).replace(microsecond=0)
+    window_moved = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    return max(changed_at, window_moved)
+
+def not_modified(request: Request, etag: str, last_modified: datetime) -> bool:
+    """Conditional GET: If-None-Match wins over If-Modified-Since."""
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match:
+        return if_none_match.strip() == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]
+    
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_modified_since:
+        try:
+            return last_modified <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+@app.post("/api/calendar-feed", tags=["Calendar"])
+async def calendar_feed_url(request: Request, body: CalendarFeedRequest):
+    """
+    The doctor's private ICS feed URL, for subscribing from a phone or
+    desktop calendar. Created on first use; rotate=true revokes the old URL.
+    """
+    try:
+        sheets = SheetsClient()
+        
+        doctor = sheets.get_doctor_by_customer_id(body.customer_id, fields=['id'])
+        if not doctor:
+            raise HTTPException(status_code=404, detail="Doctor not found")
+        
+        token = sheets.set_calendar_token(doctor['id'], secrets.token_urlsafe(24), only_if_missing=not body.rotate)
+        if not token:
+            raise HTTPException(status_code=500, detail="Failed to create calendar feed")
+        
+        base_url = str(request.base_url).rstrip('/')
+        feed_url = f"{base_url}/api/calendar/{token}.ics"
+        
+        return {
+            "success": True,
+            "url": feed_url,
+            "webcal_url": "webcal://" + feed_url.split("://", 1)[1],
+            "changes_url": f"{base_url}/api/calendar/{token}/changes"
+        }
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Internal server error: {str(e)}"
+        )
+
+@app.get("/api/calendar/{token}.ics", tags=["Calendar"])
+async def calendar_feed(token: str, request: Request):
+    """
+    ICS feed of a doctor's appointments (last 30 days and the next year).
+
+    Supports ETag / If-None-Match and Last-Modified / If-Modified-Since:
+    a poll with nothing new is one indexed read answered with 304. The
+    window is read in full before the response starts, so a failed read
+    is a 500 and never a truncated feed cached under a valid ETag.
+    """
+    try:
+        sheets = SheetsClient()
+        
+        doctor = sheets.get_calendar_feed_doctor(token)
+        if not doctor:
+            raise HTTPException(status_code=404, detail="Calendar feed not found")
+        
+        # Event length from the doctor's slot length, when the schedule is known
+        durations = None
+        if doctor.get('schedule_structure'):
+            try:
+                durations = schedule_engine.compile_schedule(doctor['schedule_structure']).durations
+            except (ValueError, KeyError, TypeError, AttributeError):
+                pass
+        
+        # Last-Modified has whole-second resolution; the ETag uses the full
+        # timestamp so two changes within one second still differ, and the
+        # durations, which set every DTEND
+        date_from, date_to = calendar_window()
+        last_modified = feed_last_modified(doctor)
+        digest = hashlib.sha256(
+            f"{doctor['id']}|{doctor['name']}|{doctor['appointments_changed_at']}|{date_from}|{durations}".encode()
+        ).hexdigest()[:20]
+        etag = f'W/"{digest}"'
+        headers = {
+            "ETag": etag,
+            "Last-Modified": format_datetime(last_modified, usegmt=True),
+            "Cache-Control": "private, max-age=300"
+        }
+        
+        if not_modified(request, etag, last_modified):
+            return Response(status_code=304, headers=headers)
+        
+        appointments = list(sheets.iter_appointments(doctor['id'], date_from=date_from, date_to=date_to))
+        
+        return StreamingResponse(
+            ics_feed.iter_ics(doctor['name'], appointments, durations),
+            media_type="text/calendar; charset=utf-8",
+            headers=headers
+        )
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Internal server error: {str(e)}"
+        )
+
+@app.get("/api/calendar/{token}/changes", tags=["Calendar"])
+async def calendar_changes(token: str, sync_token: Optional[str] = None):
+    """
+    Incremental sync of the feed's appointments.
+
+    Without sync_token: every appointment of the feed window ("full": true).
+    With the sync_token of the previous response: only appointments created
+    or changed since, and the IDs of cancelled ones. Nothing new costs one
+    indexed read. A token older than 90 days gets 410: start over without one.
+    """
+    try:
+        sheets = SheetsClient()
+        
+        doctor = sheets.get_calendar_feed_doctor(token)
+        if not doctor:
+            raise HTTPException(status_code=404, detail="Calendar feed not found")
+        
+        # Read before the changes, and every change is stamped no later than
+        # it: with all pages read, nothing up to the token is left out
+        changed_at = parse_timestamp(doctor['appointments_changed_at'])
+        new_sync_token = encode_sync_token(doctor['appointments_changed_at'])
+        
+        if sync_token is None:
+            date_from, date_to = calendar_window()
+            appointments = list(sheets.iter_appointments(doctor['id'], date_from=date_from, date_to=date_to))
+            return ORJSONResponse({
+                "success": True,
+                "full": True,
+                "appointments": appointments,
+                "cancelled": [],
+                "sync_token": new_sync_token
+            })
+        
+        since = decode_sync_token(sync_token)
+        if since < datetime.now(timezone.utc) - timedelta(days=SYNC_TOKEN_MAX_AGE_DAYS):
+            raise HTTPException(status_code=410, detail="Sync token expired, resync without it")
+        
+        if since >= changed_at:
+            return {"success": True, "full": False, "appointments": [], "cancelled": [], "sync_token": sync_token}
+        
+        appointments, cancelled = sheets.get_appointment_changes(
+            doctor['id'], (since - timedelta(seconds=SYNC_OVERLAP_SECONDS)).isoformat()
+        )
+        
+        return ORJSONResponse({
+            "success": True,
+            "full": False,
+            "appointments": appointments,
+            "cancelled": cancelled,
+            "sync_token": new_sync_token
+        })
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Internal server error: {str(e)}"
+        )
+
 # ==================== SLUG GENERATION HELPERS ====================
 
 def generate_slug(name: str) -> str:
@@ -1355,7 +1941,7 @@ async def batch_referrals(request: BatchReferralRequest):
         sheets = SheetsClient()
         
         # Get referrer doctor's name (for the green bar on convite.html)
-        referrer_doctor = sheets.get_doctor_by_customer_id(request.referrer_customer_id)
+        referrer_doctor = sheets.get_doctor_by_customer_id(request.referrer_customer_id, fields=['name'])
         referrer_name = referrer_doctor['name'] if referrer_doctor else ''
         
         results = []
@@ -1372,6 +1958,7 @@ async def batch_referrals(request: BatchReferralRequest):
                     'invited_name': item.name,
                     'slug': unique_slug,
                     'referrer_name': referrer_name,
+                    'referrer_customer_id': request.referrer_customer_id,
                     'status': 'pending',
                     'contact_info': item.email,
                     'type': item.type
@@ -1418,23 +2005,19 @@ async def batch_referrals(request: BatchReferralRequest):
         )
 
 @app.get("/api/referral-stats")
-async def referral_stats(customer_id: str):
+async def referral_stats(customer_id: str, invites_limit: int = 20):
     """
     Get referral statistics for a doctor.
     Shows how many colleagues were invited and their status.
+    Counts come from one aggregate query; `invites` holds only the first
+    page (invites_limit, 0 to skip) — use /api/referral-invites for more.
     """
     try:
         sheets = SheetsClient()
         
-        # Get doctor name from customer_id
-        doctor = sheets.get_doctor_by_customer_id(customer_id)
-        if not doctor:
-            return {
-                "success": True,
-                "stats": {'total': 0, 'pending': 0, 'clicked': 0, 'trial_started': 0, 'converted': 0, 'invites': []}
-            }
-        
-        stats = sheets.get_referral_stats(doctor['name'])
+        stats = sheets.get_referral_stats(customer_id)
+        invites_limit = max(0, min(invites_limit, 100))
+        stats['invites'] = sheets.get_referral_invites(customer_id, limit=invites_limit) if invites_limit else []
         
         return {
             "success": True,
@@ -1447,6 +2030,33 @@ async def referral_stats(customer_id: str):
             detail=f"Internal server error: {str(e)}"
         )
 
+@app.get("/api/referral-invites")
+async def referral_invites(customer_id: str, limit: int = 20, offset: int = 0):
+    """
+    Get a page of a doctor's invites (most recent first)
+    """
+    try:
+        limit = max(1, min(limit, 100))
+        offset = max(0, offset)
+        
+        sheets = SheetsClient()
+        # Fetch one extra row to know if there is a next page
+        invites = sheets.get_referral_invites(customer_id, limit=limit + 1, offset=offset)
+        
+        return {
+            "success": True,
+            "invites": invites[:limit],
+            "offset": offset,
+            "limit": limit,
+            "has_more": len(invites) > limit
+        }
+    
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Internal server error: {str(e)}"
+        )
+
 @app.get("/api/invite-partner-check/{slug}")
 async def invite_partner_check(slug: str):
     """
@@ -1468,7 +2078,7 @@ async def invite_partner_check(slug: str):
             return {"success": True, "partner_source": None}
         
         # 2. Look up the referrer's doctor record for partner_source
-        doctor = sheets.get_doctor_by_customer_id(referrer_customer_id)
+        doctor = sheets.get_doctor_by_customer_id(referrer_customer_id, fields=['partner_source', 'plan_years'])
         if not doctor:
             return {"success": True, "partner_source": None}
         
@@ -1487,7 +2097,7 @@ async def invite_partner_check(slug: str):
 # ==================== TRIAL ENDPOINTS ====================
 
 @app.post("/api/trial-signup")
-async def trial_signup(request: TrialSignupRequest):
+async def trial_signup(request: TrialSignupRequest, background_tasks: BackgroundTasks):
     """
     Create a trial account (no payment required).
     Generates a trial customer_id and creates user + doctor records.
@@ -1542,15 +2152,13 @@ async def trial_signup(request: TrialSignupRequest):
         if not doctor_result['success']:
             raise HTTPException(status_code=500, detail="Failed to create doctor profile")
         
-        # Update invite status
-        sheets.update_invite_status(slug, 'trial_started')
+        # Invite status and welcome message (after the response)
+        pipeline = postcommit.PostCommit(sheets, background_tasks)
+        pipeline.add(set_invite_status, slug, 'trial_started')
         
-        # Welcome message
-        try:
-            text = get_notif_text('welcome', 'en')
-            sheets.create_message(trial_id, text, 'system')
-        except Exception:
-            pass
+        batch = notifications.NotificationBatch(sheets)
+        batch.add(trial_id, get_notif_text('welcome', 'en'), 'system')
+        batch.schedule(pipeline)
         
         return {
             "success": True,
@@ -1568,7 +2176,7 @@ async def trial_signup(request: TrialSignupRequest):
         )
 
 @app.post("/api/upgrade-trial")
-async def upgrade_trial(request: UpgradeTrialRequest):
+async def upgrade_trial(request: UpgradeTrialRequest, background_tasks: BackgroundTasks):
     """
     Upgrade a trial account to paid.
     Replaces trial_xxx customer_id with cus_xxx from Stripe
@@ -1585,19 +2193,20 @@ async def upgrade_trial(request: UpgradeTrialRequest):
         
         sheets = SheetsClient()
         
-        # Verify trial account exists
-        doctor = sheets.get_doctor_by_customer_id(request.trial_customer_id)
+        # Verify trial account and Stripe customer exist (in parallel)
+        doctor, customer_exists = await concurrency.gather(
+            concurrency.call(sheets.get_doctor_by_customer_id, request.trial_customer_id, fields=['id', 'name', 'link']),
+            concurrency.call(stripe_customer_exists, request.stripe_customer_id)
+        )
         if not doctor:
             raise HTTPException(status_code=404, detail="Trial account not found")
         
-        # Verify Stripe customer exists
-        try:
-            stripe.Customer.retrieve(request.stripe_customer_id)
-        except:
+        if not customer_exists:
             raise HTTPException(status_code=404, detail="Stripe customer not found")
         
         # Perform the upgrade
-        result = sheets.upgrade_trial_to_paid(
+        result = await concurrency.call(
+            sheets.upgrade_trial_to_paid,
             request.trial_customer_id,
             request.stripe_customer_id
         )
@@ -1605,28 +2214,16 @@ async def upgrade_trial(request: UpgradeTrialRequest):
         if not result['success']:
             raise HTTPException(status_code=500, detail=result.get('error', 'Upgrade failed'))
         
-        # Update invite status to converted (if invite exists)
+        # Invite status to converted (if invite exists) and referrer
+        # notification, both after the response
         doctor_link = doctor.get('link', '')
         if doctor_link:
-            sheets.update_invite_status(doctor_link, 'converted')
-        
-        # Notify referrer that their invite converted
-        try:
-            # Find who referred this doctor (by invite_slug matching doctor's link)
-            referral_result = sheets.supabase.table('referrals').select('referrer_customer_id').eq('invite_slug', doctor_link).execute()
-            if referral_result.data and len(referral_result.data) > 0:
-                referrer_customer_id = referral_result.data[0].get('referrer_customer_id')
-                if referrer_customer_id:
-                    # Get referrer's language
-                    referrer = sheets.get_doctor_by_customer_id(referrer_customer_id)
-                    referrer_lang = referrer.get('language', 'en') if referrer else 'en'
-                    # Get converted doctor's name
-                    converted_name = doctor.get('name', 'A colleague')
-                    # Send notification
-                    text = get_notif_text('referral_converted', referrer_lang).replace('{name}', converted_name)
-                    sheets.create_message(referrer_customer_id, text, 'referral_converted')
-        except Exception as notif_error:
-            print(f"Could not send referral conversion notification: {notif_error}")
+            pipeline = postcommit.PostCommit(sheets, background_tasks)
+            pipeline.add(set_invite_status, doctor_link, 'converted')
+            
+            batch = notifications.NotificationBatch(sheets)
+            batch.add_deferred(referral_converted_messages, doctor_link, doctor.get('name') or 'A colleague')
+            batch.schedule(pipeline)
         
         return {
             "success": True,
@@ -1683,6 +2280,173 @@ async def save_newgrad(request: NewGradRequest):
             detail=f"Internal server error: {str(e)}"
         )
 
+# ==================== MESSAGES ====================
+
+class MarkReadRequest(BaseModel):
+    customer_id: str
+
+class BroadcastRequest(BaseModel):
+    text: str
+    type: Optional[str] = "manual"
+
+@app.get("/api/messages/unread-count")
+async def unread_message_count(customer_id: str):
+    """Number of unread panel messages (own + broadcasts) — one aggregate query"""
+    try:
+        sheets = SheetsClient()
+        return {"success": True, "unread": sheets.get_unread_message_count(customer_id)}
+    
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+
+@app.post("/api/messages/mark-read")
+async def mark_messages_read(request: MarkReadRequest):
+    """Mark every message up to now as read (moves the read cursor)"""
+    try:
+        sheets = SheetsClient()
+        result = sheets.mark_messages_read(request.customer_id)
+        
+        if not result['success']:
+            raise HTTPException(status_code=500, detail=result.get('error', 'Failed to mark messages read'))
+        
+        return {"success": True}
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+
+def verify_admin_request(request: Request):
+    """Admin endpoints require 'Authorization: Bearer <ADMIN_TOKEN>'"""
+    token = os.environ.get('ADMIN_TOKEN')
+    if not token or not secrets.compare_digest(request.headers.get('authorization', ''), f"Bearer {token}"):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+@app.post("/api/messages/broadcast", include_in_schema=False)
+async def broadcast_message(request: Request, body: BroadcastRequest):
+    """Send a message to every doctor (stored once). Requires ADMIN_TOKEN."""
+    verify_admin_request(request)
+    
+    sheets = SheetsClient()
+    result = notifications.broadcast(sheets, body.text, body.type or 'manual')
+    
+    if not result['success']:
+        raise HTTPException(status_code=500, detail=result.get('error', 'Failed to broadcast'))
+    
+    return {"success": True}
+
+# ==================== CRON JOBS ====================
+
+def verify_cron_request(request: Request):
+    """Vercel Cron sends 'Authorization: Bearer <CRON_SECRET>'"""
+    cron_secret = os.environ.get('CRON_SECRET')
+    if not cron_secret:
+        raise HTTPException(status_code=500, detail="Cron secret not configured")
+    
+    auth = request.headers.get('authorization', '')
+    if not secrets.compare_digest(auth, f"Bearer {cron_secret}"):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+@app.get("/api/cron/reconcile-subscriptions")
+async def cron_reconcile_subscriptions(request: Request):
+    """
+    Periodic reconciliation of the subscription projection with Stripe.
+    Repairs state from webhook events that were missed or failed.
+    """
+    verify_cron_request(request)
+    
+    try:
+        sheets = SheetsClient()
+        result = subscription_state.reconcile_subscriptions(sheets)
+        
+        return {"success": True, **result}
+    
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Reconciliation failed: {str(e)}"
+        )
+
+@app.get("/api/cron/stripe-events")
+async def cron_stripe_events(request: Request):
+    """
+    Drain the Stripe event queue: events whose in-request processing
+    was cut short, and retries whose backoff has elapsed.
+    """
+    verify_cron_request(request)
+    
+    try:
+        sheets = SheetsClient()
+        result = stripe_events.process_pending(sheets, limit=500)
+        
+        return {"success": True, **result}
+    
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Event processing failed: {str(e)}"
+        )
+
+@app.get("/api/cron/expire-trials")
+async def cron_expire_trials(request: Request):
+    """Flag trial doctors whose expires_at has passed"""
+    verify_cron_request(request)
+    
+    sheets = SheetsClient()
+    result = sheets.flag_expired_trials()
+    
+    if not result['success']:
+        raise HTTPException(status_code=500, detail=result.get('error', 'Failed to flag expired trials'))
+    
+    return {"success": True, "flagged": result['flagged']}
+
+@app.get("/api/cron/post-commit")
+async def cron_post_commit(request: Request):
+    """
+    Run post-commit outbox tasks that failed or never ran in-request
+    (only used with POST_COMMIT_OUTBOX=1)
+    """
+    verify_cron_request(request)
+    
+    try:
+        sheets = SheetsClient()
+        result = postcommit.process_outbox(sheets, limit=200)
+        
+        return {"success": True, **result}
+    
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Post-commit processing failed: {str(e)}"
+        )
+
+@app.get("/api/cron/sweep-slot-holds")
+async def cron_sweep_slot_holds(request: Request):
+    """Delete expired slot holds (expired holds are already ignored)"""
+    verify_cron_request(request)
+    
+    sheets = SheetsClient()
+    result = sheets.sweep_slot_holds()
+    
+    if not result['success']:
+        raise HTTPException(status_code=500, detail=result.get('error', 'Failed to sweep slot holds'))
+    
+    return {"success": True, "deleted": result['deleted']}
+
+@app.get("/api/cron/prune-calendar-tombstones")
+async def cron_prune_calendar_tombstones(request: Request):
+    """Delete appointment tombstones older than the sync-token lifetime"""
+    verify_cron_request(request)
+    
+    sheets = SheetsClient()
+    before = (datetime.now(timezone.utc) - timedelta(days=SYNC_TOKEN_MAX_AGE_DAYS)).isoformat()
+    result = sheets.prune_appointment_tombstones(before)
+    
+    if not result['success']:
+        raise HTTPException(status_code=500, detail=result.get('error', 'Failed to prune tombstones'))
+    
+    return {"success": True, "deleted": result['deleted']}
+
 # ==================== EXCEPTION HANDLERS ====================
 
 @app.exception_handler(HTTPException)
@@ -1757,7 +2521,7 @@ def send_notification_email(subject: str, body: str, to_email: str = None):
         msg['Subject'] = subject
         msg.attach(MIMEText(body, 'plain', 'utf-8'))
 
-        with smtplib.SMTP(smtp_host, smtp_port) as server:
+        with track('smtp', '', 'send'), smtplib.SMTP(smtp_host, smtp_port) as server:
             server.starttls()
             server.login(smtp_user, smtp_pass)
             server.send_message(msg)
@@ -1769,21 +2533,6 @@ def send_notification_email(subject: str, body: str, to_email: str = None):
         return False
 
 
-def generate_activation_code(doctor_name: str) -> str:
-    """Generate a unique activation code like JM3847 (no dash)."""
-    # Extract initials from doctor name (skip Dr./Dra./Dr )
-    clean = re.sub(r'^(Dr\.?a?|Dra?\.?)\s*', '', doctor_name, flags=re.IGNORECASE).strip()
-    words = clean.split()
-    if len(words) >= 2:
-        initials = (words[0][0] + words[-1][0]).upper()
-    elif len(words) == 1 and len(words[0]) >= 2:
-        initials = words[0][:2].upper()
-    else:
-        initials = 'SC'
-    numbers = ''.join(random.choices(string.digits, k=4))
-    return f"{initials}{numbers}"
-
-
 # ==================== TRIAL PYDANTIC MODELS ====================
 
 class TrialVisitRequest(BaseModel):
@@ -1804,7 +2553,7 @@ class TrialCheckRequest(BaseModel):
 # ==================== TRIAL ENDPOINTS ====================
 
 @app.post("/api/trial/visit")
-async def trial_visit(request: TrialVisitRequest):
+async def trial_visit(request: TrialVisitRequest, background_tasks: BackgroundTasks):
     """
     Record that a doctor opened their trial page.
     Sends real-time email notification to Renato.
@@ -1813,30 +2562,20 @@ async def trial_visit(request: TrialVisitRequest):
     try:
         sheets = SheetsClient()
 
-        # Find the trial by slug
-        result = sheets.supabase.table('trials').select('*').eq('slug', request.slug).execute()
+        trial, first_visit = trials.record_visit(sheets, request.slug)
 
-        if not result.data or len(result.data) == 0:
-            raise HTTPException(status_code=404, detail="Trial not found")
-
-        trial = result.data[0]
-
-        # Only record first visit
-        if not trial.get('visited_at'):
-            now = datetime.utcnow().isoformat()
-            sheets.supabase.table('trials').update({
-                'visited_at': now,
-                'status': 'visited'
-            }).eq('slug', request.slug).execute()
-
-            # Send real-time notification to Renato
-            send_notification_email(
-                subject=f"👁️ {trial['doctor_name']} opened their page",
-                body=f"Doctor: {trial['doctor_name']}\nSlug: {request.slug}\nOpened at: {now}\n\nThey haven't requested a code yet. If no code request comes in 3 days, consider a follow-up."
+        if first_visit:
+            # Real-time notification to Renato (sent after the response)
+            postcommit.PostCommit(sheets, background_tasks).add(
+                send_email,
+                f"👁️ {trial['doctor_name']} opened their page",
+                f"Doctor: {trial['doctor_name']}\nSlug: {request.slug}\nOpened at: {trial['visited_at']}\n\nThey haven't requested a code yet. If no code request comes in 3 days, consider a follow-up."
             )
 
         return {"success": True, "status": "visited"}
 
+    except trials.TrialTransitionError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
     except HTTPException:
         raise
     except Exception as e:
@@ -1844,7 +2583,7 @@ async def trial_visit(request: TrialVisitRequest):
 
 
 @app.post("/api/trial/request-code")
-async def trial_request_code(request: TrialRequestCodeRequest):
+async def trial_request_code(request: TrialRequestCodeRequest, background_tasks: BackgroundTasks):
     """
     Doctor submits their email to receive activation code.
     Backend generates unique code, saves to Supabase, notifies Renato.
@@ -1853,52 +2592,27 @@ async def trial_request_code(request: TrialRequestCodeRequest):
     try:
         sheets = SheetsClient()
 
-        # Find the trial by slug
-        result = sheets.supabase.table('trials').select('*').eq('slug', request.slug).execute()
-
-        if not result.data or len(result.data) == 0:
-            raise HTTPException(status_code=404, detail="Trial not found")
-
-        trial = result.data[0]
+        # Single conditional update; the code is generated in the database
+        trial, issued = trials.request_code(sheets, request.slug, request.doctor_email)
 
         # Check if code was already requested
-        if trial.get('activation_code'):
+        if not issued:
             return {
                 "success": True,
                 "message": "Code already requested. Check your email.",
                 "already_requested": True
             }
 
-        # Generate unique activation code
-        code = generate_activation_code(trial['doctor_name'])
-
-        # Ensure code is unique
-        code_check = sheets.supabase.table('trials').select('slug').eq('activation_code', code).execute()
-        attempts = 0
-        while code_check.data and len(code_check.data) > 0 and attempts < 10:
-            code = generate_activation_code(trial['doctor_name'])
-            code_check = sheets.supabase.table('trials').select('slug').eq('activation_code', code).execute()
-            attempts += 1
-
-        now = datetime.utcnow().isoformat()
-
-        # Save code and email to Supabase
-        sheets.supabase.table('trials').update({
-            'doctor_email': request.doctor_email,
-            'activation_code': code,
-            'code_requested_at': now,
-            'status': 'pending'
-        }).eq('slug', request.slug).execute()
-
-        # Send notification to Renato with everything he needs
-        send_notification_email(
-            subject=f"🔑 {trial['doctor_name']} wants to activate!",
-            body=(
+        # Notification to Renato with everything he needs (sent after the response)
+        postcommit.PostCommit(sheets, background_tasks).add(
+            send_email,
+            f"🔑 {trial['doctor_name']} wants to activate!",
+            (
                 f"Doctor: {trial['doctor_name']}\n"
                 f"Slug: {request.slug}\n"
                 f"Email: {request.doctor_email}\n"
-                f"Activation code: {code}\n"
-                f"Requested at: {now}\n\n"
+                f"Activation code: {trial['activation_code']}\n"
+                f"Requested at: {trial['code_requested_at']}\n\n"
                 f"→ Copy the code above and reply to {request.doctor_email}"
             )
         )
@@ -1908,6 +2622,8 @@ async def trial_request_code(request: TrialRequestCodeRequest):
             "message": "Code request received. You will receive your activation code shortly."
         }
 
+    except trials.TrialTransitionError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
     except HTTPException:
         raise
     except Exception as e:
@@ -1915,7 +2631,7 @@ async def trial_request_code(request: TrialRequestCodeRequest):
 
 
 @app.post("/api/trial/activate")
-async def trial_activate(request: TrialActivateRequest):
+async def trial_activate(request: TrialActivateRequest, background_tasks: BackgroundTasks):
     """
     Doctor enters the activation code.
     Validates code, activates trial (7 days start now).
@@ -1923,41 +2639,21 @@ async def trial_activate(request: TrialActivateRequest):
     try:
         sheets = SheetsClient()
 
-        # Find the trial by slug
-        result = sheets.supabase.table('trials').select('*').eq('slug', request.slug).execute()
-
-        if not result.data or len(result.data) == 0:
-            raise HTTPException(status_code=404, detail="Trial not found")
-
-        trial = result.data[0]
+        # Single conditional update: matches the code and the allowed states
+        trial, activated = trials.activate(sheets, request.slug, request.code)
 
         # Check if already active
-        if trial.get('status') == 'active':
+        if not activated:
             return {"success": True, "message": "Trial already active", "already_active": True}
 
-        # Check if expired
-        if trial.get('status') == 'expired':
-            raise HTTPException(status_code=403, detail="Trial has expired")
-
-        # Validate code
-        if not trial.get('activation_code'):
-            raise HTTPException(status_code=400, detail="No activation code has been generated yet. Please request one first.")
-
-        if request.code.strip().upper().replace('-', '') != trial['activation_code'].strip().upper().replace('-', ''):
-            raise HTTPException(status_code=401, detail="Invalid activation code")
-
-        now = datetime.utcnow().isoformat()
+        now = trial['activated_at']
 
-        # Activate trial
-        sheets.supabase.table('trials').update({
-            'activated_at': now,
-            'status': 'active'
-        }).eq('slug', request.slug).execute()
-
-        # Notify Renato
-        send_notification_email(
-            subject=f"✅ {trial['doctor_name']} activated their trial!",
-            body=(
+        # Notify Renato and send the panel link (after the response)
+        pipeline = postcommit.PostCommit(sheets, background_tasks)
+        pipeline.add(
+            send_email,
+            f"✅ {trial['doctor_name']} activated their trial!",
+            (
                 f"Doctor: {trial['doctor_name']}\n"
                 f"Slug: {request.slug}\n"
                 f"Email: {trial.get('doctor_email', 'N/A')}\n"
@@ -1971,9 +2667,10 @@ async def trial_activate(request: TrialActivateRequest):
         doctor_email = trial.get('doctor_email')
         if doctor_email:
             panel_link = f"https://slotlycare.com/painel?trial={request.slug}"
-            send_notification_email(
-                subject=f"🔐 Your SlotlyCare panel is ready",
-                body=(
+            pipeline.add(
+                send_email,
+                f"🔐 Your SlotlyCare panel is ready",
+                (
                     f"Welcome, {trial['doctor_name']}!\n\n"
                     f"Your panel is unlocked and ready to use. "
                     f"Bookmark this link — it's your access to everything:\n\n"
@@ -1983,7 +2680,7 @@ async def trial_activate(request: TrialActivateRequest):
                     f"If you need anything, reply to this email.\n\n"
                     f"— The SlotlyCare Team"
                 ),
-                to_email=doctor_email
+                doctor_email
             )
 
         return {
@@ -1992,6 +2689,8 @@ async def trial_activate(request: TrialActivateRequest):
             "activated_at": now
         }
 
+    except trials.TrialTransitionError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
     except HTTPException:
         raise
     except Exception as e:
@@ -2003,35 +2702,15 @@ async def trial_check(request: TrialCheckRequest):
     """
     Check trial status and remaining days.
     Used by the frontend to determine what to show.
+    Served from the cached trial projection.
     """
     try:
         sheets = SheetsClient()
 
-        result = sheets.supabase.table('trials').select('*').eq('slug', request.slug).execute()
-
-        if not result.data or len(result.data) == 0:
-            raise HTTPException(status_code=404, detail="Trial not found")
-
-        trial = result.data[0]
-
-        response = {
-            "success": True,
-            "slug": trial['slug'],
-            "doctor_name": trial['doctor_name'],
-            "status": trial['status'],
-            "has_code": bool(trial.get('activation_code')),
-            "days_remaining": None
-        }
-
-        # Calculate remaining days if active
-        if trial.get('activated_at') and trial['status'] == 'active':
-            activated = datetime.fromisoformat(trial['activated_at'].replace('Z', '+00:00'))
-            expires = activated + timedelta(days=7)
-            remaining = (expires - datetime.now(activated.tzinfo)).days
-            response['days_remaining'] = max(0, remaining)
-
-        return response
+        return {"success": True, **trials.check(sheets, request.slug)}
 
+    except trials.TrialTransitionError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
     except HTTPException:
         raise
     except Exception as e:
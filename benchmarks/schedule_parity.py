@@ -0,0 +1,343 @@
+"""
+Schedule parity corpus: the shared engine (schedule_engine) on a corpus of
+structures, against
+
+- generate_slots() of api/index.py as it was before the engine (what every
+  FastAPI user got): the output must be identical, or the script fails
+- the retired legacy generator of api/schedule.py, for information only
+
+The legacy generator only skipped slots *starting* inside a break, so a
+slot could run into a break (e.g. 11:30-12:15 with a 12:00 lunch) or past
+the end of the day, and it ignored overrides and blocked dates. The engine
+never lets a slot overlap a break, like generate_slots. This script lists
+where the engine and the legacy generator differ and checks the engine's
+invariants on every case.
+
+Run from the repository root:
+    python benchmarks/schedule_parity.py
+"""
+
+import os
+import sys
+import timeit
+from datetime import date, datetime, time, timedelta
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from schedule_engine import DAY_INDEX, HORIZON_DAYS, compile_schedule
+
+LEGACY_DAYS = 90
+REPEAT = 5
+
+WEEKDAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday"]
+
+CORPUS = {
+    "weekdays 9-17, 30 min": {
+        "days": WEEKDAYS, "start_time": "09:00", "end_time": "17:00",
+        "slot_duration_minutes": 30, "breaks": []
+    },
+    "weekdays 8-18, lunch 12-13": {
+        "days": WEEKDAYS, "start_time": "08:00", "end_time": "18:00",
+        "slot_duration_minutes": 30, "breaks": [{"start": "12:00", "end": "13:00"}]
+    },
+    "45 min slots, lunch 12-13 (misaligned)": {
+        "days": ["Tuesday", "Wednesday", "Thursday", "Friday", "Saturday"], "start_time": "10:00",
+        "end_time": "19:00", "slot_duration_minutes": 45, "breaks": [{"start": "12:00", "end": "13:00"}]
+    },
+    "20 min slots, two breaks": {
+        "days": WEEKDAYS, "start_time": "07:30", "end_time": "16:30", "slot_duration_minutes": 20,
+        "breaks": [{"start": "10:00", "end": "10:15"}, {"start": "12:30", "end": "13:30"}]
+    },
+    "end not a multiple of duration": {
+        "days": ["Monday", "Wednesday"], "start_time": "09:00", "end_time": "12:50",
+        "slot_duration_minutes": 40, "breaks": []
+    },
+    "nested, Saturday override": {"schedule": {
+        "default": {"days": WEEKDAYS, "start_time": "09:00", "end_time": "17:00",
+                    "slot_duration_minutes": 20, "breaks": []},
+        "overrides": [{"day": "Saturday", "start_time": "08:00", "end_time": "12:00",
+                       "slot_duration_minutes": 20, "breaks": []}],
+        "blocked_dates": [], "blocked_date_ranges": []
+    }},
+    "nested, vacation": {"schedule": {
+        "default": {"days": WEEKDAYS, "start_time": "09:00", "end_time": "18:00",
+                    "slot_duration_minutes": 30, "breaks": []},
+        "overrides": [], "blocked_dates": [],
+        "blocked_date_ranges": [{"start": (date.today() + timedelta(days=10)).isoformat(),
+                                 "end": (date.today() + timedelta(days=24)).isoformat()}]
+    }},
+    "nested, blocked dates as strings and dicts, override with break": {"schedule": {
+        "default": {"days": WEEKDAYS, "start_time": "08:30", "end_time": "17:30",
+                    "slot_duration_minutes": 25, "breaks": [{"start": "12:00", "end": "13:15"}]},
+        "overrides": [{"day": "Friday", "start_time": "07:00", "end_time": "13:00",
+                       "breaks": [{"start": "10:00", "end": "10:30"}]}],
+        "blocked_dates": [(date.today() + timedelta(days=3)).isoformat(),
+                          {"date": (date.today() + timedelta(days=5)).isoformat()},
+                          {"start": (date.today() + timedelta(days=40)).isoformat(),
+                           "end": (date.today() + timedelta(days=44)).isoformat()}],
+        "blocked_date_ranges": []
+    }},
+    "invalid slot duration": {
+        "days": ["Monday", "Thursday"], "start_time": "09:00", "end_time": "13:00",
+        "slot_duration_minutes": 2, "breaks": []
+    },
+}
+
+
+def _minutes(value):
+    hours, minutes = map(int, value.split(":"))
+    return hours * 60 + minutes
+
+
+def legacy_slots(schedule_data, days=LEGACY_DAYS):
+    """The generator api/schedule.py used (flat structures only)."""
+    schedule_data = schedule_data.get("schedule", schedule_data)
+    schedule_data = schedule_data.get("default", schedule_data)
+    weekdays = {DAY_INDEX[d] for d in schedule_data.get("days", []) if d in DAY_INDEX}
+    start = _minutes(schedule_data.get("start_time", "09:00"))
+    end = _minutes(schedule_data.get("end_time", "17:00"))
+    duration = schedule_data.get("slot_duration_minutes", 30)
+    breaks = [(_minutes(b["start"]), _minutes(b["end"])) for b in schedule_data.get("breaks", [])]
+
+    slots = []
+    today = date.today()
+    for offset in range(days):
+        current = today + timedelta(days=offset)
+        if current.weekday() not in weekdays:
+            continue
+        minute = start
+        while minute < end:
+            in_break = next((b for b in breaks if b[0] <= minute < b[1]), None)
+            if in_break:
+                minute = in_break[1]
+                continue
+            slots.append({"date": current.isoformat(), "time": f"{minute // 60:02d}:{minute % 60:02d}", "status": "available"})
+            minute += duration
+    return slots
+
+
+def baseline_slots(structure):
+    """
+    generate_slots() of api/index.py before the shared engine, verbatim but
+    for returning dicts instead of Slot models.
+    """
+    slots = []
+    today = datetime.now().date()
+    end_date = today + timedelta(days=180)
+    current_date = today
+
+    schedule_data = structure.get("schedule", structure)
+    default_config = schedule_data.get("default", schedule_data)
+    overrides = schedule_data.get("overrides", [])
+    blocked_ranges = schedule_data.get("blocked_date_ranges", [])
+
+    blocked_dates = set()
+    raw_blocked = schedule_data.get("blocked_dates", [])
+    for item in raw_blocked:
+        if isinstance(item, str):
+            blocked_dates.add(item)
+        elif isinstance(item, dict):
+            if "date" in item:
+                blocked_dates.add(item["date"])
+            elif "start" in item and "end" in item:
+                try:
+                    start = datetime.strptime(item["start"], "%Y-%m-%d").date()
+                    end = datetime.strptime(item["end"], "%Y-%m-%d").date()
+                    current = start
+                    while current <= end:
+                        blocked_dates.add(current.strftime("%Y-%m-%d"))
+                        current += timedelta(days=1)
+                except Exception:
+                    pass
+
+    for range_info in blocked_ranges:
+        try:
+            start = datetime.strptime(range_info["start"], "%Y-%m-%d").date()
+            end = datetime.strptime(range_info["end"], "%Y-%m-%d").date()
+            current = start
+            while current <= end:
+                blocked_dates.add(current.strftime("%Y-%m-%d"))
+                current += timedelta(days=1)
+        except Exception:
+            pass
+
+    day_mapping = {
+        "Monday": 0, "Tuesday": 1, "Wednesday": 2, "Thursday": 3,
+        "Friday": 4, "Saturday": 5, "Sunday": 6
+    }
+
+    default_days = []
+    for d in default_config.get("days", []):
+        if d in day_mapping:
+            default_days.append(day_mapping[d])
+
+    try:
+        default_start = time.fromisoformat(default_config.get("start_time", "09:00"))
+    except Exception:
+        default_start = time.fromisoformat("09:00")
+
+    try:
+        default_end = time.fromisoformat(default_config.get("end_time", "17:00"))
+    except Exception:
+        default_end = time.fromisoformat("17:00")
+
+    default_duration = default_config.get("slot_duration_minutes", 30)
+    if not isinstance(default_duration, int) or default_duration < 5:
+        default_duration = 30
+
+    default_breaks = default_config.get("breaks", [])
+    if not isinstance(default_breaks, list):
+        default_breaks = []
+
+    day_overrides = {}
+    for override in overrides:
+        day_name = override.get("day")
+        if day_name in day_mapping:
+            day_overrides[day_name] = override
+
+    while current_date <= end_date:
+        date_str = current_date.strftime("%Y-%m-%d")
+
+        if date_str in blocked_dates:
+            current_date += timedelta(days=1)
+            continue
+
+        weekday = current_date.weekday()
+        day_name = [k for k, v in day_mapping.items() if v == weekday][0]
+
+        if day_name in day_overrides:
+            override = day_overrides[day_name]
+            start_time = time.fromisoformat(override.get("start_time", "09:00"))
+            end_time = time.fromisoformat(override.get("end_time", "17:00"))
+            duration = override.get("slot_duration_minutes", default_duration)
+            breaks = override.get("breaks", [])
+        elif weekday in default_days:
+            start_time = default_start
+            end_time = default_end
+            duration = default_duration
+            breaks = default_breaks
+        else:
+            current_date += timedelta(days=1)
+            continue
+
+        break_intervals = []
+        for b in breaks:
+            break_intervals.append((
+                time.fromisoformat(b["start"]),
+                time.fromisoformat(b["end"])
+            ))
+
+        current_slot_time = datetime.combine(current_date, start_time)
+        end_of_day = datetime.combine(current_date, end_time)
+        slot_delta = timedelta(minutes=duration)
+
+        while current_slot_time < end_of_day:
+            slot_end = current_slot_time + slot_delta
+            if slot_end > end_of_day:
+                break
+
+            in_break = False
+            break_end_time = None
+            for break_start, break_end in break_intervals:
+                if not (current_slot_time.time() >= break_end or slot_end.time() <= break_start):
+                    in_break = True
+                    break_end_time = break_end
+                    break
+
+            if in_break:
+                current_slot_time = datetime.combine(current_date, break_end_time)
+            else:
+                slots.append({
+                    "date": current_slot_time.strftime("%Y-%m-%d"),
+                    "time": current_slot_time.strftime("%H:%M"),
+                    "status": "available"
+                })
+                current_slot_time = slot_end
+
+        current_date += timedelta(days=1)
+
+    return slots
+
+
+def engine_slots(structure, days=LEGACY_DAYS):
+    return list(compile_schedule(structure).iter_slots(days=days - 1))
+
+
+def check_invariants(structure, slots):
+    """Every slot ends by the end of its day and overlaps no break of its weekday."""
+    schedule_data = structure.get("schedule", structure)
+    configs = {}
+    default = schedule_data.get("default", schedule_data)
+    for day in default.get("days", []):
+        configs[DAY_INDEX[day]] = default
+    for override in schedule_data.get("overrides", []):
+        configs[DAY_INDEX[override["day"]]] = override
+
+    problems = []
+    seen = set()
+    for slot in slots:
+        key = (slot["date"], slot["time"])
+        if key in seen:
+            problems.append(f"duplicate {key}")
+        seen.add(key)
+
+        config = configs.get(date.fromisoformat(slot["date"]).weekday())
+        if config is None:
+            problems.append(f"slot on a day off {key}")
+            continue
+        start = _minutes(slot["time"])
+        # The default's duration falls back to 30 below 5 minutes;
+        # overrides without a duration use the default's
+        default_duration = default.get("slot_duration_minutes", 30)
+        if not isinstance(default_duration, int) or default_duration < 5:
+            default_duration = 30
+        duration = default_duration if config is default else config.get("slot_duration_minutes", default_duration)
+        end = start + duration
+        if start < _minutes(config["start_time"]) or end > _minutes(config["end_time"]):
+            problems.append(f"outside working hours {key}")
+        for brk in config.get("breaks", []):
+            if start < _minutes(brk["end"]) and end > _minutes(brk["start"]):
+                problems.append(f"overlaps break {key}")
+    return problems
+
+
+def check_baseline(structure):
+    """Differences between the engine and the pre-engine generate_slots (must be none)."""
+    engine = list(compile_schedule(structure).iter_slots(days=HORIZON_DAYS))
+    baseline = baseline_slots(structure)
+    if engine == baseline:
+        return []
+    for index, (ours, theirs) in enumerate(zip(engine, baseline)):
+        if ours != theirs:
+            return [f"slot {index}: engine {ours}, generate_slots {theirs}"]
+    return [f"engine {len(engine)} slots, generate_slots {len(baseline)}"]
+
+
+def run(name, structure):
+    baseline_problems = check_baseline(structure)
+    engine = engine_slots(structure)
+    legacy = legacy_slots(structure)
+    engine_keys = {(s["date"], s["time"]) for s in engine}
+    legacy_keys = {(s["date"], s["time"]) for s in legacy}
+
+    problems = check_invariants(structure, engine)
+    engine_ms = min(timeit.repeat(lambda: engine_slots(structure), number=1, repeat=REPEAT)) * 1000
+
+    status = "same" if engine_keys == legacy_keys else "differs"
+    parity = "identical to generate_slots" if not baseline_problems else "DIFFERS FROM generate_slots"
+    print(f"\n{name}: {parity}; legacy {status}, engine {len(engine)} slots ({engine_ms:.2f} ms), legacy {len(legacy)}")
+    only_legacy = sorted(legacy_keys - engine_keys)
+    only_engine = sorted(engine_keys - legacy_keys)
+    if only_legacy:
+        print(f"  legacy only ({len(only_legacy)}), e.g. {only_legacy[0]}")
+    if only_engine:
+        print(f"  engine only ({len(only_engine)}), e.g. {only_engine[0]}")
+    for problem in baseline_problems:
+        print(f"  PARITY: {problem}")
+    for problem in problems[:5]:
+        print(f"  INVARIANT: {problem}")
+    return not problems and not baseline_problems
+
+
+if __name__ == '__main__':
+    results = [run(name, structure) for name, structure in CORPUS.items()]
+    sys.exit(0 if all(results) else 1)
@@ -0,0 +1,58 @@
+"""
+Schedule extraction prompt benchmark: prompt size, and (with --live and
+OPENAI_API_KEY set) time to first chunk and token usage of real streamed
+calls through llm_gateway, including prompt tokens served from the
+provider's prefix cache.
+
+Run from the repository root:
+    python benchmarks/schedule_prompt.py
+    python benchmarks/schedule_prompt.py --live 5
+"""
+
+import os
+import statistics
+import sys
+import time
+from datetime import date
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import llm_gateway
+import schedule_parser
+
+TEXTS = (
+    "Segunda a sexta 9h-18h, almoço 12h-13h, consultas de 30 minutos",
+    "Monday to Thursday 8am-4pm, Friday 8am-12pm, 20 minute appointments. Off Dec 24 to Jan 2",
+    "Lunes, miércoles y viernes de 10 a 19, consultas de 45 minutos",
+)
+
+
+def prompt_size():
+    tokens = schedule_parser.estimate_tokens(schedule_parser.SYSTEM_PROMPT)
+    exact = "tiktoken" if schedule_parser._encoding is not None else "estimated, ~4 chars/token"
+    print(f"system prompt: {len(schedule_parser.SYSTEM_PROMPT)} chars, {tokens} tokens ({exact})")
+    print(f"doctor text budget: {schedule_parser.MAX_TEXT_TOKENS} tokens, "
+          f"completion cap: {schedule_parser.MAX_COMPLETION_TOKENS} tokens")
+
+
+def live(rounds):
+    first_chunk = []
+    for _ in range(rounds):
+        for text in TEXTS:
+            start = time.perf_counter()
+            chunks = llm_gateway.stream_chat(schedule_parser.build_messages(text, date.today()), **schedule_parser.COMPLETION_PARAMS)
+            next(chunks)
+            first_chunk.append(time.perf_counter() - start)
+            for _ in chunks:
+                pass
+
+    print(f"\n{len(first_chunk)} streamed calls, time to first chunk: "
+          f"median {statistics.median(first_chunk) * 1000:.0f} ms, max {max(first_chunk) * 1000:.0f} ms")
+    for line in llm_gateway.REGISTRY.render().splitlines():
+        if line.startswith('slotlycare_llm_tokens_total'):
+            print(f"  {line}")
+
+
+if __name__ == '__main__':
+    prompt_size()
+    if '--live' in sys.argv:
+        live(int(sys.argv[sys.argv.index('--live') + 1]))
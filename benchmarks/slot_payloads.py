@@ -0,0 +1,94 @@
+"""
+Slot payload benchmark: per-slot pydantic models + stdlib json vs bulk
+parse_slots + orjson, on 5k and 20k slot schedules.
+
+Run from the repository root:
+    python benchmarks/slot_payloads.py
+"""
+
+import json
+import os
+import sys
+import timeit
+from datetime import date, timedelta
+from typing import List, Optional
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from slot_io import parse_slots, dumps
+
+try:
+    from pydantic import BaseModel
+except ImportError:
+    BaseModel = None
+
+SIZES = (5000, 20000)
+REPEAT = 5
+
+
+def make_slots(count):
+    """count slots, 16 per day (08:00-16:00, 30 min)."""
+    slots = []
+    day = date.today()
+    while len(slots) < count:
+        for i in range(16):
+            slots.append({
+                'date': day.isoformat(),
+                'time': f"{8 + i // 2:02d}:{30 * (i % 2):02d}",
+                'status': 'available'
+            })
+        day += timedelta(days=1)
+    return slots[:count]
+
+
+def best_ms(func):
+    return min(timeit.repeat(func, number=1, repeat=REPEAT)) * 1000
+
+
+def run(count):
+    slots = make_slots(count)
+    body = json.dumps({'slots': slots}).encode()
+    results = {}
+
+    # Ingestion: request body -> list of slot dicts
+    results['ingest: parse_slots'] = best_ms(lambda: parse_slots(json.loads(body)['slots']))
+
+    # Serialisation: slot dicts -> response body
+    payload = {'success': True, 'slots': slots, 'total_slots': count, 'error': None}
+    results['serialise: json.dumps'] = best_ms(lambda: json.dumps(payload).encode())
+    results['serialise: orjson'] = best_ms(lambda: dumps(payload))
+
+    if BaseModel is not None:
+        class SlotModel(BaseModel):
+            date: str
+            time: str
+            status: str = "available"
+
+        class SlotsBody(BaseModel):
+            slots: List[SlotModel]
+
+        class ScheduleResponse(BaseModel):
+            success: bool
+            slots: List[SlotModel]
+            total_slots: int
+            error: Optional[str] = None
+
+        results['ingest: model per slot + .dict()'] = best_ms(
+            lambda: [s.model_dump() for s in SlotsBody.model_validate_json(body).slots]
+        )
+        models = [SlotModel(**s) for s in slots]
+        results['serialise: response_model + json.dumps'] = best_ms(
+            lambda: json.dumps(ScheduleResponse(
+                success=True, slots=models, total_slots=count
+            ).model_dump()).encode()
+        )
+
+    print(f"\n{count} slots ({len(body) / 1024:.0f} KiB body), best of {REPEAT}:")
+    for name, ms in sorted(results.items()):
+        print(f"  {name:<45} {ms:8.2f} ms")
+
+
+if __name__ == '__main__':
+    if BaseModel is None:
+        print("pydantic not installed: model-based variants skipped")
+    for size in SIZES:
+        run(size)
@@ -0,0 +1,47 @@
+"""
+Concurrent backend calls for SlotlyCare handlers
+The data layer (supabase-py) and the Stripe SDK are synchronous, so
+independent calls are run in worker threads and awaited together:
+
+    doctor, customer = await concurrency.gather(
+        concurrency.call(sheets.get_doctor, doctor_id),
+        concurrency.call(stripe.Customer.retrieve, customer_id),
+    )
+
+Structured: every call of a stage has finished (or failed) before the
+stage returns, so nothing keeps running behind the response. Worker
+threads inherit the request context, so track() timings still end up in
+the request's Server-Timing header.
+"""
+
+import asyncio
+
+
+def call(func, *args, **kwargs):
+    """Run a blocking call in a worker thread (returns an awaitable)."""
+    return asyncio.to_thread(func, *args, **kwargs)
+
+
+async def gather(*awaitables):
+    """
+    Await all calls concurrently and return their results in order.
+    If any failed, the first failure is raised once all have finished.
+    """
+    results = await asyncio.gather(*awaitables, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+
+async def best_effort(*awaitables):
+    """
+    Await side effects whose failure must not fail the request.
+    Failures are logged and come back as None.
+    """
+    results = await asyncio.gather(*awaitables, return_exceptions=True)
+    for index, result in enumerate(results):
+        if isinstance(result, BaseException):
+            print(f"Best-effort call {index} failed: {result}")
+            results[index] = None
+    return results
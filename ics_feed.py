@@ -0,0 +1,118 @@
+"""
+ICS calendar feed for SlotlyCare
+Renders a doctor's appointments as an iCalendar (RFC 5545) feed that
+phone and desktop calendars can subscribe to.
+
+Appointments are stored as local date + time without a time zone, so
+events use floating times: they show at the same wall-clock time the
+patient booked, in whatever zone the doctor's calendar is in.
+
+The feed is produced chunk by chunk from an iterator of appointments, so
+a large feed is never built as one string.
+"""
+
+from datetime import datetime, timedelta, timezone
+
+PRODID = "-//SlotlyCare//Appointments//EN"
+UID_DOMAIN = "slotlycare.com"
+DEFAULT_EVENT_MINUTES = 30
+# Hint to clients on how often to poll (not all of them honour it)
+REFRESH_INTERVAL = "PT15M"
+EVENTS_PER_CHUNK = 100
+MAX_LINE_OCTETS = 75
+
+
+def escape_text(value):
+    """TEXT value escaping (backslash, semicolon, comma, newline)."""
+    return (str(value or '').replace('\\', '\\\\').replace(';', '\\;')
+            .replace(',', '\\,').replace('\r\n', '\\n').replace('\n', '\\n'))
+
+
+def fold(line):
+    """Fold a content line at 75 octets, never inside a UTF-8 sequence."""
+    encoded = line.encode('utf-8')
+    if len(encoded) <= MAX_LINE_OCTETS:
+        return line
+
+    parts = []
+    current = ''
+    size = 0
+    limit = MAX_LINE_OCTETS
+    for char in line:
+        char_size = len(char.encode('utf-8'))
+        if size + char_size > limit:
+            parts.append(current)
+            # Continuation lines start with a space, which counts
+            current = ''
+            size = 0
+            limit = MAX_LINE_OCTETS - 1
+        current += char
+        size += char_size
+    parts.append(current)
+    return '\r\n '.join(parts)
+
+
+def utc_stamp(moment):
+    """DATE-TIME in UTC form (e.g. for DTSTAMP)."""
+    return moment.astimezone(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+
+def event_lines(appointment, minutes, stamp):
+    """VEVENT content lines of one appointment."""
+    start = datetime.strptime(f"{appointment['date'][:10]} {appointment['time'][:5]}", '%Y-%m-%d %H:%M')
+    end = start + timedelta(minutes=minutes)
+
+    details = [f"{label}: {appointment[key]}" for label, key in
+               (('Phone', 'patient_phone'), ('Email', 'patient_email'), ('Notes', 'notes'))
+               if appointment.get(key)]
+
+    lines = [
+        'BEGIN:VEVENT',
+        f"UID:{appointment['id']}@{UID_DOMAIN}",
+        f"DTSTAMP:{stamp}",
+        f"DTSTART:{start.strftime('%Y%m%dT%H%M%S')}",
+        f"DTEND:{end.strftime('%Y%m%dT%H%M%S')}",
+        f"SUMMARY:{escape_text(appointment.get('patient_name'))}",
+    ]
+    if details:
+        lines.append(f"DESCRIPTION:{escape_text(chr(10).join(details))}")
+    lines.extend(['STATUS:CONFIRMED', 'END:VEVENT'])
+    return lines
+
+
+def iter_ics(calendar_name, appointments, durations=None, stamp=None):
+    """
+    Yield the feed as bytes chunks (CRLF line endings, folded lines).
+
+    Args:
+        calendar_name (str): Name shown by calendar apps
+        appointments (iterable): Appointments in wire format (see appointment_from_row)
+        durations (tuple): Event length in minutes per weekday (Monday first),
+                           e.g. CompiledSchedule.durations; default 30 for all
+        stamp (str): DTSTAMP of every event (default now)
+    """
+    stamp = stamp or utc_stamp(datetime.now(timezone.utc))
+    durations = durations or (DEFAULT_EVENT_MINUTES,) * 7
+
+    header = [
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        f'PRODID:{PRODID}',
+        'CALSCALE:GREGORIAN',
+        'METHOD:PUBLISH',
+        f'X-WR-CALNAME:{escape_text(calendar_name)}',
+        f'REFRESH-INTERVAL;VALUE=DURATION:{REFRESH_INTERVAL}',
+        f'X-PUBLISHED-TTL:{REFRESH_INTERVAL}',
+    ]
+    buffer = header
+    count = 0
+    for appointment in appointments:
+        weekday = datetime.strptime(appointment['date'][:10], '%Y-%m-%d').weekday()
+        buffer.extend(event_lines(appointment, durations[weekday], stamp))
+        count += 1
+        if count % EVENTS_PER_CHUNK == 0:
+            yield ('\r\n'.join(fold(line) for line in buffer) + '\r\n').encode('utf-8')
+            buffer = []
+
+    buffer.append('END:VCALENDAR')
+    yield ('\r\n'.join(fold(line) for line in buffer) + '\r\n').encode('utf-8')
@@ -0,0 +1,340 @@
+"""
+Request instrumentation for SlotlyCare
+Times every request and every backend call (Supabase, Stripe, OpenAI),
+emits Server-Timing headers and keeps Prometheus-style histograms for /metrics.
+
+Everything is in-process and lock-protected: one perf_counter pair and one
+bisect per observation, so it is cheap enough to leave on in production.
+"""
+
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+# Seconds. Covers fast indexed reads up to slow OpenAI completions.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Query-builder methods that determine the operation label of a Supabase call
+SUPABASE_OPERATIONS = ('select', 'insert', 'update', 'upsert', 'delete')
+
+
+# ==================== METRIC TYPES ====================
+
+def _format_labels(label_names, label_values, extra=None):
+    pairs = list(zip(label_names, label_values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = []
+    for name, value in pairs:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append(f'{name}="{value}"')
+    return '{' + ','.join(escaped) + '}'
+
+
+class Histogram:
+    """Cumulative histogram with a fixed set of label names."""
+
+    def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [per-bucket counts (+Inf last), sum, count]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                self._series[labels] = series
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            items = [(labels, list(s[0]), s[1], s[2]) for labels, s in self._series.items()]
+        for labels, counts, total, count in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{self.name}_bucket{_format_labels(self.label_names, labels, ("le", le))} {cumulative}')
+            label_str = _format_labels(self.label_names, labels)
+            lines.append(f'{self.name}_sum{label_str} {total}')
+            lines.append(f'{self.name}_count{label_str} {count}')
+        return lines
+
+
+class Counter:
+    """Monotonic counter with a fixed set of label names."""
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        with self._lock:
+            items = list(self._values.items())
+        for labels, value in items:
+            lines.append(f'{self.name}{_format_labels(self.label_names, labels)} {value}')
+        return lines
+
+
+class Gauge:
+    """Value that goes up and down (queue depth, backlog)."""
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def set(self, value, labels=()):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, labels=(), amount=1):
+        self.inc(labels, -amount)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} gauge']
+        with self._lock:
+            items = list(self._values.items())
+        for labels, value in items:
+            lines.append(f'{self.name}{_format_labels(self.label_names, labels)} {value}')
+        return lines
+
+
+class MetricsRegistry:
+    """Holds every metric exposed on /metrics."""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+REQUEST_DURATION = REGISTRY.register(Histogram(
+    'slotlycare_request_duration_seconds',
+    'HTTP request duration by route and status.',
+    ('method', 'route', 'status')
+))
+
+BACKEND_CALL_DURATION = REGISTRY.register(Histogram(
+    'slotlycare_backend_call_duration_seconds',
+    'Backend call duration by backend, table and operation.',
+    ('backend', 'table', 'operation', 'outcome')
+))
+
+
+# ==================== PER-REQUEST TIMINGS ====================
+
+class RequestTimings:
+    """Backend time accumulated by the current request, for Server-Timing."""
+
+    __slots__ = ('backends', '_lock')
+
+    def __init__(self):
+        self.backends = {}
+        self._lock = threading.Lock()
+
+    def add(self, backend, seconds):
+        # Calls may be fanned out to worker threads, hence the lock
+        with self._lock:
+            entry = self.backends.get(backend)
+            if entry is None:
+                self.backends[backend] = [1, seconds]
+            else:
+                entry[0] += 1
+                entry[1] += seconds
+
+    def header(self, total_seconds):
+        with self._lock:
+            items = list(self.backends.items())
+        parts = [
+            f'{backend};dur={seconds * 1000:.1f};desc="{count} call{"s" if count != 1 else ""}"'
+            for backend, (count, seconds) in items
+        ]
+        parts.append(f'total;dur={total_seconds * 1000:.1f}')
+        return ', '.join(parts)
+
+
+_current_timings = contextvars.ContextVar('slotlycare_request_timings', default=None)
+
+
+@contextmanager
+def track(backend, table='', operation=''):
+    """
+    Time a backend call and record it in the metrics and the current request.
+
+    Usage:
+        with track('stripe', 'PromotionCode', 'list'):
+            stripe.PromotionCode.list(...)
+    """
+    outcome = 'ok'
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        outcome = 'error'
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        BACKEND_CALL_DURATION.observe((backend, table, operation, outcome), elapsed)
+        timings = _current_timings.get()
+        if timings is not None:
+            timings.add(backend, elapsed)
+
+
+def timed(backend, table='', operation=''):
+    """Decorator form of track()."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with track(backend, table, operation or func.__name__):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# ==================== SUPABASE INSTRUMENTATION ====================
+
+class InstrumentedQuery:
+    """
+    Wraps a postgrest request builder so that execute() is timed and
+    labelled with the table and the operation (select/insert/...).
+    """
+
+    __slots__ = ('_builder', '_table', '_operation')
+
+    def __init__(self, builder, table, operation=None):
+        self._builder = builder
+        self._table = table
+        self._operation = operation
+
+    def __getattr__(self, name):
+        attr = getattr(self._builder, name)
+        operation = self._operation
+        if operation is None and name in SUPABASE_OPERATIONS:
+            operation = name
+
+        if not callable(attr):
+            # e.g. the `not_` property, which returns the builder itself
+            if hasattr(attr, 'execute'):
+                return InstrumentedQuery(attr, self._table, operation)
+            return attr
+
+        def call(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            if hasattr(result, 'execute'):
+                return InstrumentedQuery(result, self._table, operation)
+            return result
+
+        return call
+
+    def execute(self):
+        with track('supabase', self._table, self._operation or 'select'):
+            return self._builder.execute()
+
+
+class InstrumentedSupabase:
+    """Drop-in wrapper around a supabase Client that times every query."""
+
+    __slots__ = ('_client',)
+
+    def __init__(self, client):
+        self._client = client
+
+    def table(self, name):
+        return InstrumentedQuery(self._client.table(name), name)
+
+    def rpc(self, fn, params=None, *args, **kwargs):
+        return InstrumentedQuery(self._client.rpc(fn, params or {}, *args, **kwargs), fn, 'rpc')
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+# ==================== ASGI MIDDLEWARE ====================
+
+def _route_label(scope):
+    """Route template (e.g. /api/trial/check) to keep label cardinality bounded."""
+    route = scope.get('route')
+    path = getattr(route, 'path', None)
+    return path or 'unmatched'
+
+
+class TimingMiddleware:
+    """
+    Pure ASGI middleware: times the request, adds a Server-Timing header
+    with the per-backend breakdown and records the request histogram.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        timings = RequestTimings()
+        token = _current_timings.set(timings)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                header = timings.header(time.perf_counter() - start)
+                headers = list(message.get('headers', []))
+                headers.append((b'server-timing', header.encode('latin-1')))
+                message = {**message, 'headers': headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            REQUEST_DURATION.observe(
+                (scope.get('method', ''), _route_label(scope), str(status)),
+                time.perf_counter() - start
+            )
+            _current_timings.reset(token)
@@ -0,0 +1,98 @@
+"""
+Incremental JSON parsing for SlotlyCare
+Used on streamed OpenAI completions: text arrives in small deltas, and
+each object or array is reported as soon as its closing bracket arrives,
+with its path from the root, e.g. ('schedule', 'default') or
+('schedule', 'overrides', 0). The root value has the path ().
+
+Only containers are reported (scalars are part of their parent). The
+bracket scan is one pass over the text, but every completed container is
+decoded with json.loads on its own slice, so a nested value is decoded
+again at each enclosing level: O(N * depth) for N characters. Each feed
+also copies the buffer. Both are cheap at the size of a completion
+(a few hundred tokens, depth 4 or less); this is not a general-purpose
+streaming parser.
+
+Malformed input raises ValueError (json.JSONDecodeError is one).
+"""
+
+import json
+
+
+class IncrementalJSON:
+    """
+    Usage:
+        parser = IncrementalJSON()
+        for delta in deltas:
+            for path, value in parser.feed(delta):
+                ...
+        document = parser.result()
+    """
+
+    def __init__(self):
+        self.buffer = ''
+        self.pos = 0
+        # Open containers: [kind, start, path, key, index]
+        self.stack = []
+        self.in_string = False
+        self.escape = False
+        self.string_start = 0
+        self.done = None
+
+    def feed(self, delta):
+        """Add text; returns the (path, value) of every container it completes."""
+        self.buffer += delta
+        completed = []
+        buffer = self.buffer
+        stack = self.stack
+
+        for i in range(self.pos, len(buffer)):
+            char = buffer[i]
+
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == '\\':
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+                    frame = stack[-1] if stack else None
+                    # In an object, the last string before a nested
+                    # container is always that container's key
+                    if frame is not None and frame[0] == '{':
+                        frame[3] = buffer[self.string_start:i + 1]
+                continue
+
+            if char == '"':
+                self.in_string = True
+                self.string_start = i
+            elif char in '{[':
+                path = ()
+                if stack:
+                    parent = stack[-1]
+                    if parent[0] == '{':
+                        if parent[3] is None:
+                            raise ValueError(f"Object member without a key at {i}")
+                        path = parent[2] + (json.loads(parent[3]),)
+                    else:
+                        path = parent[2] + (parent[4],)
+                stack.append([char, i, path, None, 0])
+            elif char in '}]':
+                if not stack:
+                    raise ValueError(f"Unbalanced {char!r} at {i}")
+                kind, start, path, _, _ = stack.pop()
+                value = json.loads(buffer[start:i + 1])
+                completed.append((path, value))
+                if not stack:
+                    self.done = value
+            elif char == ',' and stack and stack[-1][0] == '[':
+                stack[-1][4] += 1
+
+        self.pos = len(buffer)
+        return completed
+
+    def result(self):
+        """The root value, once complete (otherwise ValueError)."""
+        if self.done is None:
+            raise ValueError("Incomplete JSON document")
+        return self.done
@@ -0,0 +1,343 @@
+"""
+OpenAI gateway for SlotlyCare
+Every chat completion goes through chat(), which bounds how long a slow or
+degraded upstream can hold a worker:
+
+- a deadline for the whole call (all attempts and models), and a per-attempt
+  timeout that never outlives it
+- retries of transient failures (timeouts, connection errors, 429, 5xx)
+  with jittered exponential backoff
+- a circuit breaker per model: after FAILURE_THRESHOLD consecutive failures
+  the model is skipped for OPEN_SECONDS, then one trial call decides
+- fallback from the primary model to FALLBACK_MODEL (cheaper and faster)
+
+stream_chat() does the same for streamed completions, up to the first
+chunk. Latency, outcome and token usage are recorded per model for /metrics.
+"""
+
+import itertools
+import os
+import random
+import threading
+import time
+
+import openai
+from openai import OpenAI
+
+from instrumentation import REGISTRY, Counter, Gauge, Histogram, track
+
+PRIMARY_MODEL = os.environ.get('OPENAI_MODEL', 'gpt-4-turbo')
+FALLBACK_MODEL = os.environ.get('OPENAI_FALLBACK_MODEL', 'gpt-4o-mini')
+
+DEADLINE_SECONDS = 25
+ATTEMPT_TIMEOUT_SECONDS = 8
+# Attempts per model (first call included)
+MAX_ATTEMPTS = 2
+BASE_BACKOFF_SECONDS = 0.5
+# Not worth starting an attempt with less time left than this
+MIN_ATTEMPT_SECONDS = 2
+
+FAILURE_THRESHOLD = 5
+OPEN_SECONDS = 30
+
+RETRYABLE_ERRORS = (
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+)
+
+CALLS = REGISTRY.register(Counter(
+    'slotlycare_llm_calls_total',
+    'OpenAI call attempts by model and outcome (ok, retryable, error, skipped).',
+    ('model', 'outcome')
+))
+
+CALL_DURATION = REGISTRY.register(Histogram(
+    'slotlycare_llm_call_duration_seconds',
+    'OpenAI call attempt duration by model and outcome.',
+    ('model', 'outcome')
+))
+
+FIRST_CHUNK = REGISTRY.register(Histogram(
+    'slotlycare_llm_first_chunk_seconds',
+    'Time from request to first streamed chunk by model.',
+    ('model',)
+))
+
+TOKENS = REGISTRY.register(Counter(
+    'slotlycare_llm_tokens_total',
+    'OpenAI tokens used by model and kind (prompt, cached_prompt, completion).',
+    ('model', 'kind')
+))
+
+TOKENS_PER_CALL = REGISTRY.register(Histogram(
+    'slotlycare_llm_call_tokens',
+    'Tokens per OpenAI call by model and kind (prompt, completion).',
+    ('model', 'kind'),
+    buckets=(50, 100, 250, 500, 750, 1000, 1500, 2000, 4000, 8000)
+))
+
+CIRCUIT_OPEN = REGISTRY.register(Gauge(
+    'slotlycare_llm_circuit_open',
+    'Whether the circuit breaker of a model is open (1) or closed (0).',
+    ('model',)
+))
+
+
+class LLMUnavailable(Exception):
+    """No model answered within the deadline (or every circuit is open)."""
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker for one model.
+
+    Closed: calls go through. After `threshold` consecutive failures it
+    opens and allow() is False for `open_seconds`; then a single trial call
+    is let through (half-open) and its outcome closes or re-opens it.
+    """
+
+    def __init__(self, model, threshold=FAILURE_THRESHOLD, open_seconds=OPEN_SECONDS):
+        self.model = model
+        self.threshold = threshold
+        self.open_seconds = open_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self.trial_running or time.monotonic() - self.opened_at < self.open_seconds:
+                return False
+            self.trial_running = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+        CIRCUIT_OPEN.set(0, (self.model,))
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+            self.trial_running = False
+            is_open = self.opened_at is not None
+        if is_open:
+            CIRCUIT_OPEN.set(1, (self.model,))
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+_client = None
+
+
+def get_client():
+    """The process-wide OpenAI client. Retries are done here, not by the SDK."""
+    global _client
+    if _client is None:
+        _client = OpenAI(max_retries=0)
+    return _client
+
+
+def breaker(model):
+    with _breakers_lock:
+        if model not in _breakers:
+            _breakers[model] = CircuitBreaker(model)
+        return _breakers[model]
+
+
+def _backoff_seconds(attempt):
+    """Delay after attempt number `attempt` (1-based), with +/-50% jitter."""
+    return BASE_BACKOFF_SECONDS * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+
+
+def _record_usage(model, response):
+    usage = getattr(response, 'usage', None)
+    if usage is None:
+        return
+    prompt_tokens = usage.prompt_tokens or 0
+    completion_tokens = usage.completion_tokens or 0
+    # Prompt tokens served from the provider's prefix cache (billed at a discount)
+    details = getattr(usage, 'prompt_tokens_details', None)
+    cached_tokens = (getattr(details, 'cached_tokens', 0) or 0) if details is not None else 0
+
+    TOKENS.inc((model, 'prompt'), prompt_tokens)
+    TOKENS.inc((model, 'cached_prompt'), cached_tokens)
+    TOKENS.inc((model, 'completion'), completion_tokens)
+    TOKENS_PER_CALL.observe((model, 'prompt'), prompt_tokens)
+    TOKENS_PER_CALL.observe((model, 'completion'), completion_tokens)
+
+
+def _attempt(model, messages, timeout, params):
+    outcome = 'ok'
+    start = time.perf_counter()
+    try:
+        with track('openai', 'chat.completions', model):
+            response = get_client().chat.completions.create(
+                model=model,
+                messages=messages,
+                timeout=timeout,
+                **params
+            )
+    except RETRYABLE_ERRORS:
+        outcome = 'retryable'
+        raise
+    except Exception:
+        outcome = 'error'
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        CALLS.inc((model, outcome))
+        CALL_DURATION.observe((model, outcome), elapsed)
+
+    _record_usage(model, response)
+    return response
+
+
+def _call_with_fallback(call, models, deadline):
+    """
+    call(model, timeout) with retries per model, then the next model.
+
+    Returns:
+        tuple: (model, result) of the first successful call
+    """
+    last_error = None
+
+    for model in models or (PRIMARY_MODEL, FALLBACK_MODEL):
+        if deadline - time.monotonic() < MIN_ATTEMPT_SECONDS:
+            break
+
+        model_breaker = breaker(model)
+        if not model_breaker.allow():
+            CALLS.inc((model, 'skipped'))
+            continue
+
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            timeout = min(ATTEMPT_TIMEOUT_SECONDS, max(deadline - time.monotonic(), MIN_ATTEMPT_SECONDS))
+            try:
+                result = call(model, timeout)
+            except RETRYABLE_ERRORS as e:
+                last_error = e
+                print(f"OpenAI {model} attempt {attempt} failed: {e.__class__.__name__}: {e}")
+                delay = _backoff_seconds(attempt)
+                if attempt == MAX_ATTEMPTS or deadline - time.monotonic() - delay < MIN_ATTEMPT_SECONDS:
+                    break
+                time.sleep(delay)
+                continue
+            except Exception:
+                # Non-retryable (the request itself is wrong): the model is healthy
+                model_breaker.record_success()
+                raise
+
+            model_breaker.record_success()
+            return model, result
+
+        # Retries exhausted or out of time: try the next model
+        model_breaker.record_failure()
+
+    raise LLMUnavailable(f"No OpenAI model answered in time: {last_error or 'all circuits open'}")
+
+
+def chat(messages, models=None, deadline_seconds=DEADLINE_SECONDS, **params):
+    """
+    Chat completion with deadline, retries, circuit breaking and fallback.
+
+    Args:
+        messages (list): Chat messages
+        models (tuple): Models to try in order (default primary, fallback)
+        deadline_seconds (float): Budget for the whole call
+        **params: Passed to chat.completions.create (temperature, response_format...)
+
+    Returns:
+        ChatCompletion: The first successful response (response.model says which model)
+
+    Raises:
+        LLMUnavailable: Every model failed transiently, was skipped, or the deadline passed
+        openai.APIError: Non-retryable errors (bad request, authentication) are raised as-is
+    """
+    deadline = time.monotonic() + deadline_seconds
+    _, response = _call_with_fallback(
+        lambda model, timeout: _attempt(model, messages, timeout, params),
+        models,
+        deadline
+    )
+    return response
+
+
+# ==================== STREAMING ====================
+
+def _open_stream(model, messages, timeout, params):
+    """Start a streamed completion and wait for its first chunk."""
+    start = time.perf_counter()
+    try:
+        with track('openai', 'chat.completions.stream', model):
+            stream = get_client().chat.completions.create(
+                model=model,
+                messages=messages,
+                timeout=timeout,
+                stream=True,
+                stream_options={"include_usage": True},
+                **params
+            )
+            chunks = iter(stream)
+            first = next(chunks, None)
+    except RETRYABLE_ERRORS:
+        CALLS.inc((model, 'retryable'))
+        CALL_DURATION.observe((model, 'retryable'), time.perf_counter() - start)
+        raise
+    except Exception:
+        CALLS.inc((model, 'error'))
+        CALL_DURATION.observe((model, 'error'), time.perf_counter() - start)
+        raise
+
+    FIRST_CHUNK.observe((model,), time.perf_counter() - start)
+    return stream, chunks, first, start
+
+
+def _relay(model, stream, chunks, first, start, deadline):
+    outcome = 'error'
+    try:
+        for chunk in itertools.chain([first] if first is not None else [], chunks):
+            if chunk.usage is not None:
+                _record_usage(model, chunk)
+            if chunk.choices:
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    yield delta
+            if time.monotonic() > deadline:
+                raise LLMUnavailable("OpenAI deadline exceeded while streaming")
+        outcome = 'ok'
+    except RETRYABLE_ERRORS as e:
+        breaker(model).record_failure()
+        raise LLMUnavailable(f"OpenAI stream interrupted: {e}") from e
+    finally:
+        stream.close()
+        CALLS.inc((model, outcome))
+        CALL_DURATION.observe((model, outcome), time.perf_counter() - start)
+
+
+def stream_chat(messages, models=None, deadline_seconds=DEADLINE_SECONDS, **params):
+    """
+    Streamed chat completion: yields the content deltas as they arrive.
+
+    Retries and fallback apply until the first chunk is received; once
+    text has been handed out the stream cannot be restarted, so a later
+    failure (or the deadline passing) raises LLMUnavailable mid-stream.
+    Same arguments as chat().
+    """
+    deadline = time.monotonic() + deadline_seconds
+    model, (stream, chunks, first, start) = _call_with_fallback(
+        lambda model, timeout: _open_stream(model, messages, timeout, params),
+        models,
+        deadline
+    )
+    yield from _relay(model, stream, chunks, first, start, deadline)
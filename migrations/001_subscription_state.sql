@@ -0,0 +1,78 @@
+-- Local projection of Stripe subscription / payment state.
+-- Fed by /api/stripe-webhook and the reconciliation cron, read by
+-- /api/verify-subscription with a single primary-key lookup.
+
+create table if not exists stripe_events (
+    id text primary key,                 -- Stripe event ID (evt_...)
+    type text not null,
+    received_at timestamptz not null default now()
+);
+
+create table if not exists subscriptions (
+    customer_id text primary key,
+    subscription_id text,
+    status text not null default 'none',
+    active boolean not null default false,
+    current_period_end timestamptz,
+    payment_status text,
+    -- Stripe event.created (unix seconds) of the newest event applied to
+    -- the subscription fields and to payment_status respectively
+    subscription_event_created bigint not null default 0,
+    payment_event_created bigint not null default 0,
+    last_event_id text,
+    last_event_created bigint not null default 0,
+    updated_at timestamptz not null default now()
+);
+
+-- Apply a state change only if it is not older than what is already projected,
+-- so out-of-order webhook deliveries cannot regress the state.
+-- Subscription fields (subscription_id, status, current_period_end) and
+-- payment_status are watermarked separately: Stripe does not order its
+-- deliveries, and an invoice or checkout event must never make an earlier
+-- customer.subscription.* event look stale.
+-- NULL arguments keep the current value.
+create or replace function apply_subscription_state(
+    p_customer_id text,
+    p_subscription_id text,
+    p_status text,
+    p_current_period_end timestamptz,
+    p_payment_status text,
+    p_event_id text,
+    p_event_created bigint
+) returns setof subscriptions
+language sql
+as $$
+    insert into subscriptions as s (
+        customer_id, subscription_id, status, active, current_period_end,
+        payment_status, subscription_event_created, payment_event_created,
+        last_event_id, last_event_created, updated_at
+    ) values (
+        p_customer_id, p_subscription_id, coalesce(p_status, 'none'),
+        coalesce(p_status, 'none') = 'active', p_current_period_end,
+        p_payment_status,
+        case when p_status is not null then p_event_created else 0 end,
+        case when p_payment_status is not null then p_event_created else 0 end,
+        p_event_id, p_event_created, now()
+    )
+    on conflict (customer_id) do update set
+        subscription_id = case when p_status is not null and s.subscription_event_created <= p_event_created
+            then coalesce(excluded.subscription_id, s.subscription_id) else s.subscription_id end,
+        status = case when p_status is not null and s.subscription_event_created <= p_event_created
+            then p_status else s.status end,
+        active = case when p_status is not null and s.subscription_event_created <= p_event_created
+            then p_status else s.status end = 'active',
+        current_period_end = case when p_status is not null and s.subscription_event_created <= p_event_created
+            then coalesce(excluded.current_period_end, s.current_period_end) else s.current_period_end end,
+        subscription_event_created = case when p_status is not null and s.subscription_event_created <= p_event_created
+            then p_event_created else s.subscription_event_created end,
+        payment_status = case when p_payment_status is not null and s.payment_event_created <= p_event_created
+            then p_payment_status else s.payment_status end,
+        payment_event_created = case when p_payment_status is not null and s.payment_event_created <= p_event_created
+            then p_event_created else s.payment_event_created end,
+        last_event_id = excluded.last_event_id,
+        last_event_created = greatest(s.last_event_created, excluded.last_event_created),
+        updated_at = now()
+    where (p_status is not null and s.subscription_event_created <= p_event_created)
+       or (p_payment_status is not null and s.payment_event_created <= p_event_created)
+    returning *;
+$$;
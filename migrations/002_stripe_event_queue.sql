@@ -0,0 +1,22 @@
+-- Turn stripe_events into a durable work queue: the webhook stores the
+-- raw verified event and acknowledges; a worker processes it afterwards
+-- with per-customer ordering and retry with backoff.
+
+alter table stripe_events
+    add column if not exists customer_id text not null default '',
+    add column if not exists event_created bigint not null default 0,
+    add column if not exists payload jsonb,
+    add column if not exists status text not null default 'done',  -- pending | processing | done | dead
+    add column if not exists attempts integer not null default 0,
+    add column if not exists next_attempt_at timestamptz not null default now(),
+    add column if not exists locked_at timestamptz,
+    add column if not exists last_error text,
+    add column if not exists processed_at timestamptz;
+
+-- Rows recorded before this migration were processed inline
+alter table stripe_events alter column status set default 'pending';
+
+-- Worker scan: unfinished events in Stripe creation order
+create index if not exists stripe_events_unfinished_idx
+    on stripe_events (event_created, id)
+    where status in ('pending', 'processing');
@@ -0,0 +1,66 @@
+-- Trial state machine: every transition is one conditional UPDATE that
+-- returns the new row (see trials.py).
+
+-- Activation codes: doctor initials + a suffix derived from a sequence
+-- through a bijection, so codes never collide and need no read-back check.
+create sequence if not exists trial_code_seq;
+
+create or replace function trial_code_initials(p_name text) returns text
+language sql immutable
+as $$
+    select case
+        when array_length(w, 1) >= 2 then upper(left(w[1], 1) || left(w[array_length(w, 1)], 1))
+        when length(w[1]) >= 2 then upper(left(w[1], 2))
+        else 'SC'
+    end
+    from (
+        select regexp_split_to_array(
+            trim(regexp_replace(coalesce(p_name, ''), '^(Dr\.?a?|Dra?\.?)\s*', '', 'i')),
+            '\s+'
+        ) as w
+    ) t;
+$$;
+
+-- 4 digits for the first 10,000 codes, 6 digits after that. Within each
+-- block the affine map is a permutation (the multiplier is coprime with
+-- the modulus), so distinct sequence values give distinct suffixes while
+-- consecutive codes do not look consecutive.
+create or replace function trial_code_suffix(p_seq bigint) returns text
+language sql immutable
+as $$
+    select case
+        when p_seq < 10000 then lpad(((p_seq * 7919 + 4271) % 10000)::text, 4, '0')
+        else lpad(((p_seq * 611953 + 271828) % 1000000)::text, 6, '0')
+    end;
+$$;
+
+create unique index if not exists trials_activation_code_key
+    on trials (activation_code)
+    where activation_code is not null;
+
+-- pending code request: only if no code was issued yet
+create or replace function request_trial_code(p_slug text, p_email text) returns setof trials
+language sql
+as $$
+    update trials
+    set doctor_email = p_email,
+        activation_code = trial_code_initials(doctor_name) || trial_code_suffix(nextval('trial_code_seq')),
+        code_requested_at = now(),
+        status = 'pending'
+    where slug = p_slug and activation_code is null
+    returning *;
+$$;
+
+-- activation: code must match (ignoring case and dashes) and the trial
+-- must not be active or expired already (legacy rows have no status)
+create or replace function activate_trial(p_slug text, p_code text) returns setof trials
+language sql
+as $$
+    update trials
+    set activated_at = now(),
+        status = 'active'
+    where slug = p_slug
+      and coalesce(status, 'pending') not in ('active', 'expired')
+      and upper(replace(trim(activation_code), '-', '')) = upper(replace(trim(p_code), '-', ''))
+    returning *;
+$$;
@@ -0,0 +1,20 @@
+-- Materialise trial expiry on the doctor row: set at signup, cleared on
+-- upgrade, flagged by the daily expire-trials cron.
+
+alter table doctors
+    add column if not exists expires_at timestamptz,
+    add column if not exists trial_expired boolean not null default false;
+
+-- Same rule as the former created_at computation: 7 days counted from
+-- the start of the (UTC) signup day
+update doctors
+set expires_at = date_trunc('day', created_at at time zone 'utc') at time zone 'utc' + interval '7 days'
+where customer_id like 'trial\_%' and expires_at is null and created_at is not null;
+
+update doctors
+set trial_expired = true
+where expires_at is not null and expires_at <= now();
+
+create index if not exists doctors_trial_expiry_idx
+    on doctors (expires_at)
+    where expires_at is not null and not trial_expired;
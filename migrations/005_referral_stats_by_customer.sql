@@ -0,0 +1,36 @@
+-- Referral statistics keyed by the referrer's customer ID instead of the
+-- free-text referrer_name, computed by an indexed grouped aggregate.
+
+alter table invites add column if not exists referrer_customer_id text;
+
+-- Exact backfill from referral records (batch referrals store the slug)
+update invites i
+set referrer_customer_id = r.referrer_customer_id
+from referrals r
+where r.invite_slug = i.slug
+  and i.referrer_customer_id is null
+  and r.referrer_customer_id is not null;
+
+-- Remaining legacy rows: match the referrer by name
+update invites i
+set referrer_customer_id = d.customer_id
+from doctors d
+where i.referrer_customer_id is null
+  and i.referrer_name = d.name
+  and coalesce(d.customer_id, '') <> '';
+
+create index if not exists invites_referrer_status_idx
+    on invites (referrer_customer_id, status);
+
+create index if not exists invites_referrer_created_idx
+    on invites (referrer_customer_id, created_at desc);
+
+create or replace function referral_status_counts(p_customer_id text)
+returns table (status text, total bigint)
+language sql stable
+as $$
+    select coalesce(status, 'pending'), count(*)
+    from invites
+    where referrer_customer_id = p_customer_id
+    group by 1;
+$$;
@@ -0,0 +1,26 @@
+-- Panel notifications: broadcasts are stored once (customer_id = 'all')
+-- and each user keeps a read cursor instead of per-user copies.
+
+create table if not exists message_cursors (
+    customer_id text primary key,
+    last_read_at timestamptz not null default now()
+);
+
+create index if not exists messages_customer_created_idx
+    on messages (customer_id, created_at desc);
+
+-- Unread = own messages + broadcasts newer than the read cursor. Users
+-- without a cursor start from their signup, so old broadcasts don't count.
+create or replace function unread_message_count(p_customer_id text)
+returns bigint
+language sql stable
+as $$
+    select count(*)
+    from messages m
+    where m.customer_id in (p_customer_id, 'all')
+      and m.created_at > coalesce(
+          (select c.last_read_at from message_cursors c where c.customer_id = p_customer_id),
+          (select u.created_at from users u where u.customer_id = p_customer_id limit 1),
+          '-infinity'::timestamptz
+      );
+$$;
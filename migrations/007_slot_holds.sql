@@ -0,0 +1,47 @@
+-- Short-lived slot holds: a patient reserves (doctor_id, date, time) while
+-- filling in the booking form. Expiry is lazy (an expired hold is simply
+-- ignored and overwritten); sweep_slot_holds() deletes the leftovers.
+-- date/time use the same 'YYYY-MM-DD' / 'HH:MM' text as the API.
+
+create table if not exists slot_holds (
+    doctor_id text not null,
+    date text not null,
+    time text not null,
+    token text not null,
+    expires_at timestamptz not null,
+    created_at timestamptz not null default now(),
+    primary key (doctor_id, date, time)
+);
+
+create index if not exists slot_holds_token_idx on slot_holds (token);
+create index if not exists slot_holds_expires_at_idx on slot_holds (expires_at);
+
+-- Take the hold if the slot is free, the previous hold expired, or the
+-- caller already holds it (renewal). Returns no row if someone else holds it.
+create or replace function hold_slot(
+    p_doctor_id text,
+    p_date text,
+    p_time text,
+    p_token text,
+    p_minutes integer
+) returns setof slot_holds
+language sql
+as $$
+    insert into slot_holds (doctor_id, date, time, token, expires_at)
+    values (p_doctor_id, p_date, p_time, p_token, now() + make_interval(mins => p_minutes))
+    on conflict (doctor_id, date, time) do update
+        set token = excluded.token,
+            expires_at = excluded.expires_at,
+            created_at = now()
+        where slot_holds.expires_at <= now() or slot_holds.token = excluded.token
+    returning *;
+$$;
+
+create or replace function sweep_slot_holds() returns bigint
+language sql
+as $$
+    with deleted as (
+        delete from slot_holds where expires_at <= now() returning 1
+    )
+    select count(*) from deleted;
+$$;
@@ -0,0 +1,54 @@
+-- Multi-doctor availability search: earliest free slots across doctors,
+-- filtered by specialty and date window, in one indexed query.
+-- Keyset pagination on (date, time, doctor_id).
+
+-- Equality on status first, then the sort order, so a page is an index
+-- range scan in (date, time, doctor_id) order with no sort step
+drop index if exists availability_date_status_doctor_idx;
+create index if not exists availability_status_date_time_doctor_idx
+    on availability (status, date, time, doctor_id);
+
+drop function if exists search_availability(text, text, text, text, text, text, integer);
+
+-- p_today / p_now: the caller's current date and time, on the same clock
+-- as slot generation; slots that have already started are left out
+create or replace function search_availability(
+    p_date_from text,
+    p_date_to text,
+    p_today text,
+    p_now text,
+    p_specialty text default null,
+    p_after_date text default null,
+    p_after_time text default null,
+    p_after_doctor text default null,
+    p_limit integer default 50
+) returns table (
+    doctor_id text,
+    date text,
+    time text,
+    doctor_name text,
+    specialty text,
+    link text,
+    logo_url text,
+    color text
+)
+language sql stable
+as $$
+    select a.doctor_id, a.date, a.time, d.name, d.specialty, d.link, d.logo_url, d.color
+    from availability a
+    join doctors d on d.id = a.doctor_id
+    where a.date between p_date_from and p_date_to
+      and a.status = 'available'
+      and (a.date, a.time) >= (p_today, p_now)
+      and (p_specialty is null or d.specialty ilike '%' || p_specialty || '%')
+      and not coalesce(d.trial_expired, false)
+      and (p_after_date is null
+           or (a.date, a.time, a.doctor_id) > (p_after_date, p_after_time, p_after_doctor))
+      and not exists (
+          select 1 from slot_holds h
+          where h.doctor_id = a.doctor_id and h.date = a.date and h.time = a.time
+            and h.expires_at > now()
+      )
+    order by a.date, a.time, a.doctor_id
+    limit p_limit;
+$$;
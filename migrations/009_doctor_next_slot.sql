@@ -0,0 +1,90 @@
+-- Next available slot per doctor, for cards and invite pages.
+-- Maintained incrementally by the data layer: save_availability writes it
+-- from the new schedule, single status changes go through note_slot_status.
+-- A pointer that has slipped into the past is recomputed when it is read.
+
+create table if not exists doctor_next_slot (
+    doctor_id text primary key,
+    date text,  -- null: no future available slot
+    time text,
+    updated_at timestamptz not null default now()
+);
+
+create index if not exists availability_doctor_status_date_idx
+    on availability (doctor_id, status, date, time);
+
+-- Earliest available slot of a doctor at or after (p_today, p_now)
+create or replace function compute_next_slot(p_doctor_id text, p_today text, p_now text)
+returns table (date text, time text)
+language sql stable
+as $$
+    select a.date, a.time
+    from availability a
+    where a.doctor_id = p_doctor_id
+      and a.status = 'available'
+      and (a.date, a.time) >= (p_today, p_now)
+    order by a.date, a.time
+    limit 1;
+$$;
+
+-- A slot changed status: move the pointer only when it is affected
+create or replace function note_slot_status(
+    p_doctor_id text,
+    p_date text,
+    p_time text,
+    p_status text,
+    p_today text,
+    p_now text
+) returns void
+language plpgsql
+as $$
+declare
+    cur doctor_next_slot%rowtype;
+begin
+    if (p_date, p_time) < (p_today, p_now) then
+        return;
+    end if;
+
+    select * into cur from doctor_next_slot where doctor_id = p_doctor_id for update;
+
+    if not found
+       or (p_status <> 'available' and cur.date = p_date and cur.time = p_time) then
+        -- Unknown pointer, or its slot was just taken: recompute
+        insert into doctor_next_slot (doctor_id, date, time)
+        select p_doctor_id, c.date, c.time
+        from (select 1) one
+        left join compute_next_slot(p_doctor_id, p_today, p_now) c on true
+        on conflict (doctor_id) do update
+            set date = excluded.date, time = excluded.time, updated_at = now();
+    elsif p_status = 'available'
+          and (cur.date is null or (p_date, p_time) < (cur.date, cur.time)) then
+        update doctor_next_slot
+        set date = p_date, time = p_time, updated_at = now()
+        where doctor_id = p_doctor_id;
+    end if;
+end;
+$$;
+
+-- Pointers for many doctors; missing and past pointers are recomputed first
+create or replace function next_available_slots(p_doctor_ids text[], p_today text, p_now text)
+returns table (doctor_id text, date text, time text)
+language plpgsql
+as $$
+#variable_conflict use_column
+begin
+    insert into doctor_next_slot (doctor_id, date, time)
+    select d.id, c.date, c.time
+    from doctors d
+    left join doctor_next_slot n on n.doctor_id = d.id
+    left join lateral compute_next_slot(d.id, p_today, p_now) c on true
+    where d.id = any(p_doctor_ids)
+      and (n.doctor_id is null or (n.date is not null and (n.date, n.time) < (p_today, p_now)))
+    on conflict (doctor_id) do update
+        set date = excluded.date, time = excluded.time, updated_at = now();
+
+    return query
+        select n.doctor_id, n.date, n.time
+        from doctor_next_slot n
+        where n.doctor_id = any(p_doctor_ids);
+end;
+$$;
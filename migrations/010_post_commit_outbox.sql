@@ -0,0 +1,21 @@
+-- Optional durable outbox for post-commit side effects (POST_COMMIT_OUTBOX=1).
+-- Rows are written before the response; the in-request background run or
+-- /api/cron/post-commit executes them at least once, with backoff.
+
+create table if not exists post_commit_outbox (
+    id bigserial primary key,
+    task text not null,
+    args jsonb not null default '[]',
+    status text not null default 'pending',  -- pending | processing | done | dead
+    attempts integer not null default 0,
+    next_attempt_at timestamptz not null default now(),
+    locked_at timestamptz,
+    last_error text,
+    created_at timestamptz not null default now(),
+    processed_at timestamptz
+);
+
+-- Worker scan and backlog count: unfinished rows only
+create index if not exists post_commit_outbox_unfinished_idx
+    on post_commit_outbox (next_attempt_at)
+    where status in ('pending', 'processing');
@@ -0,0 +1,39 @@
+-- Shared, versioned schedule templates. A version is immutable once
+-- written; a doctor references (template, version) plus personal
+-- overrides and blocked dates instead of keeping their own structure.
+
+create table if not exists schedule_templates (
+    id text not null,
+    version integer not null,
+    name text not null,
+    structure jsonb not null,
+    created_at timestamptz not null default now(),
+    primary key (id, version)
+);
+
+alter table doctors
+    add column if not exists schedule_template_id text,
+    add column if not exists schedule_template_version integer,
+    add column if not exists schedule_overrides jsonb;
+
+create index if not exists doctors_schedule_template_idx
+    on doctors (schedule_template_id, schedule_template_version)
+    where schedule_template_id is not null;
+
+-- New version = latest + 1 (the primary key rejects a concurrent duplicate)
+create or replace function create_schedule_template_version(p_id text, p_name text, p_structure jsonb)
+returns setof schedule_templates
+language sql
+as $$
+    insert into schedule_templates (id, version, name, structure)
+    select p_id, coalesce(max(version), 0) + 1, p_name, p_structure
+    from schedule_templates
+    where id = p_id
+    returning *;
+$$;
+
+-- Latest version of every template
+create or replace view schedule_templates_latest as
+    select distinct on (id) id, version, name, structure, created_at
+    from schedule_templates
+    order by id, version desc;
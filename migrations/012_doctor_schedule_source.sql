@@ -0,0 +1,7 @@
+-- The doctor's own description of their hours and the structure extracted
+-- from it, kept so availability can be regenerated offline (new prompt,
+-- new horizon) without asking every doctor to re-enter their schedule.
+
+alter table doctors
+    add column if not exists schedule_text text,
+    add column if not exists schedule_structure jsonb;
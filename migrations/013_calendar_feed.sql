@@ -0,0 +1,86 @@
+-- Per-doctor ICS calendar feed with cheap conditional polling and
+-- incremental sync.
+--
+-- doctors.calendar_token is the secret in the feed URL (calendar apps send
+-- no credentials). doctors.appointments_changed_at moves on every insert,
+-- update or delete of the doctor's appointments, so a poll that finds
+-- nothing new is one indexed read answered with 304. Deletions (cancelled
+-- appointments) leave a tombstone, so sync tokens can report them.
+
+alter table doctors
+    add column if not exists calendar_token text,
+    add column if not exists appointments_changed_at timestamptz not null default now();
+
+create unique index if not exists doctors_calendar_token_idx
+    on doctors (calendar_token)
+    where calendar_token is not null;
+
+alter table appointments
+    add column if not exists updated_at timestamptz not null default now();
+
+create index if not exists appointments_doctor_updated_idx
+    on appointments (doctor_id, updated_at);
+
+create table if not exists appointment_tombstones (
+    appointment_id text not null,
+    doctor_id text not null,
+    deleted_at timestamptz not null default now()
+);
+
+create index if not exists appointment_tombstones_doctor_deleted_idx
+    on appointment_tombstones (doctor_id, deleted_at);
+
+create or replace function appointments_track_changes()
+returns trigger
+language plpgsql
+as $$
+begin
+    if tg_op = 'DELETE' then
+        insert into appointment_tombstones (appointment_id, doctor_id)
+        values (old.id::text, old.doctor_id);
+        update doctors set appointments_changed_at = now() where id = old.doctor_id;
+        return old;
+    end if;
+
+    new.updated_at := now();
+    update doctors set appointments_changed_at = now() where id = new.doctor_id;
+    return new;
+end;
+$$;
+
+drop trigger if exists appointments_track_changes on appointments;
+create trigger appointments_track_changes
+    before insert or update or delete on appointments
+    for each row execute function appointments_track_changes();
+
+-- The feed also shows the doctor's name (calendar name) and takes event
+-- lengths from schedule_structure: a change to either is a feed change,
+-- so it moves Last-Modified like an appointment change does
+create or replace function doctors_track_feed_changes()
+returns trigger
+language plpgsql
+as $$
+begin
+    if new.name is distinct from old.name
+       or new.schedule_structure is distinct from old.schedule_structure then
+        new.appointments_changed_at := now();
+    end if;
+    return new;
+end;
+$$;
+
+drop trigger if exists doctors_track_feed_changes on doctors;
+create trigger doctors_track_feed_changes
+    before update on doctors
+    for each row execute function doctors_track_feed_changes();
+
+-- Tombstones older than the sync-token lifetime are no longer needed
+create or replace function prune_appointment_tombstones(p_before timestamptz)
+returns integer
+language sql
+as $$
+    with deleted as (
+        delete from appointment_tombstones where deleted_at < p_before returning 1
+    )
+    select count(*)::integer from deleted;
+$$;
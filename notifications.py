@@ -0,0 +1,118 @@
+"""
+Panel notifications for SlotlyCare
+Messages are collected during a request and written after the response
+in one batched insert, so milestone checks and inserts never block the
+request path. Broadcasts are stored once (customer_id = 'all') and read
+state is a per-user cursor (see migrations/006_message_cursors.sql).
+
+Batches run as a post-commit task (deliver_notifications), so deferred
+producers are referenced by name and must be registered with @producer.
+"""
+
+import postcommit
+
+BROADCAST_CUSTOMER_ID = 'all'
+
+PRODUCERS = {}
+
+
+def producer(func):
+    """Register a deferred message producer under its function name."""
+    PRODUCERS[func.__name__] = func
+    return func
+
+
+class NotificationBatch:
+    """
+    Notifications produced by one request.
+
+    Usage:
+        batch = NotificationBatch(sheets)
+        batch.add(customer_id, text, 'system')
+        batch.add_deferred(first_appointment_messages, doctor_id)
+        batch.schedule(pipeline)
+    """
+
+    def __init__(self, sheets):
+        self.sheets = sheets
+        self._messages = []
+        self._producers = []
+
+    def add(self, customer_id, text, msg_type='system'):
+        """Queue a message that is already known."""
+        if customer_id and text:
+            self._messages.append({'customer_id': customer_id, 'text': text, 'type': msg_type})
+
+    def add_deferred(self, producer, *args):
+        """
+        Queue a registered producer evaluated at flush time, off the request path.
+        producer(sheets, *args) returns a list of (customer_id, text, msg_type).
+        """
+        if PRODUCERS.get(producer.__name__) is not producer:
+            raise ValueError(f"{producer.__name__} is not a registered notification producer")
+        self._producers.append((producer.__name__, list(args)))
+
+    def __len__(self):
+        return len(self._messages) + len(self._producers)
+
+    def schedule(self, pipeline):
+        """Deliver the batch after the response, as a post-commit task."""
+        if len(self):
+            pipeline.add(deliver_notifications, self._messages, self._producers)
+            self._messages = []
+            self._producers = []
+
+    def flush(self, raise_errors=False):
+        """
+        Run deferred producers and insert every message in one batch.
+        A failing producer or a failed insert is logged and skipped, or
+        raised with raise_errors (nothing was written, so a retry is safe).
+
+        Returns:
+            int: Number of messages written
+        """
+        messages = list(self._messages)
+        for name, args in self._producers:
+            try:
+                for customer_id, text, msg_type in PRODUCERS[name](self.sheets, *args) or []:
+                    if customer_id and text:
+                        messages.append({'customer_id': customer_id, 'text': text, 'type': msg_type})
+            except Exception as e:
+                if raise_errors:
+                    raise
+                print(f"Notification producer {name} failed: {e}")
+
+        self._messages = []
+        self._producers = []
+
+        if not messages:
+            return 0
+
+        result = self.sheets.create_messages(messages)
+        if not result['success']:
+            if raise_errors:
+                raise RuntimeError(f"Notification batch failed ({len(messages)} messages): {result.get('error')}")
+            print(f"Notification batch failed ({len(messages)} messages): {result.get('error')}")
+            return 0
+
+        return result['count']
+
+
+@postcommit.task
+def deliver_notifications(sheets, messages, producers):
+    """Post-commit task of NotificationBatch.schedule."""
+    batch = NotificationBatch(sheets)
+    batch._messages = [dict(m) for m in messages]
+    batch._producers = [(name, list(args)) for name, args in producers]
+    batch.flush(raise_errors=True)
+
+
+def broadcast(sheets, text, msg_type='manual'):
+    """
+    Send a message to every doctor. Stored once; each user's read cursor
+    decides whether it counts as unread.
+
+    Returns:
+        dict: Success status
+    """
+    return sheets.create_message(BROADCAST_CUSTOMER_ID, text, msg_type)
@@ -0,0 +1,192 @@
+"""
+Post-commit side effects for SlotlyCare
+Work that must follow a request's primary write but must not delay its
+response (emails to the team, invite status updates, panel notifications)
+is added to a PostCommit pipeline and run after the response through
+FastAPI BackgroundTasks, with a few in-process retries.
+
+With POST_COMMIT_OUTBOX=1 each task is also written to post_commit_outbox
+before the response, which makes execution at-least-once: a task whose
+background run fails, or never happens because the instance was frozen,
+is retried by process_outbox (/api/cron/post-commit) with backoff. Tasks
+must therefore tolerate running twice.
+
+Tasks are registered by name (@task) so outbox rows can be replayed, take
+the data layer as first argument, and get JSON-serialisable arguments.
+"""
+
+import os
+import time
+from datetime import datetime, timedelta
+
+from instrumentation import REGISTRY, Counter, Gauge, Histogram
+
+IN_PROCESS_ATTEMPTS = 3
+IN_PROCESS_RETRY_DELAY = 0.5
+MAX_ATTEMPTS = 6
+BASE_BACKOFF_SECONDS = 60
+MAX_BACKOFF_SECONDS = 3600
+# A 'processing' row older than this belongs to a run that died
+STALE_LOCK_SECONDS = 300
+
+TASKS = {}
+
+TASK_RUNS = REGISTRY.register(Counter(
+    'slotlycare_post_commit_tasks_total',
+    'Post-commit task attempts by task and outcome (ok, retry, failed).',
+    ('task', 'outcome')
+))
+
+TASK_DURATION = REGISTRY.register(Histogram(
+    'slotlycare_post_commit_task_duration_seconds',
+    'Post-commit task attempt duration by task.',
+    ('task',)
+))
+
+QUEUED = REGISTRY.register(Gauge(
+    'slotlycare_post_commit_queued',
+    'Post-commit tasks waiting for their background run in this instance.'
+))
+
+OUTBOX_BACKLOG = REGISTRY.register(Gauge(
+    'slotlycare_post_commit_outbox_backlog',
+    'Unfinished outbox rows at the end of the last worker run.'
+))
+
+
+def task(func):
+    """Register a post-commit task under its function name."""
+    TASKS[func.__name__] = func
+    return func
+
+
+def outbox_enabled():
+    return os.environ.get('POST_COMMIT_OUTBOX') == '1'
+
+
+def _stale_before():
+    return (datetime.utcnow() - timedelta(seconds=STALE_LOCK_SECONDS)).isoformat()
+
+
+def _retry_at(attempts):
+    delay = min(BASE_BACKOFF_SECONDS * (2 ** (attempts - 1)), MAX_BACKOFF_SECONDS)
+    return (datetime.utcnow() + timedelta(seconds=delay)).isoformat()
+
+
+class PostCommit:
+    """
+    Side effects of one request, run after its response.
+
+    Usage:
+        pipeline = postcommit.PostCommit(sheets, background_tasks)
+        pipeline.add(set_invite_status, slug, 'converted')
+        pipeline.add(send_email, subject, body)
+    """
+
+    def __init__(self, sheets, background_tasks):
+        self.sheets = sheets
+        self.background_tasks = background_tasks
+        self.durable = outbox_enabled()
+
+    def add(self, func, *args):
+        """Schedule a registered task; call only once the primary write has committed."""
+        name = func.__name__
+        if TASKS.get(name) is not func:
+            raise ValueError(f"{name} is not a registered post-commit task")
+
+        outbox_id = None
+        if self.durable:
+            # If the outbox write fails the task still runs, best-effort
+            outbox_id = self.sheets.enqueue_post_commit_task(name, list(args))
+
+        QUEUED.inc()
+        self.background_tasks.add_task(_run_scheduled, self.sheets, name, args, outbox_id)
+
+
+def run_task(sheets, name, args, attempts=1):
+    """
+    Run a registered task, retrying in-process up to `attempts` times.
+
+    Returns:
+        str: The last error, or None if the task succeeded
+    """
+    func = TASKS.get(name)
+    if func is None:
+        TASK_RUNS.inc((name, 'failed'))
+        return f"Unknown post-commit task: {name}"
+
+    delay = IN_PROCESS_RETRY_DELAY
+    error = None
+    for attempt in range(1, attempts + 1):
+        start = time.perf_counter()
+        try:
+            func(sheets, *args)
+            TASK_DURATION.observe((name,), time.perf_counter() - start)
+            TASK_RUNS.inc((name, 'ok'))
+            return None
+        except Exception as e:
+            TASK_DURATION.observe((name,), time.perf_counter() - start)
+            error = str(e) or e.__class__.__name__
+            print(f"Post-commit task {name} failed, attempt {attempt}: {error}")
+            if attempt < attempts:
+                TASK_RUNS.inc((name, 'retry'))
+                time.sleep(delay)
+                delay *= 2
+
+    TASK_RUNS.inc((name, 'failed'))
+    return error
+
+
+def _run_scheduled(sheets, name, args, outbox_id):
+    QUEUED.dec()
+
+    if outbox_id is not None and not sheets.claim_post_commit_task(outbox_id, _stale_before()):
+        # The worker already has it
+        return
+
+    error = run_task(sheets, name, args, attempts=IN_PROCESS_ATTEMPTS)
+
+    if outbox_id is None:
+        return
+    if error is None:
+        sheets.complete_post_commit_task(outbox_id)
+    else:
+        attempts = IN_PROCESS_ATTEMPTS
+        sheets.fail_post_commit_task(outbox_id, attempts, _retry_at(attempts), error, dead=attempts >= MAX_ATTEMPTS)
+
+
+def process_outbox(sheets, limit=100):
+    """
+    Run outbox tasks that are due (failed or never run in-request).
+
+    Args:
+        sheets (SheetsClient): Data layer
+        limit (int): Maximum number of rows to run
+
+    Returns:
+        dict: Counts of processed and failed tasks, and the remaining backlog
+    """
+    now = datetime.utcnow().isoformat()
+    stale_before = _stale_before()
+
+    processed = 0
+    failed = 0
+
+    for row in sheets.get_due_post_commit_tasks(now, stale_before, limit):
+        if not sheets.claim_post_commit_task(row['id'], stale_before):
+            continue
+
+        error = run_task(sheets, row['task'], row.get('args') or [])
+        if error is None:
+            sheets.complete_post_commit_task(row['id'])
+            processed += 1
+            continue
+
+        attempts = (row.get('attempts') or 0) + 1
+        sheets.fail_post_commit_task(row['id'], attempts, _retry_at(attempts), error, dead=attempts >= MAX_ATTEMPTS)
+        failed += 1
+
+    backlog = sheets.count_post_commit_backlog()
+    OUTBOX_BACKLOG.set(backlog)
+
+    return {'processed': processed, 'failed': failed, 'backlog': backlog}
@@ -0,0 +1,267 @@
+"""
+Batch schedule regeneration for SlotlyCare
+Regenerates every active doctor's availability after a change to the
+extraction prompt, the slot engine or the horizon, without one
+interactive /api/schedule call per doctor.
+
+Per doctor, the schedule comes from (first match):
+- their schedule template (no OpenAI call)
+- --batch-results: a structure from an OpenAI Batch API output file
+- their saved schedule_text, re-extracted through the LLM gateway when
+  --reextract is given or no structure is stored
+- their saved schedule_structure
+
+Doctors whose last save sent hand-edited slots without any of these have
+no stored source and are skipped, so their availability is left as is.
+
+Slots are written per doctor as soon as they are generated (booked and
+blocked slots are kept), and each finished doctor is appended to the
+checkpoint file. A rerun with the same checkpoint skips them, so an
+interrupted run resumes where it stopped; failed doctors are retried.
+
+Usage (from the repository root, with the production environment):
+    python regenerate_schedules.py [--concurrency 4] [--reextract] [--limit N] [--dry-run]
+    python regenerate_schedules.py --export-batch batch_input.jsonl
+    python regenerate_schedules.py --batch-results batch_output.jsonl
+"""
+
+import argparse
+import json
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+from itertools import islice
+
+import llm_gateway
+import schedule_engine
+import schedule_parser
+import schedule_templates
+from slotset import SlotSet
+from supabase_client import SheetsClient
+
+DEFAULT_CHECKPOINT = 'regenerate_schedules.checkpoint.jsonl'
+DEFAULT_CONCURRENCY = 4
+# Statuses a regeneration must not touch
+PRESERVED_STATUSES = ('booked', 'blocked')
+PROGRESS_EVERY = 25
+
+
+class Checkpoint:
+    """Append-only record of finished doctors (one JSON line each)."""
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        self._lock = threading.Lock()
+        try:
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Torn last line of an interrupted run
+                        continue
+                    if entry.get('status') in ('ok', 'skipped'):
+                        self.done.add(entry['id'])
+        except FileNotFoundError:
+            pass
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def record(self, entry):
+        with self._lock:
+            self._file.write(json.dumps(entry) + '\n')
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def load_batch_results(path):
+    """
+    Structures from an OpenAI Batch API output file.
+
+    Returns:
+        dict: doctor id (custom_id) -> structure
+    """
+    structures = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            entry = json.loads(line)
+            try:
+                content = entry['response']['body']['choices'][0]['message']['content']
+                structures[entry['custom_id']] = json.loads(content)
+            except (KeyError, IndexError, TypeError, ValueError):
+                print(f"Batch result for {entry.get('custom_id')} unusable: {entry.get('error')}")
+    return structures
+
+
+def export_batch(sheets, path, limit=None):
+    """Write an OpenAI Batch API input file for every doctor with a schedule_text."""
+    today = datetime.now().date()
+    count = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        for source in islice(sheets.iter_schedule_sources(), limit):
+            if source.get('schedule_template_id') or not source.get('schedule_text'):
+                continue
+            f.write(json.dumps({
+                'custom_id': source['id'],
+                'method': 'POST',
+                'url': '/v1/chat/completions',
+                'body': {
+                    'model': llm_gateway.PRIMARY_MODEL,
+                    'messages': schedule_parser.build_messages(source['schedule_text'], today),
+                    **schedule_parser.COMPLETION_PARAMS
+                }
+            }) + '\n')
+            count += 1
+    print(f"{count} requests written to {path}")
+
+
+def compiled_schedule(sheets, source, reextract, batch_structures):
+    """
+    The doctor's compiled schedule and, if it was (re-)extracted, the new
+    structure to store. (None, None) when the doctor has no schedule source.
+    """
+    if source.get('schedule_template_id'):
+        expanded = schedule_templates.expand(
+            sheets, source['schedule_template_id'], source.get('schedule_template_version'), source.get('schedule_overrides')
+        )
+        if expanded is None:
+            raise ValueError(f"Schedule template {source['schedule_template_id']} not found")
+        return expanded[1], None
+
+    structure = batch_structures.get(source['id'])
+    if structure is None and source.get('schedule_text') and (reextract or not source.get('schedule_structure')):
+        structure = schedule_parser.parse_schedule(source['schedule_text'])
+
+    if structure is not None:
+        if not schedule_parser.is_complete(structure):
+            raise ValueError("Extracted structure is incomplete")
+        return schedule_engine.compile_schedule(structure), structure
+
+    if source.get('schedule_structure'):
+        return schedule_engine.compile_schedule(source['schedule_structure']), None
+
+    return None, None
+
+
+def regenerate(sheets, source, reextract, batch_structures, dry_run):
+    """Regenerate one doctor. Returns the checkpoint entry."""
+    doctor_id = source['id']
+    try:
+        compiled, new_structure = compiled_schedule(sheets, source, reextract, batch_structures)
+        if compiled is None:
+            return {'id': doctor_id, 'status': 'skipped', 'reason': 'no schedule source'}
+
+        slots = SlotSet.from_slots(compiled.iter_slots())
+        if dry_run:
+            return {'id': doctor_id, 'status': 'dry-run', 'slots': len(slots)}
+
+        if new_structure is not None:
+            stored = sheets.set_schedule_structure(doctor_id, new_structure)
+            if not stored['success']:
+                return {'id': doctor_id, 'status': 'failed', 'error': stored.get('error')}
+
+        result = sheets.save_availability(doctor_id, slots, preserve=PRESERVED_STATUSES)
+        if not result['success']:
+            return {'id': doctor_id, 'status': 'failed', 'error': result.get('error')}
+
+        return {
+            'id': doctor_id,
+            'status': 'ok',
+            'slots': result['slots_count'],
+            'previous': result['previous_count']
+        }
+
+    except llm_gateway.LLMUnavailable as e:
+        return {'id': doctor_id, 'status': 'failed', 'error': f"OpenAI unavailable: {e}"}
+    except Exception as e:
+        return {'id': doctor_id, 'status': 'failed', 'error': str(e) or e.__class__.__name__}
+
+
+def run(sheets, checkpoint, concurrency=DEFAULT_CONCURRENCY, reextract=False,
+        batch_structures=None, limit=None, dry_run=False):
+    """
+    Regenerate every doctor not yet in the checkpoint, `concurrency` at a
+    time. Doctors are read page by page as workers free up.
+
+    Returns:
+        dict: Counts per status
+    """
+    batch_structures = batch_structures or {}
+    sources = (s for s in sheets.iter_schedule_sources() if s['id'] not in checkpoint.done)
+    sources = islice(sources, limit)
+
+    counts = {}
+    started = time.monotonic()
+    if checkpoint.done:
+        print(f"Resuming: {len(checkpoint.done)} doctors already done")
+
+    def finished(future):
+        entry = future.result()
+        entry['at'] = datetime.now().isoformat()
+        if not dry_run:
+            checkpoint.record(entry)
+        counts[entry['status']] = counts.get(entry['status'], 0) + 1
+        if entry['status'] == 'failed':
+            print(f"  {entry['id']}: {entry['error']}")
+        total = sum(counts.values())
+        if total % PROGRESS_EVERY == 0:
+            print(f"{total} doctors in {time.monotonic() - started:.0f}s: {counts}")
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = set()
+        for source in sources:
+            # Bounded: never more than 2x concurrency doctors in memory
+            if len(pending) >= concurrency * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finished(future)
+            pending.add(executor.submit(regenerate, sheets, source, reextract, batch_structures, dry_run))
+
+        done, _ = wait(pending)
+        for future in done:
+            finished(future)
+
+    print(f"Finished in {time.monotonic() - started:.0f}s: {counts}")
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Regenerate every doctor's availability.")
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help="Doctors processed at a time (OpenAI and database calls)")
+    parser.add_argument('--checkpoint', default=DEFAULT_CHECKPOINT,
+                        help="Progress file; rerun with the same file to resume")
+    parser.add_argument('--reextract', action='store_true',
+                        help="Re-extract structures from schedule_text (after a prompt change)")
+    parser.add_argument('--export-batch', metavar='PATH',
+                        help="Only write an OpenAI Batch API input file and exit")
+    parser.add_argument('--batch-results', metavar='PATH',
+                        help="Use structures from an OpenAI Batch API output file")
+    parser.add_argument('--limit', type=int, help="Process at most this many doctors")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="Generate slots but write nothing")
+    args = parser.parse_args(argv)
+
+    sheets = SheetsClient()
+
+    if args.export_batch:
+        export_batch(sheets, args.export_batch, args.limit)
+        return 0
+
+    batch_structures = load_batch_results(args.batch_results) if args.batch_results else None
+    checkpoint = Checkpoint(args.checkpoint)
+    try:
+        counts = run(sheets, checkpoint, max(1, args.concurrency), args.reextract,
+                     batch_structures, args.limit, args.dry_run)
+    finally:
+        checkpoint.close()
+
+    return 1 if counts.get('failed') else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
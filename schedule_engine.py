@@ -0,0 +1,277 @@
+"""
+Schedule engine for SlotlyCare
+Turns a schedule structure (as extracted from the doctor's text, or a
+template) into appointment slots.
+
+A structure is compiled once into a per-weekday grid of 'HH:MM' start times
+plus a set of blocked dates; expanding it over a horizon is then only a
+weekday lookup per day. Compiled schedules are immutable, so a template's
+grid can be shared by every doctor that uses it (see schedule_templates.py).
+"""
+
+from datetime import datetime, timedelta, time
+
+DAY_NAMES = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")
+DAY_INDEX = {name: index for index, name in enumerate(DAY_NAMES)}
+
+# Slots are generated from today up to and including today + HORIZON_DAYS
+HORIZON_DAYS = 180
+
+DEFAULT_START_TIME = "09:00"
+DEFAULT_END_TIME = "17:00"
+DEFAULT_SLOT_MINUTES = 30
+MIN_SLOT_MINUTES = 5
+
+
+def _minutes(value):
+    """Minute of day of an ISO time ('HH:MM' or 'HH:MM:SS'); raises ValueError."""
+    parsed = time.fromisoformat(value)
+    return parsed.hour * 60 + parsed.minute
+
+
+def _valid_duration(value, default):
+    if not isinstance(value, int) or value < MIN_SLOT_MINUTES:
+        return default
+    return value
+
+
+def day_grid(start, end, duration, breaks):
+    """
+    Slot start times of one working day, as 'HH:MM' strings.
+
+    Args:
+        start (int): First slot, minute of day
+        end (int): End of the working day, minute of day
+        duration (int): Slot length in minutes
+        breaks (list): (start, end) minute-of-day intervals without slots
+
+    A slot that would overlap a break is not created; the next slot starts
+    when the break ends.
+    """
+    grid = []
+    current = start
+    while current < end:
+        slot_end = current + duration
+        if slot_end > end:
+            break
+
+        for break_start, break_end in breaks:
+            if not (current >= break_end or slot_end <= break_start):
+                current = break_end
+                break
+        else:
+            grid.append(f"{current // 60:02d}:{current % 60:02d}")
+            current = slot_end
+
+    return tuple(grid)
+
+
+def _parse_breaks(breaks):
+    if not isinstance(breaks, list):
+        return []
+    return [(_minutes(b["start"]), _minutes(b["end"])) for b in breaks]
+
+
+def _date_range(start, end):
+    start_date = datetime.strptime(start, "%Y-%m-%d").date()
+    end_date = datetime.strptime(end, "%Y-%m-%d").date()
+    current = start_date
+    while current <= end_date:
+        yield current.strftime("%Y-%m-%d")
+        current += timedelta(days=1)
+
+
+def parse_blocked_dates(schedule_data):
+    """
+    Blocked dates of a schedule, from "blocked_dates" (strings, {"date"} or
+    {"start", "end"} objects) and "blocked_date_ranges". Malformed entries
+    are ignored.
+    """
+    blocked = set()
+
+    for item in schedule_data.get("blocked_dates", []) or []:
+        if isinstance(item, str):
+            blocked.add(item)
+        elif isinstance(item, dict):
+            if "date" in item:
+                blocked.add(item["date"])
+            elif "start" in item and "end" in item:
+                try:
+                    blocked.update(_date_range(item["start"], item["end"]))
+                except (TypeError, ValueError):
+                    pass
+
+    for range_info in schedule_data.get("blocked_date_ranges", []) or []:
+        try:
+            blocked.update(_date_range(range_info["start"], range_info["end"]))
+        except (TypeError, ValueError, KeyError):
+            pass
+
+    return blocked
+
+
+class CompiledSchedule:
+    """
+    A schedule compiled to per-weekday slot grids.
+
+    Usage:
+        compiled = compile_schedule(structure)
+        for slot in compiled.iter_slots():
+            ...
+    """
+
+    __slots__ = ('grids', 'blocked_dates', 'default_duration', 'durations')
+
+    def __init__(self, grids, blocked_dates=frozenset(), default_duration=DEFAULT_SLOT_MINUTES, durations=None):
+        self.grids = tuple(grids)
+        self.blocked_dates = frozenset(blocked_dates)
+        self.default_duration = default_duration
+        # Slot length per weekday (overrides may differ from the default)
+        self.durations = tuple(durations) if durations else (default_duration,) * 7
+
+    def iter_slots(self, start=None, days=HORIZON_DAYS):
+        """
+        Yield slot dicts (date, time, status) in date/time order, from
+        `start` (default today) up to and including start + days.
+        """
+        current = start or datetime.now().date()
+        grids = self.grids
+        blocked = self.blocked_dates
+        for _ in range(days + 1):
+            grid = grids[current.weekday()]
+            if grid:
+                date_str = current.strftime("%Y-%m-%d")
+                if date_str not in blocked:
+                    for slot_time in grid:
+                        yield {"date": date_str, "time": slot_time, "status": "available"}
+            current += timedelta(days=1)
+
+    def weekly_stats(self):
+        """
+        Summary of a regular week, from the grids alone (nothing is expanded):
+        working days, slots per week and bookable hours per week.
+        """
+        working_days = [DAY_NAMES[weekday] for weekday, grid in enumerate(self.grids) if grid]
+        slots_per_week = sum(len(grid) for grid in self.grids)
+        minutes_per_week = sum(len(grid) * duration for grid, duration in zip(self.grids, self.durations))
+        return {
+            "working_days": working_days,
+            "slots_per_week": slots_per_week,
+            "hours_per_week": round(minutes_per_week / 60, 2)
+        }
+
+    def count_slots(self, start=None, days=HORIZON_DAYS):
+        """Number of slots iter_slots(start, days) would yield, without expanding them."""
+        start = start or datetime.now().date()
+        weeks, extra = divmod(days + 1, 7)
+        per_weekday = [len(grid) for grid in self.grids]
+
+        total = weeks * sum(per_weekday)
+        for offset in range(extra):
+            total += per_weekday[(start.weekday() + offset) % 7]
+
+        end = start + timedelta(days=days)
+        for date_str in self.blocked_dates:
+            try:
+                blocked = datetime.strptime(date_str, "%Y-%m-%d").date()
+            except (TypeError, ValueError):
+                continue
+            if start <= blocked <= end:
+                total -= per_weekday[blocked.weekday()]
+        return total
+
+    def with_overrides(self, personal):
+        """
+        This schedule with a doctor's personal changes on top: "overrides"
+        (per-day hours) replace the grid of their weekday, "blocked_dates"
+        and "blocked_date_ranges" are added. Only overridden weekdays are
+        recompiled.
+        """
+        if not personal:
+            return self
+
+        grids = list(self.grids)
+        durations = list(self.durations)
+        for weekday, (grid, duration) in _compile_overrides(personal.get("overrides", []), self.default_duration).items():
+            grids[weekday] = grid
+            durations[weekday] = duration
+
+        return CompiledSchedule(
+            grids,
+            self.blocked_dates | parse_blocked_dates(personal),
+            self.default_duration,
+            durations
+        )
+
+
+def _compile_overrides(overrides, default_duration):
+    # Later overrides of the same day win
+    by_day = {}
+    for override in overrides or []:
+        if override.get("day") in DAY_INDEX:
+            by_day[override["day"]] = override
+
+    # weekday -> (grid, slot length)
+    grids = {}
+    for day_name, override in by_day.items():
+        duration = _valid_duration(override.get("slot_duration_minutes", default_duration), default_duration)
+        grids[DAY_INDEX[day_name]] = (
+            day_grid(
+                _minutes(override.get("start_time", DEFAULT_START_TIME)),
+                _minutes(override.get("end_time", DEFAULT_END_TIME)),
+                duration,
+                _parse_breaks(override.get("breaks", []))
+            ),
+            duration
+        )
+    return grids
+
+
+def compile_schedule(structure):
+    """
+    Compile a schedule structure:
+        {"schedule": {"default": {days, start_time, end_time,
+                                  slot_duration_minutes, breaks},
+                      "overrides": [{day, start_time, ...}],
+                      "blocked_dates": [...], "blocked_date_ranges": [...]}}
+    The "schedule" and "default" levels are optional (flat structures work).
+
+    Returns:
+        CompiledSchedule
+
+    Raises:
+        ValueError: malformed break or override times
+    """
+    schedule_data = structure.get("schedule", structure)
+    default_config = schedule_data.get("default", schedule_data)
+
+    default_days = [DAY_INDEX[d] for d in default_config.get("days", []) if d in DAY_INDEX]
+
+    try:
+        default_start = _minutes(default_config.get("start_time", DEFAULT_START_TIME))
+    except (TypeError, ValueError):
+        default_start = _minutes(DEFAULT_START_TIME)
+
+    try:
+        default_end = _minutes(default_config.get("end_time", DEFAULT_END_TIME))
+    except (TypeError, ValueError):
+        default_end = _minutes(DEFAULT_END_TIME)
+
+    default_duration = _valid_duration(default_config.get("slot_duration_minutes", DEFAULT_SLOT_MINUTES), DEFAULT_SLOT_MINUTES)
+    default_grid = day_grid(default_start, default_end, default_duration, _parse_breaks(default_config.get("breaks", [])))
+
+    grids = [()] * 7
+    durations = [default_duration] * 7
+    for weekday in default_days:
+        grids[weekday] = default_grid
+
+    for weekday, (grid, duration) in _compile_overrides(schedule_data.get("overrides", []), default_duration).items():
+        grids[weekday] = grid
+        durations[weekday] = duration
+
+    return CompiledSchedule(grids, parse_blocked_dates(schedule_data), default_duration, durations)
+
+
+def iter_slots(structure, start=None, days=HORIZON_DAYS):
+    """Compile `structure` and yield its slots (see CompiledSchedule.iter_slots)."""
+    return compile_schedule(structure).iter_slots(start, days)
@@ -0,0 +1,178 @@
+"""
+Schedule text parsing for SlotlyCare
+Turns a doctor's free-text description of their hours into a schedule
+structure (see schedule_engine.compile_schedule) with one OpenAI call.
+Shared by the FastAPI app (api/index.py) and the legacy handler
+(api/schedule.py), so both validate, prompt and cache the same way.
+
+Parsed structures are cached per (day, text): the prompt contains today's
+date, so relative dates ("next week off") are re-resolved each day. Only
+complete structures are cached, so resending a text that failed to parse
+asks the model again.
+"""
+
+import copy
+import hashlib
+import json
+import re
+from datetime import datetime
+
+from json_stream import IncrementalJSON
+import llm_gateway
+from ttl_cache import TTLCache
+
+MIN_TEXT_LENGTH = 15
+BLOCKED_KEYWORDS = ("recipe", "receita", "bolo", "cake", "poem", "poema", "story", "história", "piada", "joke")
+# Whole words (plural allowed): "story" must not reject a "history" of hours
+_BLOCKED_PATTERN = re.compile(r"\b(?:" + "|".join(map(re.escape, BLOCKED_KEYWORDS)) + r")s?\b")
+REQUIRED_KEYS = ("days", "start_time", "end_time", "slot_duration_minutes")
+
+# (date, text hash) -> structure
+PARSED = TTLCache(ttl=3600, max_entries=512)
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except ImportError:
+    _encoding = None
+
+
+def validate_schedule_text(text: str):
+    """Valida o texto de entrada para evitar abuso e garantir o mínimo de qualidade."""
+    text_lower = text.lower().strip()
+    if len(text_lower) < MIN_TEXT_LENGTH:
+        return "Schedule text is too short. Please provide more details (minimum 15 characters)."
+    
+    if estimate_tokens(text) > MAX_TEXT_TOKENS:
+        return "Schedule text is too long. Please describe only your work hours and days off."
+    
+    if _BLOCKED_PATTERN.search(text_lower):
+        return "The text does not appear to be schedule-related. Please enter only information about your work hours."
+    
+    return None
+
+
+def is_complete(structure) -> bool:
+    """Whether a parsed structure has the default day config the engine needs."""
+    if not isinstance(structure, dict):
+        return False
+    schedule_data = structure.get("schedule", structure)
+    default_config = schedule_data.get("default", schedule_data) if isinstance(schedule_data, dict) else None
+    return isinstance(default_config, dict) and all(key in default_config for key in REQUIRED_KEYS)
+
+
+# Static, so it is byte-identical on every call and the provider can cache
+# it as a prompt prefix; everything that varies (the doctor's text, today's
+# date) goes after it, in the user message. Compact JSON on purpose:
+# indentation is paid for in tokens on every call.
+SYSTEM_PROMPT = """You are a medical scheduling assistant. Extract the doctor's schedule from their text and return ONLY a JSON object:
+{"schedule":{"default":{"days":[...],"start_time":"HH:MM","end_time":"HH:MM","slot_duration_minutes":N,"breaks":[{"start":"HH:MM","end":"HH:MM"}]},"overrides":[{"day":"...","start_time":"HH:MM","end_time":"HH:MM","slot_duration_minutes":N,"breaks":[]}],"blocked_dates":["YYYY-MM-DD"],"blocked_date_ranges":[{"start":"YYYY-MM-DD","end":"YYYY-MM-DD","reason":"..."}]}}
+
+CRITICAL: ONLY include what the user EXPLICITLY mentions. NEVER add anything they didn't ask for.
+- Input may be in any language (Portuguese, Spanish, French, German, Italian, English...). ALWAYS output day names in English.
+- breaks: ONLY if the text mentions lunch/break/pause (almoço, almuerzo, intervalo, pausa...). Otherwise [].
+- slot_duration_minutes: as stated, default 30.
+- overrides: ONLY for days with DIFFERENT hours.
+- blocked_dates / blocked_date_ranges: ONLY for vacation, holidays, blocked days (férias, bloquear...). Resolve relative dates from today's date, given at the end of the user message.
+- 24h times, YYYY-MM-DD dates, empty arrays for anything not mentioned.
+
+Example: "Segunda a sexta 9h-17h. Sábado 8h-12h. Consulta de 20 minutos"
+{"schedule":{"default":{"days":["Monday","Tuesday","Wednesday","Thursday","Friday"],"start_time":"09:00","end_time":"17:00","slot_duration_minutes":20,"breaks":[]},"overrides":[{"day":"Saturday","start_time":"08:00","end_time":"12:00","slot_duration_minutes":20,"breaks":[]}],"blocked_dates":[],"blocked_date_ranges":[]}}
+
+Example: "Monday to Friday 8am-6pm, lunch 12pm-1pm. Vacation Dec 20 to Jan 5"
+{"schedule":{"default":{"days":["Monday","Tuesday","Wednesday","Thursday","Friday"],"start_time":"08:00","end_time":"18:00","slot_duration_minutes":30,"breaks":[{"start":"12:00","end":"13:00"}]},"overrides":[],"blocked_dates":[],"blocked_date_ranges":[{"start":"2026-12-20","end":"2027-01-05","reason":"vacation"}]}}"""
+
+# Input budget: the static prompt plus at most MAX_TEXT_TOKENS of doctor text
+MAX_TEXT_TOKENS = 600
+# The structure is small; a cap keeps a runaway completion from using the deadline
+MAX_COMPLETION_TOKENS = 800
+
+
+def estimate_tokens(text: str) -> int:
+    """Token count of `text` (exact with tiktoken installed, else ~4 chars per token)."""
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    return (len(text) + 3) // 4
+
+
+def build_messages(text: str, today) -> list:
+    """Static system prompt first, then the doctor's text and today's date."""
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": f"{text.strip()}\n\nToday is {today.strftime('%Y-%m-%d')} ({today.strftime('%A')})."}
+    ]
+
+
+# Lower temperature for more consistent/literal responses
+COMPLETION_PARAMS = {
+    "response_format": {"type": "json_object"},
+    "temperature": 0.1,
+    "max_tokens": MAX_COMPLETION_TOKENS
+}
+
+
+def _cache_key(text: str, today) -> tuple:
+    normalized = " ".join(text.split()).lower()
+    return (today.isoformat(), hashlib.sha256(normalized.encode('utf-8')).hexdigest())
+
+
+def _default_config(structure: dict) -> dict:
+    schedule_data = structure.get("schedule", structure)
+    return schedule_data.get("default", schedule_data)
+
+
+def _request_structure(text: str, today) -> dict:
+    # Deadline, retries and fallback model: see llm_gateway
+    response = llm_gateway.chat(build_messages(text, today), **COMPLETION_PARAMS)
+    return json.loads(response.choices[0].message.content)
+
+
+def parse_schedule(text: str) -> dict:
+    """
+    Chama a API da OpenAI para extrair uma estrutura FLEXÍVEL de horários.
+    Identical texts on the same day share one call.
+
+    Returns:
+        dict: Schedule structure (a copy, callers may modify it)
+
+    Raises:
+        llm_gateway.LLMUnavailable: OpenAI did not answer within the deadline
+    """
+    today = datetime.now().date()
+    structure = PARSED.get_or_load(
+        _cache_key(text, today), lambda: _request_structure(text, today), cache_if=is_complete
+    )
+    return copy.deepcopy(structure)
+
+
+def stream_schedule(text: str):
+    """
+    parse_schedule() for streamed completions. Yields, in order:
+        ('default', config)       as soon as schedule.default is complete (if any)
+        ('schedule', structure)   once the whole structure is complete
+    A cached structure is yielded at once, without calling OpenAI.
+
+    Raises:
+        llm_gateway.LLMUnavailable: OpenAI did not answer (or stalled) within the deadline
+    """
+    today = datetime.now().date()
+    key = _cache_key(text, today)
+
+    structure = PARSED.get(key)
+    if structure is None:
+        parser = IncrementalJSON()
+        sent_default = False
+        for delta in llm_gateway.stream_chat(build_messages(text, today), **COMPLETION_PARAMS):
+            for path, value in parser.feed(delta):
+                if path == ("schedule", "default"):
+                    sent_default = True
+                    yield "default", copy.deepcopy(value)
+        structure = parser.result()
+        if is_complete(structure):
+            PARSED.set(key, structure)
+        if not sent_default and is_complete(structure):
+            yield "default", copy.deepcopy(_default_config(structure))
+    elif is_complete(structure):
+        yield "default", copy.deepcopy(_default_config(structure))
+
+    yield "schedule", copy.deepcopy(structure)
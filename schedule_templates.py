@@ -0,0 +1,93 @@
+"""
+Schedule templates for SlotlyCare
+Many doctors work the same week (e.g. Mon-Fri 9-18, 30-minute slots).
+A template stores that structure once, in immutable versions; a doctor
+references (template, version) plus personal overrides and blocked dates.
+
+Each template version is compiled to its weekday grid once per instance
+and shared by every doctor using it, so onboarding from a template needs
+no OpenAI call and expansion only applies the doctor's overrides on top.
+"""
+
+from schedule_engine import compile_schedule
+from ttl_cache import TTLCache
+
+# (id, version) -> (template row, CompiledSchedule). Versions never change.
+COMPILED = TTLCache(ttl=86400, negative_ttl=30, max_entries=256)
+# id -> latest version; a new version is picked up within a minute
+LATEST_VERSIONS = TTLCache(ttl=60, negative_ttl=30, max_entries=256)
+LISTING = TTLCache(ttl=60, max_entries=1)
+
+
+def _compile(row):
+    return row, compile_schedule(row['structure'])
+
+
+def _load_latest_version(sheets, template_id):
+    row = sheets.get_schedule_template(template_id)
+    if row is None:
+        return None
+    COMPILED.set((template_id, row['version']), _compile(row))
+    return row['version']
+
+
+def _load_version(sheets, template_id, version):
+    row = sheets.get_schedule_template(template_id, version)
+    return _compile(row) if row else None
+
+
+def get_compiled(sheets, template_id, version=None):
+    """
+    A template version and its compiled schedule.
+
+    Args:
+        template_id (str): Template identifier
+        version (int): Version, or None for the latest
+
+    Returns:
+        tuple: (template row, CompiledSchedule), or None if not found
+    """
+    if version is None:
+        version = LATEST_VERSIONS.get_or_load(template_id, lambda: _load_latest_version(sheets, template_id))
+        if version is None:
+            return None
+
+    return COMPILED.get_or_load((template_id, version), lambda: _load_version(sheets, template_id, version))
+
+
+def list_templates(sheets):
+    """Latest version of every template (id, version, name, structure)."""
+    return LISTING.get_or_load('all', sheets.list_schedule_templates)
+
+
+def create_version(sheets, template_id, name, structure):
+    """
+    Store a new template version. The structure is compiled first, so a
+    malformed one is rejected (ValueError) before it is stored.
+
+    Returns:
+        dict: Success status and the new version
+    """
+    compile_schedule(structure)
+
+    result = sheets.create_schedule_template_version(template_id, name, structure)
+    if result['success']:
+        LATEST_VERSIONS.invalidate(template_id)
+        LISTING.clear()
+    return result
+
+
+def expand(sheets, template_id, version=None, personal=None):
+    """
+    A doctor's compiled schedule: the template with their personal
+    overrides and blocked dates on top.
+
+    Returns:
+        tuple: (template row, CompiledSchedule), or None if the template is not found
+    """
+    entry = get_compiled(sheets, template_id, version)
+    if entry is None:
+        return None
+
+    template, compiled = entry
+    return template, compiled.with_overrides(personal)
@@ -0,0 +1,106 @@
+"""
+Slot payload helpers for SlotlyCare
+Slot arrays are the largest bodies the API reads and writes (a 180-day
+schedule is thousands of slots). They are validated in one pass over the
+plain parsed dicts, without a model instance per slot, and serialised with
+orjson. benchmarks/slot_payloads.py measures both paths.
+"""
+
+import re
+from datetime import date as Date
+
+import orjson
+
+from slotset import STATUSES
+
+_TIME = re.compile(r'(?:[01]\d|2[0-3]):[0-5]\d(?::[0-5]\d)?')
+
+
+class SlotPayloadError(ValueError):
+    """A slots array that does not have the expected shape."""
+
+
+def is_date(value):
+    """
+    Whether value is a calendar date written exactly as YYYY-MM-DD (the
+    stored form, compared as text by range filters). Other ISO 8601 forms
+    that fromisoformat accepts, e.g. week dates, are rejected.
+    """
+    try:
+        return Date.fromisoformat(value).isoformat() == value
+    except ValueError:
+        return False
+
+
+def normalize_slot(date, time):
+    """
+    A single slot reference in its stored form.
+
+    Args:
+        date (str): 'YYYY-MM-DD'
+        time (str): 'HH:MM' or 'HH:MM:SS'
+
+    Returns:
+        tuple: ('YYYY-MM-DD', 'HH:MM')
+
+    Raises:
+        SlotPayloadError: if either is in another form
+    """
+    if type(date) is not str or not is_date(date):
+        raise SlotPayloadError("date must be YYYY-MM-DD")
+    if type(time) is not str or not _TIME.fullmatch(time):
+        raise SlotPayloadError("time must be HH:MM")
+    return date, time[:5]
+
+
+def parse_slots(raw):
+    """
+    Validate a slots array from a request body.
+
+    Args:
+        raw (list): Parsed JSON array of {"date", "time", "status"?} objects
+
+    Returns:
+        list: Slot dicts with date, time and status (default "available")
+
+    Raises:
+        SlotPayloadError: on the first malformed element (shape, date
+                          'YYYY-MM-DD', time 'HH:MM[:SS]', unknown status)
+    """
+    if raw is None:
+        return []
+    if not isinstance(raw, list):
+        raise SlotPayloadError("slots must be a list")
+
+    slots = []
+    append = slots.append
+    valid_dates = set()
+    for index, item in enumerate(raw):
+        try:
+            date = item['date']
+            time = item['time']
+            status = item.get('status', 'available')
+        except (TypeError, KeyError, AttributeError):
+            raise SlotPayloadError(f"slots[{index}] must be an object with date and time")
+
+        if type(date) is not str or type(time) is not str or type(status) is not str:
+            raise SlotPayloadError(f"slots[{index}]: date, time and status must be strings")
+
+        # A schedule repeats few dates: each is parsed once
+        if date not in valid_dates:
+            if not is_date(date):
+                raise SlotPayloadError(f"slots[{index}]: date must be YYYY-MM-DD")
+            valid_dates.add(date)
+        if not _TIME.fullmatch(time):
+            raise SlotPayloadError(f"slots[{index}]: time must be HH:MM")
+        if status not in STATUSES:
+            raise SlotPayloadError(f"slots[{index}]: status must be one of {', '.join(STATUSES)}")
+
+        append({'date': date, 'time': time, 'status': status})
+
+    return slots
+
+
+def dumps(obj):
+    """Serialise to JSON bytes with orjson."""
+    return orjson.dumps(obj)
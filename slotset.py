@@ -0,0 +1,216 @@
+"""
+Compact slot sets for SlotlyCare
+A SlotSet holds slots as two parallel typed arrays instead of a list of
+{"date": "YYYY-MM-DD", "time": "HH:MM", "status": ...} dicts:
+
+- keys:     array('q'), day ordinal * 1440 + minute of day, sorted and unique
+- statuses: array('B'), index into STATUSES
+
+That is 9 bytes per slot instead of a few hundred, and sorted keys make
+range filters a bisect + slice and set operations a linear merge.
+Conversion to the wire format is lazy (iter_slots / to_slots).
+"""
+
+from array import array
+from bisect import bisect_left
+from datetime import date as Date
+from itertools import compress
+
+MINUTES_PER_DAY = 1440
+
+STATUSES = ('available', 'booked', 'blocked')
+STATUS_CODES = {status: code for code, status in enumerate(STATUSES)}
+
+
+def slot_key(date_str, time_str):
+    """Key of a 'YYYY-MM-DD' / 'HH:MM[:SS]' pair."""
+    ordinal = Date.fromisoformat(date_str[:10]).toordinal()
+    return ordinal * MINUTES_PER_DAY + int(time_str[:2]) * 60 + int(time_str[3:5])
+
+
+def status_code(status):
+    try:
+        return STATUS_CODES[status]
+    except KeyError:
+        raise ValueError(f"Unknown slot status: {status!r}")
+
+
+class SlotSet:
+    """
+    Immutable, sorted set of slots keyed by (date, time), each with a status.
+
+    Usage:
+        current = SlotSet.from_slots(rows)
+        wanted = SlotSet.from_slots(payload)
+        removed, added, changed = current.changes(wanted)
+        available = wanted.between('2026-01-01', '2026-01-31').with_status('available')
+    """
+
+    __slots__ = ('keys', 'statuses')
+
+    def __init__(self, keys=None, statuses=None):
+        self.keys = keys if keys is not None else array('q')
+        self.statuses = statuses if statuses is not None else array('B')
+
+    @classmethod
+    def from_slots(cls, slots, unknown_status=None):
+        """
+        Build from slot dicts (date, time, status). A later slot with the
+        same date and time replaces an earlier one.
+
+        An unknown status raises ValueError, unless `unknown_status` is
+        given: rows loaded from the database are mapped to it instead, so
+        one unexpected row cannot break every read and save of a doctor.
+        """
+        fallback = status_code(unknown_status) if unknown_status is not None else None
+        ordinals = {}
+        by_key = {}
+        for slot in slots:
+            date_str = slot['date']
+            ordinal = ordinals.get(date_str)
+            if ordinal is None:
+                ordinal = ordinals[date_str] = Date.fromisoformat(date_str[:10]).toordinal()
+            time_str = slot['time']
+            key = ordinal * MINUTES_PER_DAY + int(time_str[:2]) * 60 + int(time_str[3:5])
+            status = slot.get('status', 'available')
+            code = STATUS_CODES.get(status, fallback)
+            by_key[key] = code if code is not None else status_code(status)
+
+        keys = sorted(by_key)
+        return cls(array('q', keys), array('B', [by_key[k] for k in keys]))
+
+    # ---- size and lookup ----
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __bool__(self):
+        return len(self.keys) > 0
+
+    def __eq__(self, other):
+        if not isinstance(other, SlotSet):
+            return NotImplemented
+        return self.keys == other.keys and self.statuses == other.statuses
+
+    def _index(self, key):
+        i = bisect_left(self.keys, key)
+        return i if i < len(self.keys) and self.keys[i] == key else -1
+
+    def __contains__(self, slot):
+        """`(date, time) in slot_set`"""
+        return self._index(slot_key(*slot)) >= 0
+
+    def status_of(self, date_str, time_str):
+        """Status of a slot, None if the set does not contain it."""
+        i = self._index(slot_key(date_str, time_str))
+        return STATUSES[self.statuses[i]] if i >= 0 else None
+
+    def first_from(self, date_str, time_str):
+        """First slot at or after (date, time) as a slot dict, None if there is none."""
+        i = bisect_left(self.keys, slot_key(date_str, time_str))
+        if i == len(self.keys):
+            return None
+        return next(SlotSet(self.keys[i:i + 1], self.statuses[i:i + 1]).iter_slots())
+
+    # ---- filters ----
+
+    def between(self, start_date=None, end_date=None):
+        """Slots from start_date to end_date inclusive ('YYYY-MM-DD', either may be None)."""
+        lo = 0
+        hi = len(self.keys)
+        if start_date:
+            lo = bisect_left(self.keys, Date.fromisoformat(start_date).toordinal() * MINUTES_PER_DAY)
+        if end_date:
+            hi = bisect_left(self.keys, (Date.fromisoformat(end_date).toordinal() + 1) * MINUTES_PER_DAY)
+        return SlotSet(self.keys[lo:hi], self.statuses[lo:hi])
+
+    def with_status(self, *statuses):
+        """Slots whose status is one of `statuses`."""
+        codes = {status_code(s) for s in statuses}
+        mask = [code in codes for code in self.statuses]
+        return SlotSet(array('q', compress(self.keys, mask)), array('B', compress(self.statuses, mask)))
+
+    # ---- set operations ----
+
+    def union(self, other):
+        """Slots in either set; on a clash the status from `other` wins."""
+        keys = array('q')
+        statuses = array('B')
+        a, b = self.keys, other.keys
+        i = j = 0
+        while i < len(a) and j < len(b):
+            if a[i] < b[j]:
+                keys.append(a[i])
+                statuses.append(self.statuses[i])
+                i += 1
+            else:
+                if a[i] == b[j]:
+                    i += 1
+                keys.append(b[j])
+                statuses.append(other.statuses[j])
+                j += 1
+        keys.extend(a[i:])
+        statuses.extend(self.statuses[i:])
+        keys.extend(b[j:])
+        statuses.extend(other.statuses[j:])
+        return SlotSet(keys, statuses)
+
+    def difference(self, other):
+        """Slots of this set whose date and time are not in `other`."""
+        other_keys = set(other.keys)
+        mask = [key not in other_keys for key in self.keys]
+        return SlotSet(array('q', compress(self.keys, mask)), array('B', compress(self.statuses, mask)))
+
+    def changes(self, target):
+        """
+        What turns this set into `target`.
+
+        Returns:
+            tuple: (removed, added, changed) SlotSets; `changed` holds the
+                   slots present in both whose status differs, with the
+                   status from `target`
+        """
+        current = dict(zip(self.keys, self.statuses))
+        removed = self.difference(target)
+
+        added_mask = []
+        changed_mask = []
+        for key, code in zip(target.keys, target.statuses):
+            previous = current.get(key)
+            added_mask.append(previous is None)
+            changed_mask.append(previous is not None and previous != code)
+
+        added = SlotSet(array('q', compress(target.keys, added_mask)), array('B', compress(target.statuses, added_mask)))
+        changed = SlotSet(array('q', compress(target.keys, changed_mask)), array('B', compress(target.statuses, changed_mask)))
+        return removed, added, changed
+
+    # ---- wire format ----
+
+    def dates(self):
+        """Distinct 'YYYY-MM-DD' dates, in order."""
+        ordinals = sorted({key // MINUTES_PER_DAY for key in self.keys})
+        return [Date.fromordinal(o).isoformat() for o in ordinals]
+
+    def iter_slots(self):
+        """Yield slot dicts (date, time, status) in date/time order."""
+        last_ordinal = None
+        date_str = None
+        for key, code in zip(self.keys, self.statuses):
+            ordinal, minute = divmod(key, MINUTES_PER_DAY)
+            if ordinal != last_ordinal:
+                last_ordinal = ordinal
+                date_str = Date.fromordinal(ordinal).isoformat()
+            yield {
+                'date': date_str,
+                'time': f"{minute // 60:02d}:{minute % 60:02d}",
+                'status': STATUSES[code]
+            }
+
+    def to_slots(self):
+        return list(self.iter_slots())
+
+    def __iter__(self):
+        return self.iter_slots()
+
+    def __repr__(self):
+        return f"SlotSet({len(self)} slots)"
@@ -0,0 +1,97 @@
+"""
+Stripe catalog lookups for SlotlyCare
+Caches promotion-code and price lookups so that checkout does not pay a
+Stripe round trip per request, and invalidates them from webhook events.
+
+The cache is per instance: the webhook only invalidates the instance that
+receives it, other instances pick up changes when their TTL runs out.
+"""
+
+import stripe
+
+from instrumentation import track
+from ttl_cache import TTLCache
+
+# Promotion codes and prices change rarely; refresh in the background
+# after 10 minutes and never serve anything older than an hour.
+PROMOTION_CODES = TTLCache(ttl=3600, refresh_after=600, negative_ttl=60)
+PRICES = TTLCache(ttl=3600, refresh_after=600, negative_ttl=60)
+
+PROMOTION_CODE_EVENTS = (
+    'promotion_code.created',
+    'promotion_code.updated',
+    'coupon.updated',
+    'coupon.deleted',
+)
+PRICE_EVENTS = (
+    'price.created',
+    'price.updated',
+    'price.deleted',
+)
+
+
+def _load_promotion_code_id(code):
+    with track('stripe', 'PromotionCode', 'list'):
+        promo_list = stripe.PromotionCode.list(code=code, limit=1, active=True)
+    return promo_list.data[0].id if promo_list.data else None
+
+
+def get_promotion_code_id(code):
+    """
+    Resolve a human-readable coupon code (e.g. "CIOSP2026") to its
+    active promotion_code ID.
+
+    Returns:
+        str: promotion_code ID, or None if not found / inactive
+    """
+    return PROMOTION_CODES.get_or_load(code, lambda: _load_promotion_code_id(code))
+
+
+def _load_price(price_id):
+    try:
+        with track('stripe', 'Price', 'retrieve'):
+            price = stripe.Price.retrieve(price_id)
+    except stripe.error.InvalidRequestError:
+        return None
+    return {
+        'id': price.id,
+        'active': price.active,
+        'currency': price.currency,
+        'unit_amount': price.unit_amount,
+        'product': price.product,
+        'metadata': dict(price.metadata or {})
+    }
+
+
+def get_price(price_id):
+    """
+    Get price metadata (amount, currency, active flag) for a price ID.
+
+    Returns:
+        dict: Price data, or None if the price does not exist
+    """
+    return PRICES.get_or_load(price_id, lambda: _load_price(price_id))
+
+
+def handle_catalog_event(event):
+    """
+    Invalidate cached lookups affected by a Stripe webhook event.
+
+    Returns:
+        bool: True if the event touched the catalog cache
+    """
+    event_type = event['type']
+
+    if event_type in PROMOTION_CODE_EVENTS:
+        # Coupon changes affect every promotion code built on them, and
+        # promotion-code lookups are keyed by code, not ID: drop them all.
+        PROMOTION_CODES.clear()
+        return True
+
+    if event_type in PRICE_EVENTS:
+        price_id = event['data']['object'].get('id')
+        if price_id:
+            PRICES.invalidate(price_id)
+        return True
+
+    return False
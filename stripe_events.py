@@ -0,0 +1,150 @@
+"""
+Stripe webhook event processing for SlotlyCare
+The webhook only verifies, persists and acknowledges events; this worker
+processes the queued events afterwards:
+
+- deduplicated by event ID (the queue row is keyed by it)
+- in Stripe creation order per customer: a customer's later events wait
+  until the earlier ones are done
+- retried with jittered exponential backoff, parked as 'dead' after
+  MAX_ATTEMPTS
+"""
+
+import random
+from datetime import datetime, timedelta
+
+import stripe
+
+from instrumentation import track
+import subscription_state
+
+MAX_ATTEMPTS = 8
+BASE_BACKOFF_SECONDS = 30
+MAX_BACKOFF_SECONDS = 6 * 3600
+# A 'processing' row older than this belongs to a worker that died
+STALE_LOCK_SECONDS = 300
+
+
+def event_customer_id(event):
+    """Customer an event belongs to, used as the ordering key."""
+    obj = event['data']['object']
+    if obj.get('object') == 'customer':
+        return obj.get('id') or ''
+    return obj.get('customer') or ''
+
+
+def backoff_seconds(attempts):
+    """Delay before retry number `attempts` (1-based), with +/-50% jitter."""
+    delay = min(BASE_BACKOFF_SECONDS * (2 ** (attempts - 1)), MAX_BACKOFF_SECONDS)
+    return delay * random.uniform(0.5, 1.5)
+
+
+# ==================== HANDLERS ====================
+
+def handle_checkout_completed(sheets, event):
+    """
+    Save the paid checkout to pending_accounts (recovery safety net).
+    Creates the Stripe customer for Payment Link sessions that have none.
+    """
+    session = event['data']['object']
+
+    customer_id = session.get('customer')
+    customer_email = None
+    if session.get('customer_details'):
+        customer_email = session['customer_details'].get('email')
+
+    metadata = session.get('metadata', {}) or {}
+    partner_source = metadata.get('partner_coupon')
+    plan_years = int(metadata.get('plan_years', 3))
+    amount_total = session.get('amount_total')
+
+    # If no customer was created (Payment Link flow), create one.
+    # The idempotency key keeps retries from creating duplicates.
+    if not customer_id and session.get('payment_status') == 'paid' and customer_email:
+        with track('stripe', 'Customer', 'create'):
+            new_customer = stripe.Customer.create(
+                email=customer_email,
+                metadata={"source": "webhook", "session_id": session.get('id', '')},
+                idempotency_key=f"webhook-customer-{session.get('id', '')}"
+            )
+        customer_id = new_customer.id
+
+    result = sheets.save_pending_account({
+        'session_id': session.get('id', ''),
+        'customer_id': customer_id or '',
+        'customer_email': customer_email or '',
+        'partner_source': partner_source,
+        'plan_years': plan_years,
+        'payment_status': session.get('payment_status', ''),
+        'amount_total': amount_total
+    })
+
+    if not result['success']:
+        raise RuntimeError(result.get('error', 'Failed to save pending account'))
+
+
+def process_event(sheets, event):
+    """Run every handler that applies to this event."""
+    subscription_state.project_event(sheets, event)
+
+    if event['type'] == 'checkout.session.completed':
+        handle_checkout_completed(sheets, event)
+
+
+# ==================== WORKER ====================
+
+def process_pending(sheets, limit=100):
+    """
+    Process queued Stripe events that are due.
+
+    Args:
+        sheets (SheetsClient): Data layer
+        limit (int): Maximum number of queued events to look at
+
+    Returns:
+        dict: Counts of processed, failed and deferred events
+    """
+    now = datetime.utcnow()
+    stale_before = (now - timedelta(seconds=STALE_LOCK_SECONDS)).isoformat()
+
+    processed = 0
+    failed = 0
+    deferred = 0
+    # Customers whose chain is blocked by an earlier unfinished event
+    blocked = set()
+
+    for row in sheets.get_unfinished_stripe_events(limit):
+        key = row.get('customer_id') or row['id']
+
+        if key in blocked:
+            deferred += 1
+            continue
+
+        next_attempt_at = row.get('next_attempt_at')
+        if next_attempt_at and datetime.fromisoformat(next_attempt_at.replace('Z', '+00:00')).replace(tzinfo=None) > now:
+            # Earlier event is waiting for its retry: keep the order
+            blocked.add(key)
+            deferred += 1
+            continue
+
+        if not sheets.claim_queued_stripe_event(row['id'], stale_before):
+            # Another worker has it
+            blocked.add(key)
+            deferred += 1
+            continue
+
+        try:
+            process_event(sheets, row['payload'])
+            sheets.complete_stripe_event(row['id'])
+            processed += 1
+        except Exception as e:
+            attempts = (row.get('attempts') or 0) + 1
+            dead = attempts >= MAX_ATTEMPTS
+            retry_at = datetime.utcnow() + timedelta(seconds=backoff_seconds(attempts))
+            print(f"Stripe event {row['id']} ({row['type']}) failed, attempt {attempts}: {e}")
+            sheets.fail_stripe_event(row['id'], attempts, retry_at.isoformat(), str(e), dead=dead)
+            failed += 1
+            if not dead:
+                blocked.add(key)
+
+    return {'processed': processed, 'failed': failed, 'deferred': deferred}
@@ -0,0 +1,134 @@
+"""
+Subscription state projection for SlotlyCare
+Projects Stripe subscription and payment events into the local
+`subscriptions` table so /api/verify-subscription can answer with one
+indexed read instead of a live Stripe call.
+"""
+
+import time
+from datetime import datetime, timezone
+
+import stripe
+
+from instrumentation import track
+
+SUBSCRIPTION_EVENTS = (
+    'customer.subscription.created',
+    'customer.subscription.updated',
+    'customer.subscription.deleted',
+)
+
+# Preference order when a customer has several subscriptions
+_STATUS_RANK = {'active': 0, 'trialing': 1, 'past_due': 2, 'unpaid': 3, 'incomplete': 4}
+
+
+def _timestamp(value):
+    if not value:
+        return None
+    return datetime.fromtimestamp(value, tz=timezone.utc).isoformat()
+
+
+def _subscription_state(subscription):
+    return {
+        'subscription_id': subscription.get('id'),
+        'status': subscription.get('status'),
+        'current_period_end': _timestamp(subscription.get('current_period_end'))
+    }
+
+
+def project_event(sheets, event):
+    """
+    Apply a Stripe event to the subscription projection.
+
+    Args:
+        sheets (SheetsClient): Data layer
+        event (dict): Verified Stripe event
+
+    Returns:
+        bool: True if the event type is relevant to the projection
+    """
+    event_type = event['type']
+    obj = event['data']['object']
+
+    if event_type in SUBSCRIPTION_EVENTS:
+        customer_id = obj.get('customer')
+        state = _subscription_state(obj)
+    elif event_type == 'checkout.session.completed':
+        customer_id = obj.get('customer')
+        state = {'payment_status': obj.get('payment_status')}
+    elif event_type in ('invoice.paid', 'invoice.payment_failed'):
+        customer_id = obj.get('customer')
+        state = {'payment_status': 'paid' if event_type == 'invoice.paid' else 'failed'}
+    else:
+        return False
+
+    if not customer_id:
+        return True
+
+    result = sheets.apply_subscription_state(customer_id, state, event['id'], event['created'])
+    if not result['success']:
+        raise RuntimeError(result.get('error', 'Failed to project subscription state'))
+
+    return True
+
+
+def _pick_subscription(subscriptions):
+    """Most relevant subscription: best status first, then most recent."""
+    return min(
+        subscriptions,
+        key=lambda s: (_STATUS_RANK.get(s.get('status'), 99), -(s.get('created') or 0))
+    )
+
+
+def refresh_customer(sheets, customer_id):
+    """
+    Read a customer's subscriptions live from Stripe and project them.
+    Used on a projection miss (customers that predate the webhook projection).
+
+    Returns:
+        dict: The projected state
+    """
+    with track('stripe', 'Subscription', 'list'):
+        subscriptions = stripe.Subscription.list(customer=customer_id, status='all', limit=10)
+
+    if subscriptions.data:
+        state = _subscription_state(_pick_subscription(subscriptions.data))
+    else:
+        state = {'status': 'none'}
+
+    sheets.apply_subscription_state(customer_id, state, 'reconcile', int(time.time()))
+
+    state['active'] = state.get('status') == 'active'
+    return state
+
+
+def reconcile_subscriptions(sheets):
+    """
+    Re-project every Stripe subscription, repairing state from missed
+    or failed webhook deliveries. Run periodically by the cron endpoint.
+
+    Returns:
+        dict: Number of customers reconciled and failures
+    """
+    started = int(time.time())
+    by_customer = {}
+
+    with track('stripe', 'Subscription', 'list'):
+        for subscription in stripe.Subscription.list(status='all', limit=100).auto_paging_iter():
+            customer_id = subscription.get('customer')
+            if customer_id:
+                by_customer.setdefault(customer_id, []).append(subscription)
+
+    reconciled = 0
+    failed = 0
+    for customer_id, subscriptions in by_customer.items():
+        state = _subscription_state(_pick_subscription(subscriptions))
+        # Stamped with the listing start time so that events delivered
+        # while the job runs are not overwritten by the snapshot
+        result = sheets.apply_subscription_state(customer_id, state, 'reconcile', started)
+        if result['success']:
+            reconciled += 1
+        else:
+            failed += 1
+
+    return {'reconciled': reconciled, 'failed': failed}
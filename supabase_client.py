@@ -4,9 +4,135 @@ Handles all interactions with Supabase database
 Drop-in replacement for sheets_client.py
 """
 
-from supabase import create_client, Client
+from supabase import create_client
 import os
-from datetime import datetime
+from dataclasses import dataclass, field, fields as dataclass_fields
+from datetime import datetime, timedelta, timezone
+from instrumentation import InstrumentedSupabase
+from slotset import SlotSet, STATUSES
+
+# Trial accounts (customer_id 'trial_xxx') expire this many days after signup
+TRIAL_DAYS = 7
+
+# Rows per page when reading availability (PostgREST caps responses at 1000)
+AVAILABILITY_PAGE_SIZE = 1000
+
+# save_availability rewrites everything instead of diffing past this many changed days
+AVAILABILITY_DIFF_MAX_DAYS = 14
+
+
+@dataclass(frozen=True)
+class DoctorRecord:
+    """
+    Doctor row as returned by the data layer.
+    Supports doctor['name'] and doctor.get('name') like the dicts it replaces.
+    When loaded with a column projection, fields that were not selected are
+    missing like dict keys: doctor['x'] raises KeyError instead of passing
+    off the default as data, doctor.get('x', default) returns `default`,
+    and to_dict() holds only the selected fields.
+    """
+    id: str = ''
+    name: str = ''
+    specialty: str = ''
+    address: str = ''
+    phone: str = ''
+    email: str = ''
+    logo_url: str = ''
+    color: str = '#3B82F6'
+    language: str = 'en'
+    welcome_message: str = ''
+    additional_info: str = ''
+    link: str = ''
+    customer_id: str = ''
+    created_at: str = ''
+    partner_source: str = None
+    plan_years: int = 3
+    referral_unlocked: bool = False
+    expires_at: str = None
+    trial_expired: bool = False
+    schedule_template_id: str = None
+    schedule_template_version: int = None
+    schedule_overrides: dict = None
+    schedule_text: str = None
+    schedule_structure: dict = None
+    # Fields loaded from the row (None: all of them)
+    _selected: frozenset = field(default=None, compare=False, repr=False)
+
+    @classmethod
+    def from_row(cls, row):
+        values = {name: row[name] for name in DOCTOR_FIELDS if name in row}
+        return cls(**values, _selected=frozenset(values))
+
+    def _is_selected(self, key):
+        return self._selected is None or key in self._selected
+
+    def get(self, key, default=None):
+        if key not in DOCTOR_FIELDS or not self._is_selected(key):
+            return default
+        return getattr(self, key)
+
+    def __getitem__(self, key):
+        if key not in DOCTOR_FIELDS:
+            raise KeyError(key)
+        if not self._is_selected(key):
+            raise KeyError(f"Doctor field {key!r} was not selected (add it to fields=[...])")
+        return getattr(self, key)
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in DOCTOR_FIELDS if self._is_selected(name)}
+
+
+DOCTOR_FIELDS = tuple(f.name for f in dataclass_fields(DoctorRecord) if f.name != '_selected')
+
+# Selected when no projection is given (and so returned by /api/get-doctor):
+# the schedule source columns are internal and only read when asked for
+DEFAULT_DOCTOR_FIELDS = tuple(name for name in DOCTOR_FIELDS if not name.startswith('schedule_'))
+
+
+def doctor_columns(fields=None):
+    """Column list for a doctors select, restricted to DoctorRecord fields."""
+    if not fields:
+        return ', '.join(DEFAULT_DOCTOR_FIELDS)
+    unknown = set(fields) - set(DOCTOR_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown doctor fields: {sorted(unknown)}")
+    return ', '.join(fields)
+
+
+def trial_expires_at(created_at):
+    """Trial end: TRIAL_DAYS after the start of the (UTC) signup day."""
+    start_of_day = created_at.astimezone(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    return start_of_day + timedelta(days=TRIAL_DAYS)
+
+
+def _today_and_now():
+    """Current ('YYYY-MM-DD', 'HH:MM'), on the same clock as slot generation."""
+    now = datetime.now()
+    return now.strftime('%Y-%m-%d'), now.strftime('%H:%M')
+
+
+def _times_by_date(slot_set):
+    """{'YYYY-MM-DD': ['HH:MM', ...]} for grouped per-day queries."""
+    grouped = {}
+    for slot in slot_set.iter_slots():
+        grouped.setdefault(slot['date'], []).append(slot['time'])
+    return grouped
+
+
+def appointment_from_row(row):
+    """Wire format of an appointments row."""
+    return {
+        'id': str(row['id']),
+        'doctor_id': row['doctor_id'],
+        'patient_name': row['patient_name'],
+        'patient_email': row.get('patient_email', ''),
+        'patient_phone': row.get('patient_phone', ''),
+        'date': str(row['date']),
+        'time': str(row['time']),
+        'notes': row.get('notes', ''),
+        'created_at': row.get('created_at', '')
+    }
+
 
 class SheetsClient:
     """
@@ -26,8 +152,8 @@ class SheetsClient:
         if not supabase_key:
             raise ValueError("SUPABASE_KEY environment variable not set")
         
-        # Create Supabase client
-        self.supabase: Client = create_client(supabase_url, supabase_key)
+        # Create Supabase client (every query is timed per table/operation)
+        self.supabase = InstrumentedSupabase(create_client(supabase_url, supabase_key))
     
     # ==================== DOCTORS METHODS ====================
     
@@ -43,7 +169,7 @@ class SheetsClient:
         """
         try:
             # Check if doctor already exists
-            existing = self.get_doctor(doctor_data['id'])
+            existing = self.get_doctor(doctor_data['id'], fields=['customer_id', 'partner_source', 'plan_years'])
             
             # Prepare data for Supabase
             db_data = {
@@ -65,6 +191,12 @@ class SheetsClient:
                 'updated_at': datetime.now().isoformat()
             }
             
+            # Schedule source (template reference or text), only when the caller sets it
+            for key in ('schedule_template_id', 'schedule_template_version', 'schedule_overrides',
+                        'schedule_text', 'schedule_structure'):
+                if key in doctor_data:
+                    db_data[key] = doctor_data[key]
+            
             if existing:
                 # Update existing doctor
                 self.supabase.table('doctors').update(db_data).eq('id', doctor_data['id']).execute()
@@ -77,6 +209,8 @@ class SheetsClient:
             else:
                 # Insert new doctor
                 db_data['created_at'] = datetime.now().isoformat()
+                if db_data['customer_id'].startswith('trial_'):
+                    db_data['expires_at'] = trial_expires_at(datetime.now(timezone.utc)).isoformat()
                 self.supabase.table('doctors').insert(db_data).execute()
                 
                 return {
@@ -91,40 +225,27 @@ class SheetsClient:
                 'error': str(e)
             }
     
-    def get_doctor(self, doctor_id):
+    def get_doctor(self, doctor_id, fields=None):
         """
         Get doctor data by ID
         
         Args:
             doctor_id (str): Doctor unique identifier
+            fields (list): Optional column projection (e.g. ['name', 'language'])
         
         Returns:
-            dict: Doctor data or None if not found
+            DoctorRecord: Doctor data or None if not found
+        
+        Raises:
+            ValueError: if `fields` names a column DoctorRecord does not have
         """
+        # Outside the try: an unknown field is a bug, not "doctor not found"
+        columns = doctor_columns(fields)
         try:
-            result = self.supabase.table('doctors').select('*').eq('id', doctor_id).execute()
+            result = self.supabase.table('doctors').select(columns).eq('id', doctor_id).limit(1).execute()
             
             if result.data and len(result.data) > 0:
-                row = result.data[0]
-                return {
-                    'id': row['id'],
-                    'name': row['name'],
-                    'specialty': row.get('specialty', ''),
-                    'address': row.get('address', ''),
-                    'phone': row.get('phone', ''),
-                    'email': row.get('email', ''),
-                    'logo_url': row.get('logo_url', ''),
-                    'color': row.get('color', '#3B82F6'),
-                    'language': row.get('language', 'en'),
-                    'welcome_message': row.get('welcome_message', ''),
-                    'additional_info': row.get('additional_info', ''),
-                    'link': row.get('link', ''),
-                    'customer_id': row.get('customer_id', ''),
-                    'created_at': row.get('created_at', ''),
-                    'partner_source': row.get('partner_source'),
-                    'plan_years': row.get('plan_years', 3),
-                    'referral_unlocked': row.get('referral_unlocked', False)
-                }
+                return DoctorRecord.from_row(result.data[0])
             
             return None
         
@@ -132,40 +253,27 @@ class SheetsClient:
             print(f"Error getting doctor: {e}")
             return None
     
-    def get_doctor_by_customer_id(self, customer_id):
+    def get_doctor_by_customer_id(self, customer_id, fields=None):
         """
         Get doctor data by Stripe customer ID
         
         Args:
             customer_id (str): Stripe customer ID
+            fields (list): Optional column projection (e.g. ['name', 'language'])
         
         Returns:
-            dict: Doctor data or None if not found
+            DoctorRecord: Doctor data or None if not found
+        
+        Raises:
+            ValueError: if `fields` names a column DoctorRecord does not have
         """
+        # Outside the try: an unknown field is a bug, not "doctor not found"
+        columns = doctor_columns(fields)
         try:
-            result = self.supabase.table('doctors').select('*').eq('customer_id', customer_id).execute()
+            result = self.supabase.table('doctors').select(columns).eq('customer_id', customer_id).limit(1).execute()
             
             if result.data and len(result.data) > 0:
-                row = result.data[0]
-                return {
-                    'id': row['id'],
-                    'name': row['name'],
-                    'specialty': row.get('specialty', ''),
-                    'address': row.get('address', ''),
-                    'phone': row.get('phone', ''),
-                    'email': row.get('email', ''),
-                    'logo_url': row.get('logo_url', ''),
-                    'color': row.get('color', '#3B82F6'),
-                    'language': row.get('language', 'en'),
-                    'welcome_message': row.get('welcome_message', ''),
-                    'additional_info': row.get('additional_info', ''),
-                    'link': row.get('link', ''),
-                    'customer_id': row.get('customer_id', ''),
-                    'created_at': row.get('created_at', ''),
-                    'partner_source': row.get('partner_source'),
-                    'plan_years': row.get('plan_years', 3),
-                    'referral_unlocked': row.get('referral_unlocked', False)
-                }
+                return DoctorRecord.from_row(result.data[0])
             
             return None
         
@@ -173,6 +281,24 @@ class SheetsClient:
             print(f"Error getting doctor by customer_id: {e}")
             return None
     
+    def flag_expired_trials(self):
+        """
+        Flag trial doctors whose expires_at has passed (batch job)
+        
+        Returns:
+            dict: Success status and number of doctors flagged
+        """
+        try:
+            result = self.supabase.table('doctors').update({
+                'trial_expired': True
+            }).lte('expires_at', datetime.now(timezone.utc).isoformat()).eq('trial_expired', False).execute()
+            
+            return {'success': True, 'flagged': len(result.data or [])}
+        
+        except Exception as e:
+            print(f"Error flagging expired trials: {e}")
+            return {'success': False, 'error': str(e)}
+    
     def check_link_available(self, link, exclude_doctor_id=None):
         """
         Check if a link is available (not taken by another doctor)
@@ -184,20 +310,153 @@ class SheetsClient:
         Returns:
             bool: True if available, False if taken
         """
+        owner_ids = self.get_link_owner_ids(link)
+        
+        # Treat lookup errors as taken
+        if owner_ids is None:
+            return False
+        
+        return all(owner_id == exclude_doctor_id for owner_id in owner_ids)
+    
+    def get_link_owner_ids(self, link):
+        """
+        IDs of the doctors using a link
+        
+        Args:
+            link (str): Link to check
+        
+        Returns:
+            list: Doctor IDs (normally zero or one), or None on error
+        """
         try:
-            query = self.supabase.table('doctors').select('id').eq('link', link)
+            result = self.supabase.table('doctors').select('id').eq('link', link).execute()
+            return [row['id'] for row in result.data]
+        
+        except Exception as e:
+            print(f"Error checking link: {e}")
+            return None
+    
+    def iter_schedule_sources(self, page_size=500):
+        """
+        Every active doctor's schedule source, in id order (expired trials
+        are left out). Pages by id, so a long run is not affected by
+        doctors being added meanwhile.
+        
+        Args:
+            page_size (int): Rows per query
+        
+        Yields:
+            dict: id, schedule_text, schedule_structure, schedule_template_id,
+                  schedule_template_version, schedule_overrides
+        """
+        now = datetime.now(timezone.utc).isoformat()
+        last_id = None
+        while True:
+            query = self.supabase.table('doctors').select(
+                'id, schedule_text, schedule_structure, schedule_template_id, '
+                'schedule_template_version, schedule_overrides'
+            ).or_(f'expires_at.is.null,expires_at.gt."{now}"')
+            if last_id is not None:
+                query = query.gt('id', last_id)
             
-            if exclude_doctor_id:
-                query = query.neq('id', exclude_doctor_id)
+            result = query.order('id').limit(page_size).execute()
+            yield from result.data
             
-            result = query.execute()
+            if len(result.data) < page_size:
+                return
+            last_id = result.data[-1]['id']
+    
+    def set_schedule_structure(self, doctor_id, structure):
+        """
+        Store a re-extracted schedule structure
+        
+        Args:
+            doctor_id (str): Doctor unique identifier
+            structure (dict): Structure extracted from the doctor's schedule_text
+        
+        Returns:
+            dict: Success status
+        """
+        try:
+            self.supabase.table('doctors').update({
+                'schedule_structure': structure,
+                'updated_at': datetime.now().isoformat()
+            }).eq('id', doctor_id).execute()
+            return {'success': True}
+        
+        except Exception as e:
+            return {'success': False, 'error': str(e)}
+    
+    # ==================== SCHEDULE TEMPLATES METHODS ====================
+    
+    def get_schedule_template(self, template_id, version=None):
+        """
+        Get a schedule template version
+        
+        Args:
+            template_id (str): Template identifier
+            version (int): Version, or None for the latest
+        
+        Returns:
+            dict: Template row (id, version, name, structure) or None if not found
+        """
+        try:
+            if version is None:
+                query = self.supabase.table('schedule_templates_latest').select('id, version, name, structure').eq('id', template_id)
+            else:
+                query = self.supabase.table('schedule_templates').select('id, version, name, structure').eq('id', template_id).eq('version', version)
             
-            # Available if no results found
-            return len(result.data) == 0
+            result = query.limit(1).execute()
+            return result.data[0] if result.data else None
         
         except Exception as e:
-            print(f"Error checking link: {e}")
-            return False
+            print(f"Error getting schedule template: {e}")
+            return None
+    
+    def list_schedule_templates(self):
+        """
+        Latest version of every schedule template
+        
+        Returns:
+            list: Template rows (id, version, name, structure)
+        """
+        try:
+            result = self.supabase.table('schedule_templates_latest').select('id, version, name, structure').order('name').execute()
+            return result.data or []
+        
+        except Exception as e:
+            print(f"Error listing schedule templates: {e}")
+            return []
+    
+    def create_schedule_template_version(self, template_id, name, structure):
+        """
+        Store a new version of a schedule template
+        
+        Args:
+            template_id (str): Template identifier
+            name (str): Display name
+            structure (dict): Schedule structure
+        
+        Returns:
+            dict: Success status and the new version
+        """
+        try:
+            result = self.supabase.rpc('create_schedule_template_version', {
+                'p_id': template_id,
+                'p_name': name,
+                'p_structure': structure
+            }).execute()
+            
+            return {
+                'success': True,
+                'version': result.data[0]['version']
+            }
+        
+        except Exception as e:
+            return {
+                'success': False,
+                'error': str(e)
+            }
     
     # ==================== USERS METHODS ====================
     
@@ -332,40 +591,80 @@ class SheetsClient:
     
     # ==================== AVAILABILITY METHODS ====================
     
-    def save_availability(self, doctor_id, slots):
+    def save_availability(self, doctor_id, slots, preserve=None):
         """
         Save availability slots for a doctor
-        Clears existing slots and adds new ones
+        Replaces the doctor's slots with `slots`, writing only the difference:
+        removed slots are deleted, new ones inserted and changed statuses
+        updated. Falls back to clear-and-insert when most days changed.
         
         Args:
             doctor_id (str): Doctor unique identifier
-            slots (list): List of slot dictionaries with date, time, status
+            slots (list or SlotSet): Slot dictionaries with date, time, status
+            preserve (tuple): Statuses whose current slots are kept as they
+                              are (e.g. ('booked', 'blocked') when regenerating);
+                              rows with these statuses are never deleted or updated
         
         Returns:
-            dict: Success status
+            dict: Success status, slots_count and previous_count
         """
         try:
-            # Clear existing slots for this doctor
-            self.clear_availability(doctor_id)
+            generated = slots if isinstance(slots, SlotSet) else SlotSet.from_slots(slots)
+            current = self.get_slot_set(doctor_id)
+            target = generated
+            if preserve:
+                target = generated.union(current.with_status(*preserve))
+            removed, added, changed = current.changes(target)
             
-            # Prepare rows for batch insert
-            rows_to_add = []
-            for slot in slots:
-                rows_to_add.append({
-                    'doctor_id': doctor_id,
-                    'date': slot['date'],  # Format: YYYY-MM-DD
-                    'time': slot['time'],  # Format: HH:MM
-                    'status': slot.get('status', 'available')
-                })
+            touched_days = set(removed.dates()) | set(changed.dates())
+            if len(touched_days) > AVAILABILITY_DIFF_MAX_DAYS:
+                # Wholesale change (e.g. new working hours): two queries beat one per day
+                if preserve:
+                    # Preserved rows are never deleted, even ones booked since
+                    # the snapshot: insert only around what is left
+                    self.supabase.table('availability').delete() \
+                        .eq('doctor_id', doctor_id).not_.in_('status', list(preserve)).execute()
+                    added = generated.difference(self.get_slot_set(doctor_id))
+                else:
+                    self.clear_availability(doctor_id)
+                    added = target
+                removed, changed = SlotSet(), SlotSet()
+            
+            # Deletes and status updates: one query per (date, status) group.
+            # Preserved statuses are excluded server-side, so a slot booked
+            # after the snapshot was read is not deleted or overwritten
+            for date, times in _times_by_date(removed).items():
+                query = self.supabase.table('availability').delete() \
+                    .eq('doctor_id', doctor_id).eq('date', date).in_('time', times)
+                if preserve:
+                    query = query.not_.in_('status', list(preserve))
+                query.execute()
+            
+            for status in STATUSES:
+                for date, times in _times_by_date(changed.with_status(status)).items():
+                    query = self.supabase.table('availability').update({'status': status}) \
+                        .eq('doctor_id', doctor_id).eq('date', date).in_('time', times)
+                    if preserve:
+                        query = query.not_.in_('status', list(preserve))
+                    query.execute()
             
             # Batch insert for performance
+            rows_to_add = [
+                {'doctor_id': doctor_id, 'date': slot['date'], 'time': slot['time'], 'status': slot['status']}
+                for slot in added.iter_slots()
+            ]
             if rows_to_add:
                 self.supabase.table('availability').insert(rows_to_add).execute()
             
+            # The new schedule is in memory: write the next-available pointer directly
+            today, now = _today_and_now()
+            self.set_next_slot(doctor_id, target.with_status('available').first_from(today, now))
+            
             return {
                 'success': True,
-                'message': f'{len(rows_to_add)} slots saved',
-                'slots_count': len(rows_to_add)
+                'message': f'{len(target)} slots saved',
+                'slots_count': len(target),
+                'previous_count': len(current)
             }
         
         except Exception as e:
@@ -386,34 +685,53 @@ class SheetsClient:
         except Exception as e:
             print(f"Error clearing availability: {e}")
     
-    def get_availability(self, doctor_id, date=None):
+    def get_slot_set(self, doctor_id, date=None, status=None):
         """
-        Get available slots for a doctor
+        Load a doctor's slots as a compact SlotSet, paging through all rows
         
         Args:
             doctor_id (str): Doctor unique identifier
             date (str): Optional date filter (YYYY-MM-DD)
+            status (str): Optional status filter
         
         Returns:
-            list: List of available slots
+            SlotSet: The slots (raises on database errors)
         """
-        try:
-            query = self.supabase.table('availability').select('*').eq('doctor_id', doctor_id).eq('status', 'available')
-            
+        rows = []
+        offset = 0
+        while True:
+            query = self.supabase.table('availability').select('date, time, status').eq('doctor_id', doctor_id)
             if date:
                 query = query.eq('date', date)
+            if status:
+                query = query.eq('status', status)
             
-            result = query.execute()
+            result = query.order('date').order('time') \
+                .range(offset, offset + AVAILABILITY_PAGE_SIZE - 1).execute()
+            rows.extend(result.data)
             
-            slots = []
-            for row in result.data:
-                slots.append({
-                    'date': str(row['date']),
-                    'time': str(row['time']),
-                    'status': row['status']
-                })
-            
-            return slots
+            if len(result.data) < AVAILABILITY_PAGE_SIZE:
+                # Rows with a status the app does not know are never offered
+                return SlotSet.from_slots(rows, unknown_status='blocked')
+            offset += AVAILABILITY_PAGE_SIZE
+    
+    def get_availability(self, doctor_id, date=None, hold_token=None):
+        """
+        Get available slots for a doctor
+        Slots under an active hold are left out, except the caller's own.
+        
+        Args:
+            doctor_id (str): Doctor unique identifier
+            date (str): Optional date filter (YYYY-MM-DD)
+            hold_token (str): Optional token of the caller's hold
+        
+        Returns:
+            list: List of available slots
+        """
+        try:
+            available = self.get_slot_set(doctor_id, date, status='available')
+            held = self.get_held_slots(doctor_id, date, exclude_token=hold_token)
+            return available.difference(held).to_slots()
         
         except Exception as e:
             print(f"Error getting availability: {e}")
@@ -437,12 +755,222 @@ class SheetsClient:
                 'status': status
             }).eq('doctor_id', doctor_id).eq('date', date).eq('time', time).execute()
             
+            if result.data:
+                self.note_slot_status(doctor_id, date, time, status)
+            
             return len(result.data) > 0
         
         except Exception as e:
             print(f"Error updating slot status: {e}")
             return False
     
+    def search_availability(self, date_from, date_to, specialty=None, after=None, limit=50):
+        """
+        Earliest free future slots across all doctors, in one query
+        (search_availability, see migrations/008_availability_search.sql)
+        
+        Args:
+            date_from (str): First date (YYYY-MM-DD)
+            date_to (str): Last date (YYYY-MM-DD)
+            specialty (str): Optional specialty filter (partial, case-insensitive)
+            after (tuple): Optional (date, time, doctor_id) of the last slot of the previous page
+            limit (int): Page size
+        
+        Returns:
+            list: Slots with doctor_id, date, time and doctor card fields
+        """
+        try:
+            after_date, after_time, after_doctor = after or (None, None, None)
+            today, now = _today_and_now()
+            result = self.supabase.rpc('search_availability', {
+                'p_date_from': date_from,
+                'p_date_to': date_to,
+                'p_today': today,
+                'p_now': now,
+                'p_specialty': specialty or None,
+                'p_after_date': after_date,
+                'p_after_time': after_time,
+                'p_after_doctor': after_doctor,
+                'p_limit': limit
+            }).execute()
+            
+            return result.data or []
+        
+        except Exception as e:
+            print(f"Error searching availability: {e}")
+            return []
+    
+    # ==================== NEXT AVAILABLE SLOT METHODS ====================
+    
+    def set_next_slot(self, doctor_id, slot):
+        """
+        Overwrite a doctor's next-available pointer
+        
+        Args:
+            doctor_id (str): Doctor unique identifier
+            slot (dict): Earliest available future slot, or None if there is none
+        """
+        try:
+            self.supabase.table('doctor_next_slot').upsert({
+                'doctor_id': doctor_id,
+                'date': slot['date'] if slot else None,
+                'time': slot['time'] if slot else None,
+                'updated_at': datetime.utcnow().isoformat()
+            }, on_conflict='doctor_id').execute()
+        except Exception as e:
+            print(f"Error setting next slot: {e}")
+    
+    def note_slot_status(self, doctor_id, date, time, status):
+        """
+        Move the next-available pointer after a single slot changed status
+        (only touches it when the change affects it)
+        
+        Args:
+            doctor_id (str): Doctor unique identifier
+            date (str): Slot date (YYYY-MM-DD)
+            time (str): Slot time (HH:MM)
+            status (str): New status
+        """
+        try:
+            today, now = _today_and_now()
+            self.supabase.rpc('note_slot_status', {
+                'p_doctor_id': doctor_id,
+                'p_date': date,
+                'p_time': time,
+                'p_status': status,
+                'p_today': today,
+                'p_now': now
+            }).execute()
+        except Exception as e:
+            print(f"Error updating next slot: {e}")
+    
+    def get_next_slots(self, doctor_ids):
+        """
+        Next available slot of each doctor, one indexed read
+        
+        Args:
+            doctor_ids (list): Doctor unique identifiers
+        
+        Returns:
+            dict: doctor_id -> {'date', 'time'} or None if no future slot
+                  (unknown doctors are left out; raises on database errors,
+                  so a failed read is never mistaken for unknown doctors)
+        """
+        today, now = _today_and_now()
+        result = self.supabase.rpc('next_available_slots', {
+            'p_doctor_ids': list(doctor_ids),
+            'p_today': today,
+            'p_now': now
+        }).execute()
+        
+        return {
+            row['doctor_id']: {'date': row['date'], 'time': row['time']} if row['date'] else None
+            for row in result.data or []
+        }
+    
+    # ==================== SLOT HOLDS METHODS ====================
+    
+    def hold_slot(self, doctor_id, date, time, token, minutes):
+        """
+        Reserve a slot for `minutes`. Renews the hold if `token` already
+        holds it; fails if another unexpired hold exists.
+        
+        Args:
+            doctor_id (str): Doctor unique identifier
+            date (str): Slot date (YYYY-MM-DD)
+            time (str): Slot time (HH:MM)
+            token (str): Hold token of the caller
+            minutes (int): Hold duration
+        
+        Returns:
+            dict: Success status, held flag and expires_at
+        """
+        try:
+            result = self.supabase.rpc('hold_slot', {
+                'p_doctor_id': doctor_id,
+                'p_date': date,
+                'p_time': time,
+                'p_token': token,
+                'p_minutes': minutes
+            }).execute()
+            
+            if not result.data:
+                return {'success': True, 'held': False}
+            
+            return {
+                'success': True,
+                'held': True,
+                'expires_at': result.data[0]['expires_at']
+            }
+        
+        except Exception as e:
+            return {
+                'success': False,
+                'error': str(e)
+            }
+    
+    def release_slot_hold(self, token, keep=None):
+        """
+        Release the hold(s) taken with `token`
+        
+        Args:
+            token (str): Hold token
+            keep (tuple): Optional (date, time) hold of the token to keep
+        
+        Returns:
+            bool: True if a hold was released
+        """
+        try:
+            query = self.supabase.table('slot_holds').delete().eq('token', token)
+            if keep:
+                # Quoted: ':' is reserved in PostgREST filter values
+                query = query.or_(f'date.neq."{keep[0]}",time.neq."{keep[1]}"')
+            result = query.execute()
+            return len(result.data) > 0
+        
+        except Exception as e:
+            print(f"Error releasing slot hold: {e}")
+            return False
+    
+    def get_held_slots(self, doctor_id, date=None, exclude_token=None):
+        """
+        Slots of a doctor under an unexpired hold
+        
+        Args:
+            doctor_id (str): Doctor unique identifier
+            date (str): Optional date filter (YYYY-MM-DD)
+            exclude_token (str): Leave out the holds with this token
+        
+        Returns:
+            SlotSet: Held slots (raises on database errors)
+        """
+        query = self.supabase.table('slot_holds').select('date, time') \
+            .eq('doctor_id', doctor_id) \
+            .gt('expires_at', datetime.now(timezone.utc).isoformat())
+        if date:
+            query = query.eq('date', date)
+        if exclude_token:
+            query = query.neq('token', exclude_token)
+        
+        return SlotSet.from_slots(query.execute().data)
+    
+    def sweep_slot_holds(self):
+        """
+        Delete expired holds (they are already ignored; this keeps the table small)
+        
+        Returns:
+            dict: Success status and number of deleted holds
+        """
+        try:
+            result = self.supabase.rpc('sweep_slot_holds', {}).execute()
+            return {'success': True, 'deleted': int(result.data or 0)}
+        
+        except Exception as e:
+            return {
+                'success': False,
+                'error': str(e)
+            }
+    
     # ==================== APPOINTMENTS METHODS ====================
     
     def create_appointment(self, appointment_data):
@@ -513,26 +1041,44 @@ class SheetsClient:
         try:
             result = self.supabase.table('appointments').select('*').eq('doctor_id', doctor_id).order('date', desc=False).execute()
             
-            appointments = []
-            for row in result.data:
-                appointments.append({
-                    'id': str(row['id']),
-                    'doctor_id': row['doctor_id'],
-                    'patient_name': row['patient_name'],
-                    'patient_email': row.get('patient_email', ''),
-                    'patient_phone': row.get('patient_phone', ''),
-                    'date': str(row['date']),
-                    'time': str(row['time']),
-                    'notes': row.get('notes', ''),
-                    'created_at': row.get('created_at', '')
-                })
-            
-            return appointments
+            return [appointment_from_row(row) for row in result.data]
         
         except Exception as e:
             print(f"Error getting appointments: {e}")
             return []
     
+    def iter_appointments(self, doctor_id, page_size=500, date_from=None, date_to=None):
+        """
+        Iterate over all appointments for a doctor, one page at a time,
+        so long histories are never held in memory at once
+        
+        Args:
+            doctor_id (str): Doctor unique identifier
+            page_size (int): Rows fetched per query
+            date_from (str): Optional first date, inclusive (YYYY-MM-DD)
+            date_to (str): Optional last date, inclusive (YYYY-MM-DD)
+        
+        Yields:
+            dict: Appointment, in date/time order
+        """
+        offset = 0
+        while True:
+            query = self.supabase.table('appointments').select('*').eq('doctor_id', doctor_id)
+            if date_from:
+                query = query.gte('date', date_from)
+            if date_to:
+                query = query.lte('date', date_to)
+            
+            result = query.order('date', desc=False).order('time', desc=False).order('id', desc=False) \
+                .range(offset, offset + page_size - 1).execute()
+            
+            for row in result.data:
+                yield appointment_from_row(row)
+            
+            if len(result.data) < page_size:
+                return
+            offset += page_size
+    
     def cancel_appointment(self, appointment_id, doctor_id):
         """
         Cancel an appointment and release the time slot
@@ -566,10 +1112,13 @@ class SheetsClient:
             self.supabase.table('appointments').delete().eq('id', appointment_id).execute()
             
             # Release the time slot (change status back to available)
-            self.supabase.table('availability').update({
+            released = self.supabase.table('availability').update({
                 'status': 'available'
             }).eq('doctor_id', doctor_id).eq('date', apt_date).eq('time', apt_time).execute()
             
+            if released.data:
+                self.note_slot_status(doctor_id, apt_date, apt_time, 'available')
+            
             return {
                 'success': True,
                 'message': 'Appointment cancelled',
@@ -584,6 +1133,119 @@ class SheetsClient:
                 'error': str(e)
             }
     
+    # ==================== CALENDAR FEED METHODS ====================
+    
+    def get_calendar_feed_doctor(self, token):
+        """
+        Doctor behind a calendar feed token
+        
+        Args:
+            token (str): Secret token from the feed URL
+        
+        Returns:
+            dict: id, name, appointments_changed_at and schedule_structure, or None
+        """
+        try:
+            result = self.supabase.table('doctors') \
+                .select('id, name, appointments_changed_at, schedule_structure') \
+                .eq('calendar_token', token).limit(1).execute()
+            return result.data[0] if result.data else None
+        
+        except Exception as e:
+            print(f"Error getting calendar feed doctor: {e}")
+            return None
+    
+    def set_calendar_token(self, doctor_id, token, only_if_missing=False):
+        """
+        Set the doctor's calendar feed token (a new token revokes the old URL)
+        
+        Args:
+            doctor_id (str): Doctor unique identifier
+            token (str): New token
+            only_if_missing (bool): Keep an existing token instead
+        
+        Returns:
+            str: The doctor's token afterwards, or None on error
+        """
+        try:
+            query = self.supabase.table('doctors').update({'calendar_token': token}).eq('id', doctor_id)
+            if only_if_missing:
+                query = query.is_('calendar_token', 'null')
+            query.execute()
+            
+            result = self.supabase.table('doctors').select('calendar_token').eq('id', doctor_id).execute()
+            return result.data[0]['calendar_token'] if result.data else None
+        
+        except Exception as e:
+            print(f"Error setting calendar token: {e}")
+            return None
+    
+    def _iter_since(self, table, columns, doctor_id, stamp_column, id_column, since, page_size):
+        """
+        Rows of a doctor with stamp_column > since, keyset-paged on
+        (stamp_column, id_column) so no page can be cut by the row cap and
+        rows stamped meanwhile are neither skipped nor repeated.
+        """
+        last = None
+        while True:
+            query = self.supabase.table(table).select(columns).eq('doctor_id', doctor_id)
+            if last is None:
+                query = query.gt(stamp_column, since)
+            else:
+                stamp, key = last
+                query = query.or_(
+                    f'{stamp_column}.gt."{stamp}",'
+                    f'and({stamp_column}.eq."{stamp}",{id_column}.gt."{key}")'
+                )
+            
+            result = query.order(stamp_column).order(id_column).limit(page_size).execute()
+            yield from result.data
+            
+            if len(result.data) < page_size:
+                return
+            last = (result.data[-1][stamp_column], result.data[-1][id_column])
+    
+    def get_appointment_changes(self, doctor_id, since, page_size=500):
+        """
+        Appointments created or updated, and appointments deleted, after `since`
+        
+        Args:
+            doctor_id (str): Doctor unique identifier
+            since (str): ISO timestamp
+            page_size (int): Rows fetched per query (every page is read)
+        
+        Returns:
+            tuple: (changed appointments, deleted appointment IDs); raises on database errors
+        """
+        changed = self._iter_since('appointments', '*', doctor_id, 'updated_at', 'id', since, page_size)
+        deleted = self._iter_since(
+            'appointment_tombstones', 'appointment_id, deleted_at', doctor_id,
+            'deleted_at', 'appointment_id', since, page_size
+        )
+        
+        # An ID can be deleted and never come back; a re-created slot is a new ID
+        return (
+            [appointment_from_row(row) for row in changed],
+            list(dict.fromkeys(row['appointment_id'] for row in deleted))
+        )
+    
+    def prune_appointment_tombstones(self, before):
+        """
+        Delete tombstones older than `before` (older sync tokens are refused)
+        
+        Args:
+            before (str): ISO timestamp
+        
+        Returns:
+            dict: Success status and number of deleted rows
+        """
+        try:
+            result = self.supabase.rpc('prune_appointment_tombstones', {'p_before': before}).execute()
+            return {'success': True, 'deleted': int(result.data or 0)}
+        
+        except Exception as e:
+            return {'success': False, 'error': str(e)}
+    
     # ==================== REFERRALS METHODS ====================
     
     def save_referral(self, referral_data):
@@ -667,6 +1329,7 @@ class SheetsClient:
                 - invited_name: Name of the invited colleague
                 - slug: Unique URL slug
                 - referrer_name: Name of doctor who referred (activates green bar)
+                - referrer_customer_id: Customer ID of the referring doctor (stats key)
                 - status: Default 'pending'
         
         Returns:
@@ -724,9 +1387,11 @@ class SheetsClient:
             dict: Success status
         """
         try:
-            # Update doctors table
+            # Update doctors table (paid accounts never expire)
             doc_result = self.supabase.table('doctors').update({
                 'customer_id': new_customer_id,
+                'expires_at': None,
+                'trial_expired': False,
                 'updated_at': datetime.now().isoformat()
             }).eq('customer_id', old_customer_id).execute()
             
@@ -753,45 +1418,60 @@ class SheetsClient:
                 'error': str(e)
             }
     
-    def get_referral_stats(self, referrer_name):
+    def get_referral_stats(self, referrer_customer_id):
         """
-        Get referral statistics for a doctor by their name.
-        Queries invites table where referrer_name matches.
+        Get referral statistics for a doctor by their customer ID.
+        Counts come from a grouped aggregate on the indexed
+        invites.referrer_customer_id column (one small query).
         
         Args:
-            referrer_name (str): Name of the referring doctor
+            referrer_customer_id (str): Customer ID of the referring doctor
         
         Returns:
             dict: Stats with total, pending, clicked, trial_started, converted counts
         """
+        stats = {'total': 0, 'pending': 0, 'clicked': 0, 'trial_started': 0, 'converted': 0}
         try:
-            result = self.supabase.table('invites').select('invited_name, slug, status, created_at').eq('referrer_name', referrer_name).execute()
-            
-            stats = {
-                'total': 0,
-                'pending': 0,
-                'clicked': 0,
-                'trial_started': 0,
-                'converted': 0,
-                'invites': []
-            }
+            result = self.supabase.rpc('referral_status_counts', {'p_customer_id': referrer_customer_id}).execute()
             
-            if result.data:
-                stats['total'] = len(result.data)
-                for row in result.data:
-                    status = row.get('status', 'pending')
-                    if status in stats:
-                        stats[status] += 1
-                    stats['invites'].append({
-                        'name': row.get('invited_name', ''),
-                        'slug': row.get('slug', ''),
-                        'status': status
-                    })
+            for row in result.data or []:
+                stats['total'] += row['total']
+                if row['status'] in stats:
+                    stats[row['status']] += row['total']
             
             return stats
         except Exception as e:
             print(f"Error getting referral stats: {e}")
-            return {'total': 0, 'pending': 0, 'clicked': 0, 'trial_started': 0, 'converted': 0, 'invites': []}
+            return stats
+    
+    def get_referral_invites(self, referrer_customer_id, limit=20, offset=0):
+        """
+        Get one page of a doctor's invites, most recent first
+        
+        Args:
+            referrer_customer_id (str): Customer ID of the referring doctor
+            limit (int): Page size
+            offset (int): Number of invites to skip
+        
+        Returns:
+            list: Invites with name, slug and status
+        """
+        try:
+            result = self.supabase.table('invites').select('invited_name, slug, status').eq(
+                'referrer_customer_id', referrer_customer_id
+            ).order('created_at', desc=True).range(offset, offset + limit - 1).execute()
+            
+            return [
+                {
+                    'name': row.get('invited_name', ''),
+                    'slug': row.get('slug', ''),
+                    'status': row.get('status', 'pending')
+                }
+                for row in result.data or []
+            ]
+        except Exception as e:
+            print(f"Error getting referral invites: {e}")
+            return []
 
     def save_new_grad(self, data):
         """
@@ -889,6 +1569,90 @@ class SheetsClient:
             print(f"Error creating message: {e}")
             return {'success': False, 'error': str(e)}
 
+    def create_messages(self, messages):
+        """
+        Insert several notification messages in one batched insert.
+
+        Args:
+            messages (list): Dicts with customer_id, text and type
+
+        Returns:
+            dict: Success status and number of messages inserted
+        """
+        try:
+            now = datetime.now().isoformat()
+            rows = [
+                {
+                    'customer_id': msg['customer_id'],
+                    'text': msg['text'],
+                    'type': msg.get('type', 'system'),
+                    'created_at': now
+                }
+                for msg in messages
+            ]
+
+            if rows:
+                self.supabase.table('messages').insert(rows).execute()
+
+            return {'success': True, 'count': len(rows)}
+
+        except Exception as e:
+            print(f"Error creating messages: {e}")
+            return {'success': False, 'error': str(e)}
+
+    def get_unread_message_count(self, customer_id):
+        """
+        Count unread messages (own + broadcasts) newer than the read cursor.
+
+        Args:
+            customer_id (str): Customer ID
+
+        Returns:
+            int: Number of unread messages
+        """
+        try:
+            result = self.supabase.rpc('unread_message_count', {'p_customer_id': customer_id}).execute()
+            return int(result.data or 0)
+        except Exception as e:
+            print(f"Error counting unread messages: {e}")
+            return 0
+
+    def mark_messages_read(self, customer_id):
+        """
+        Move the customer's read cursor to now.
+
+        Args:
+            customer_id (str): Customer ID
+
+        Returns:
+            dict: Success status
+        """
+        try:
+            self.supabase.table('message_cursors').upsert({
+                'customer_id': customer_id,
+                'last_read_at': datetime.now(timezone.utc).isoformat()
+            }, on_conflict='customer_id').execute()
+
+            return {'success': True}
+
+        except Exception as e:
+            print(f"Error marking messages read: {e}")
+            return {'success': False, 'error': str(e)}
+
+    def get_first_appointment_id(self, doctor_id):
+        """
+        ID of the doctor's earliest-created appointment
+
+        Args:
+            doctor_id (str): Doctor unique identifier
+
+        Returns:
+            ID of the appointment, or None if there is none (raises on database errors)
+        """
+        result = self.supabase.table('appointments').select('id').eq('doctor_id', doctor_id) \
+            .order('created_at').order('id').limit(1).execute()
+        return result.data[0]['id'] if result.data else None
+
     def count_doctor_appointments(self, doctor_id):
         """
         Count total appointments for a doctor.
@@ -1003,3 +1767,308 @@ class SheetsClient:
         except Exception as e:
             print(f"Error getting pending account: {e}")
             return None
+
+    # ==================== STRIPE EVENTS / SUBSCRIPTION STATE ====================
+
+    def enqueue_stripe_event(self, event, customer_id=''):
+        """
+        Persist a verified Stripe event for asynchronous processing.
+        Deduplicated by event ID: a redelivery is not queued again.
+
+        Args:
+            event (dict): Verified Stripe event payload
+            customer_id (str): Customer the event belongs to (ordering key)
+
+        Returns:
+            bool: True if the event is new, False if it was already queued
+
+        Raises:
+            Exception: if the database is unreachable, so the webhook can
+            answer 500 and let Stripe redeliver
+        """
+        result = self.supabase.table('stripe_events').upsert(
+            {
+                'id': event['id'],
+                'type': event['type'],
+                'customer_id': customer_id or '',
+                'event_created': event.get('created', 0),
+                'payload': event,
+                'status': 'pending'
+            },
+            on_conflict='id',
+            ignore_duplicates=True
+        ).execute()
+
+        return bool(result.data)
+
+    def get_unfinished_stripe_events(self, limit=100):
+        """
+        Get queued Stripe events that are not done yet, oldest first
+
+        Args:
+            limit (int): Maximum number of events
+
+        Returns:
+            list: Event rows (id, type, customer_id, status, attempts, next_attempt_at, locked_at, payload)
+        """
+        try:
+            result = self.supabase.table('stripe_events').select(
+                'id, type, customer_id, status, attempts, next_attempt_at, locked_at, payload'
+            ).in_('status', ['pending', 'processing']).order('event_created').order('id').limit(limit).execute()
+
+            return result.data or []
+
+        except Exception as e:
+            print(f"Error getting queued stripe events: {e}")
+            return []
+
+    def claim_queued_stripe_event(self, event_id, stale_before):
+        """
+        Atomically mark a queued event as being processed.
+        Events stuck in 'processing' since before `stale_before` can be reclaimed.
+
+        Args:
+            event_id (str): Stripe event ID
+            stale_before (str): ISO timestamp
+
+        Returns:
+            bool: True if this worker owns the event now
+        """
+        try:
+            result = self.supabase.table('stripe_events').update({
+                'status': 'processing',
+                'locked_at': datetime.utcnow().isoformat()
+            }).eq('id', event_id).or_(
+                f'status.eq.pending,and(status.eq.processing,locked_at.lt."{stale_before}")'
+            ).execute()
+
+            return bool(result.data)
+
+        except Exception as e:
+            print(f"Error claiming stripe event {event_id}: {e}")
+            return False
+
+    def complete_stripe_event(self, event_id):
+        """
+        Mark a queued event as processed
+
+        Args:
+            event_id (str): Stripe event ID
+        """
+        try:
+            self.supabase.table('stripe_events').update({
+                'status': 'done',
+                'processed_at': datetime.utcnow().isoformat(),
+                'last_error': None
+            }).eq('id', event_id).execute()
+        except Exception as e:
+            print(f"Error completing stripe event {event_id}: {e}")
+
+    def fail_stripe_event(self, event_id, attempts, next_attempt_at, error, dead=False):
+        """
+        Record a failed processing attempt and schedule the retry
+
+        Args:
+            event_id (str): Stripe event ID
+            attempts (int): Attempts made so far
+            next_attempt_at (str): ISO timestamp of the next retry
+            error (str): Error message
+            dead (bool): True to stop retrying
+        """
+        try:
+            self.supabase.table('stripe_events').update({
+                'status': 'dead' if dead else 'pending',
+                'attempts': attempts,
+                'next_attempt_at': next_attempt_at,
+                'locked_at': None,
+                'last_error': error[:1000]
+            }).eq('id', event_id).execute()
+        except Exception as e:
+            print(f"Error recording stripe event failure {event_id}: {e}")
+
+    def apply_subscription_state(self, customer_id, state, event_id, event_created):
+        """
+        Upsert the projected subscription state of a customer.
+        Ignored if a newer event has already been applied.
+
+        Args:
+            customer_id (str): Stripe customer ID
+            state (dict): Any of subscription_id, status, current_period_end, payment_status
+            event_id (str): Stripe event ID (or 'reconcile')
+            event_created (int): Stripe event.created (unix seconds)
+
+        Returns:
+            dict: Success status and whether the state was applied
+        """
+        try:
+            result = self.supabase.rpc('apply_subscription_state', {
+                'p_customer_id': customer_id,
+                'p_subscription_id': state.get('subscription_id'),
+                'p_status': state.get('status'),
+                'p_current_period_end': state.get('current_period_end'),
+                'p_payment_status': state.get('payment_status'),
+                'p_event_id': event_id,
+                'p_event_created': event_created
+            }).execute()
+
+            return {'success': True, 'applied': bool(result.data)}
+
+        except Exception as e:
+            print(f"Error applying subscription state: {e}")
+            return {'success': False, 'error': str(e)}
+
+    def get_subscription_state(self, customer_id):
+        """
+        Get the projected subscription state of a customer
+
+        Args:
+            customer_id (str): Stripe customer ID
+
+        Returns:
+            dict: Subscription state or None if never projected
+        """
+        try:
+            result = self.supabase.table('subscriptions').select(
+                'customer_id, subscription_id, status, active, current_period_end, payment_status, updated_at'
+            ).eq('customer_id', customer_id).limit(1).execute()
+
+            if result.data:
+                return result.data[0]
+
+            return None
+
+        except Exception as e:
+            print(f"Error getting subscription state: {e}")
+            return None
+
+    # ==================== POST-COMMIT OUTBOX ====================
+
+    def enqueue_post_commit_task(self, task, args, delay_seconds=60):
+        """
+        Persist a post-commit task before the response (at-least-once).
+        The worker leaves it to the in-request run for `delay_seconds`.
+
+        Args:
+            task (str): Registered task name
+            args (list): JSON-serialisable task arguments
+            delay_seconds (int): Grace period before the worker may pick it up
+
+        Returns:
+            int: Outbox row ID, or None if it could not be written
+        """
+        try:
+            result = self.supabase.table('post_commit_outbox').insert({
+                'task': task,
+                'args': args,
+                'next_attempt_at': (datetime.utcnow() + timedelta(seconds=delay_seconds)).isoformat()
+            }).execute()
+
+            return result.data[0]['id'] if result.data else None
+
+        except Exception as e:
+            print(f"Error writing post-commit task {task} to outbox: {e}")
+            return None
+
+    def get_due_post_commit_tasks(self, now, stale_before, limit=100):
+        """
+        Get outbox rows that are due: pending past next_attempt_at, or
+        stuck in 'processing' since before `stale_before`
+
+        Args:
+            now (str): ISO timestamp
+            stale_before (str): ISO timestamp
+            limit (int): Maximum number of rows
+
+        Returns:
+            list: Outbox rows (id, task, args, attempts)
+        """
+        try:
+            result = self.supabase.table('post_commit_outbox').select('id, task, args, attempts').or_(
+                f'and(status.eq.pending,next_attempt_at.lte."{now}"),'
+                f'and(status.eq.processing,locked_at.lt."{stale_before}")'
+            ).order('next_attempt_at').limit(limit).execute()
+
+            return result.data or []
+
+        except Exception as e:
+            print(f"Error getting due post-commit tasks: {e}")
+            return []
+
+    def count_post_commit_backlog(self):
+        """
+        Number of unfinished outbox rows
+
+        Returns:
+            int: Pending + processing rows (0 on error)
+        """
+        try:
+            result = self.supabase.table('post_commit_outbox').select('id', count='exact') \
+                .in_('status', ['pending', 'processing']).limit(1).execute()
+            return result.count or 0
+
+        except Exception as e:
+            print(f"Error counting post-commit backlog: {e}")
+            return 0
+
+    def claim_post_commit_task(self, task_id, stale_before):
+        """
+        Atomically mark an outbox row as being processed
+
+        Args:
+            task_id (int): Outbox row ID
+            stale_before (str): ISO timestamp; older 'processing' locks can be taken over
+
+        Returns:
+            bool: True if this worker owns the row now
+        """
+        try:
+            result = self.supabase.table('post_commit_outbox').update({
+                'status': 'processing',
+                'locked_at': datetime.utcnow().isoformat()
+            }).eq('id', task_id).or_(
+                f'status.eq.pending,and(status.eq.processing,locked_at.lt."{stale_before}")'
+            ).execute()
+
+            return bool(result.data)
+
+        except Exception as e:
+            print(f"Error claiming post-commit task {task_id}: {e}")
+            return False
+
+    def complete_post_commit_task(self, task_id):
+        """
+        Mark an outbox row as done
+
+        Args:
+            task_id (int): Outbox row ID
+        """
+        try:
+            self.supabase.table('post_commit_outbox').update({
+                'status': 'done',
+                'processed_at': datetime.utcnow().isoformat(),
+                'last_error': None
+            }).eq('id', task_id).execute()
+        except Exception as e:
+            print(f"Error completing post-commit task {task_id}: {e}")
+
+    def fail_post_commit_task(self, task_id, attempts, next_attempt_at, error, dead=False):
+        """
+        Record a failed attempt and schedule the retry
+
+        Args:
+            task_id (int): Outbox row ID
+            attempts (int): Attempts made so far
+            next_attempt_at (str): ISO timestamp of the next retry
+            error (str): Error message
+            dead (bool): True to stop retrying
+        """
+        try:
+            self.supabase.table('post_commit_outbox').update({
+                'status': 'dead' if dead else 'pending',
+                'attempts': attempts,
+                'next_attempt_at': next_attempt_at,
+                'locked_at': None,
+                'last_error': error[:1000]
+            }).eq('id', task_id).execute()
+        except Exception as e:
+            print(f"Error recording post-commit task failure {task_id}: {e}")
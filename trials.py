@@ -0,0 +1,164 @@
+"""
+Trial state machine for SlotlyCare
+Each transition (visit → request code → activate) is a single conditional
+UPDATE that returns the new row; the current row is only read when a
+transition does not apply, to tell the caller why. /api/trial/check is
+served from a short-lived cached projection kept fresh by the transitions.
+"""
+
+from datetime import datetime, timedelta
+
+from supabase_client import TRIAL_DAYS
+from ttl_cache import TTLCache
+
+TRIAL_COLUMNS = 'slug, doctor_name, doctor_email, status, activation_code, visited_at, code_requested_at, activated_at'
+
+# slug -> trial row. Short TTL: other instances may run transitions too.
+TRIALS = TTLCache(ttl=30, negative_ttl=5, max_entries=4096)
+
+# Codes issued before the sequence-based generator may still collide
+_CODE_ATTEMPTS = 3
+
+
+class TrialTransitionError(Exception):
+    """A transition that cannot happen, with the HTTP status to answer."""
+
+    def __init__(self, status_code, detail):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def _remember(row):
+    TRIALS.set(row['slug'], row)
+    return row
+
+
+def get_trial(sheets, slug, use_cache=True):
+    """
+    Get a trial row by slug
+
+    Returns:
+        dict: Trial row or None if not found
+    """
+    if use_cache:
+        return TRIALS.get_or_load(slug, lambda: get_trial(sheets, slug, use_cache=False))
+
+    result = sheets.supabase.table('trials').select(TRIAL_COLUMNS).eq('slug', slug).limit(1).execute()
+    return result.data[0] if result.data else None
+
+
+def _require_trial(sheets, slug):
+    trial = get_trial(sheets, slug, use_cache=False)
+    if trial is None:
+        raise TrialTransitionError(404, "Trial not found")
+    return _remember(trial)
+
+
+def record_visit(sheets, slug):
+    """
+    Record the first visit of the trial page.
+
+    Returns:
+        tuple: (trial row, True if this was the first visit)
+    """
+    now = datetime.utcnow().isoformat()
+    result = sheets.supabase.table('trials').update({
+        'visited_at': now,
+        'status': 'visited'
+    }).eq('slug', slug).is_('visited_at', 'null').execute()
+
+    if result.data:
+        return _remember(result.data[0]), True
+
+    return _require_trial(sheets, slug), False
+
+
+def request_code(sheets, slug, doctor_email):
+    """
+    Issue the activation code, unless one was already issued.
+    The code is generated in the database (initials + sequence-derived
+    suffix), so it is unique without a read-back loop.
+
+    Returns:
+        tuple: (trial row, True if a new code was issued)
+    """
+    for attempt in range(_CODE_ATTEMPTS):
+        try:
+            result = sheets.supabase.rpc('request_trial_code', {
+                'p_slug': slug,
+                'p_email': doctor_email
+            }).execute()
+            break
+        except Exception as e:
+            # Unique violation against a legacy random code: draw the next one
+            if '23505' not in str(e) or attempt == _CODE_ATTEMPTS - 1:
+                raise
+
+    if result.data:
+        return _remember(result.data[0]), True
+
+    return _require_trial(sheets, slug), False
+
+
+def activate(sheets, slug, code):
+    """
+    Activate the trial if the code matches.
+
+    Returns:
+        tuple: (trial row, True if activated now, False if already active)
+
+    Raises:
+        TrialTransitionError: not found, expired, no code yet or wrong code
+    """
+    result = sheets.supabase.rpc('activate_trial', {
+        'p_slug': slug,
+        'p_code': code
+    }).execute()
+
+    if result.data:
+        return _remember(result.data[0]), True
+
+    trial = _require_trial(sheets, slug)
+
+    if trial.get('status') == 'active':
+        return trial, False
+
+    if trial.get('status') == 'expired':
+        raise TrialTransitionError(403, "Trial has expired")
+
+    if not trial.get('activation_code'):
+        raise TrialTransitionError(400, "No activation code has been generated yet. Please request one first.")
+
+    raise TrialTransitionError(401, "Invalid activation code")
+
+
+def days_remaining(trial):
+    """Days left of an active trial, None if not active."""
+    if not trial.get('activated_at') or trial.get('status') != 'active':
+        return None
+
+    activated = datetime.fromisoformat(trial['activated_at'].replace('Z', '+00:00'))
+    expires = activated + timedelta(days=TRIAL_DAYS)
+    remaining = (expires - datetime.now(activated.tzinfo)).days
+    return max(0, remaining)
+
+
+def check(sheets, slug):
+    """
+    Trial status projection for the frontend, served from cache.
+
+    Returns:
+        dict: slug, doctor_name, status, has_code, days_remaining
+    """
+    trial = get_trial(sheets, slug)
+    if trial is None:
+        raise TrialTransitionError(404, "Trial not found")
+
+    return {
+        "slug": trial['slug'],
+        "doctor_name": trial['doctor_name'],
+        "status": trial['status'],
+        "has_code": bool(trial.get('activation_code')),
+        "days_remaining": days_remaining(trial)
+    }
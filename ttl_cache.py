@@ -0,0 +1,163 @@
+"""
+In-process TTL cache for SlotlyCare
+Small thread-safe cache with refresh-ahead and single-flight loading,
+used to keep slow upstream lookups (Stripe, Supabase) off the hot path.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    Thread-safe TTL cache.
+
+    - Entries older than `ttl` seconds are reloaded synchronously.
+    - Entries older than `refresh_after` seconds (but younger than `ttl`)
+      are served as-is while a background thread reloads them.
+    - Concurrent misses for the same key share one loader call, so a burst
+      of requests for a cold key costs a single upstream round trip.
+    - `None` results are cached for `negative_ttl` seconds only.
+    """
+
+    def __init__(self, ttl, refresh_after=None, negative_ttl=None, max_entries=1024):
+        self.ttl = ttl
+        self.refresh_after = refresh_after
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self.max_entries = max_entries
+        # key -> (value, loaded_at)
+        self._entries = {}
+        self._lock = threading.Lock()
+        # key -> [lock, users]; only keys with a load in progress are kept
+        self._key_locks = {}
+        self._refreshing = set()
+        # Bumped by clear(), and per key by invalidate() while a load of that
+        # key is in progress: a load that started before an invalidation
+        # must not store its (possibly stale) result afterwards
+        self._clear_generation = 0
+        self._generations = {}
+
+    def _lifetime(self, value):
+        return self.negative_ttl if value is None else self.ttl
+
+    def get(self, key, default=None):
+        """Return the cached value if still fresh, otherwise `default`."""
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return default
+        value, loaded_at = entry
+        if time.monotonic() - loaded_at >= self._lifetime(value):
+            return default
+        return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._store(key, value)
+
+    def _store(self, key, value):
+        # Caller holds self._lock
+        if key not in self._entries and len(self._entries) >= self.max_entries:
+            # Evict the oldest entry
+            oldest = min(self._entries, key=lambda k: self._entries[k][1])
+            del self._entries[oldest]
+        self._entries[key] = (value, time.monotonic())
+
+    def _generation(self, key):
+        # Caller holds self._lock
+        return self._clear_generation, self._generations.get(key, 0)
+
+    def _store_if_current(self, key, value, generation):
+        """Store a loaded value unless the key was invalidated since the load started."""
+        with self._lock:
+            if self._generation(key) == generation:
+                self._store(key, value)
+
+    def _forget_generation(self, key):
+        # Caller holds self._lock; only kept while a load of the key runs
+        if key not in self._key_locks and key not in self._refreshing:
+            self._generations.pop(key, None)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            if key in self._key_locks or key in self._refreshing:
+                self._generations[key] = self._generations.get(key, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._clear_generation += 1
+
+    def get_or_load(self, key, loader, cache_if=None):
+        """
+        Return the cached value for `key`, calling `loader()` on a miss.
+
+        Loader exceptions propagate to the caller and nothing is cached.
+        With `cache_if`, a loaded value is only cached if cache_if(value)
+        is true (it is still returned either way).
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+
+        if entry is not None:
+            value, loaded_at = entry
+            age = time.monotonic() - loaded_at
+            if age < self._lifetime(value):
+                if self.refresh_after is not None and value is not None and age >= self.refresh_after:
+                    self._refresh_in_background(key, loader)
+                return value
+
+        with self._key_lock(key):
+            # Another caller may have loaded it while we waited
+            value = self.get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+            with self._lock:
+                generation = self._generation(key)
+            value = loader()
+            if cache_if is None or cache_if(value):
+                self._store_if_current(key, value, generation)
+            return value
+
+    @contextmanager
+    def _key_lock(self, key):
+        with self._lock:
+            slot = self._key_locks.get(key)
+            if slot is None:
+                slot = self._key_locks[key] = [threading.Lock(), 0]
+            slot[1] += 1
+        try:
+            with slot[0]:
+                yield
+        finally:
+            with self._lock:
+                slot[1] -= 1
+                if not slot[1]:
+                    # Dropped once nobody waits, so keys never loaded again
+                    # (e.g. user-supplied coupon codes) do not accumulate
+                    del self._key_locks[key]
+                    self._forget_generation(key)
+
+    def _refresh_in_background(self, key, loader):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+            generation = self._generation(key)
+
+        def refresh():
+            try:
+                self._store_if_current(key, loader(), generation)
+            except Exception as e:
+                # Keep serving the current value until it expires
+                print(f"Cache refresh failed for {key!r}: {e}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+                    self._forget_generation(key)
+
+        threading.Thread(target=refresh, daemon=True).start()